@@ -199,6 +199,53 @@ def validate_fragment_name(name):
         return False, "Допускается только одно нижнее подчеркивание перед цифрой в конце (например, GoLeft_6)."
     return True, ""
 
+
+def request_story_version(data=None):
+    """
+    Версия истории, на которой редактор начинал правку: заголовок If-Match
+    (значение ETag из GET /api/story) или поле "version" в теле запроса.
+    None — клиент версию не прислал, запись выполняется без проверки.
+    """
+    raw = request.headers.get("If-Match")
+    if raw:
+        raw = raw.strip()
+        if raw.startswith("W/"):
+            raw = raw[2:]
+        raw = raw.strip('"')
+    elif isinstance(data, dict):
+        raw = data.get("version")
+    if raw in (None, "", "*"):
+        return None
+    try:
+        return int(raw)
+    except (TypeError, ValueError):
+        return None
+
+
+def commit_story_patch(user_id_str, story_id, changes, data=None, **payload):
+    """
+    save_story_patch с проверкой версии из запроса. Возвращает ответ Flask:
+    {"status": "ok", "version": новая версия, **payload} или, если историю
+    успели изменить, 409 {"error": "conflict", "version": текущая, "changes": {...}}
+    (или "story" целиком, см. story_delta_since) — клиент применяет дельту и повторяет правку.
+    Если запись не удалась, 500 {"error": ...}.
+    """
+    from novel import StoryVersionConflict, get_story_version, save_story_patch, story_delta_since
+    expected_version = request_story_version(data)
+    try:
+        version = save_story_patch(user_id_str, story_id, changes, expected_version)
+    except StoryVersionConflict as e:
+        logger.info(f"Конфликт версий истории {story_id}: клиент {expected_version}, сервер {e.current_version}")
+        delta = story_delta_since(user_id_str, story_id, expected_version)
+        return jsonify({"error": "conflict", **delta}), 409
+    if version is False:
+        return jsonify({"error": "Failed to save story"}), 500
+    if version is True:
+        version = get_story_version(story_id)
+    response = {"status": "ok", "version": version}
+    response.update(payload)
+    return jsonify(response)
+
 # --- API МАРШРУТЫ ---
 
 
@@ -455,17 +502,22 @@ def delete_html_save(story_id, player_id, save_id):
 @app.route('/api/story/<user_id_str>/<story_id>', methods=['GET'])
 def get_story(user_id_str, story_id):
     # ИЗМЕНЕНИЕ: Используем load_user_story вместо load_all
-    from novel import load_user_story
-    story = load_user_story(user_id_str, story_id)
+    from novel import load_user_story_versioned
+    story, version = load_user_story_versioned(user_id_str, story_id)
     
     if story:
-        return jsonify(story)
+        # Версию клиент возвращает в If-Match при правках (см. commit_story_patch)
+        response = jsonify(story)
+        response.headers["ETag"] = f'"{version}"'
+        response.headers["X-Story-Version"] = str(version)
+        response.headers["Access-Control-Expose-Headers"] = "ETag, X-Story-Version"
+        return response
     return jsonify({"error": "История не найдена"}), 404
 
 @app.route('/api/story/<user_id_str>/<story_id>/fragment/<fragment_id>/text', methods=['POST'])
 def update_fragment_text(user_id_str, story_id, fragment_id):
     # ИЗМЕНЕНИЕ: Загружаем только одну историю
-    from novel import load_user_story, save_story_data
+    from novel import load_user_story
     data = request.get_json()
     new_text = data.get("text", "").strip()
 
@@ -477,15 +529,13 @@ def update_fragment_text(user_id_str, story_id, fragment_id):
     if not story or "fragments" not in story or fragment_id not in story["fragments"]:
         return jsonify({"error": "Фрагмент не найден"}), 404
 
-    story["fragments"][fragment_id]["text"] = new_text
-    save_story_data(user_id_str, story_id, story)
-    return jsonify({"status": "ok"})
+    return commit_story_patch(user_id_str, story_id, {f"fragments/{fragment_id}/text": new_text}, data)
 
 
 @app.route('/api/story/<user_id_str>/<story_id>/fragment/<fragment_id>', methods=['DELETE'])
 def delete_fragment(user_id_str, story_id, fragment_id):
     # ИЗМЕНЕНИЕ: Загружаем только одну историю
-    from novel import load_user_story, save_story_data
+    from novel import load_user_story
     
     story = load_user_story(user_id_str, story_id)
 
@@ -493,23 +543,26 @@ def delete_fragment(user_id_str, story_id, fragment_id):
         return jsonify({"error": "Фрагмент не найден"}), 404
 
     del story["fragments"][fragment_id]
+    changes = {f"fragments/{fragment_id}": None}
 
     for frag_id in story["fragments"]:
         if "choices" in story["fragments"][frag_id]:
+            old_choices = story["fragments"][frag_id]["choices"]
             story["fragments"][frag_id]["choices"] = [
-                choice for choice in story["fragments"][frag_id]["choices"]
+                choice for choice in old_choices
                 if choice.get("target") != fragment_id
             ]
+            if len(story["fragments"][frag_id]["choices"]) != len(old_choices):
+                changes[f"fragments/{frag_id}/choices"] = story["fragments"][frag_id]["choices"]
 
-    save_story_data(user_id_str, story_id, story)
-    return jsonify({"status": "ok"})
+    return commit_story_patch(user_id_str, story_id, changes)
 
 
 
 @app.route('/api/story/<user_id_str>/<story_id>/fragments/delete', methods=['POST'])
 def delete_multiple_fragments(user_id_str, story_id):
     # ИЗМЕНЕНИЕ: Загружаем только одну историю
-    from novel import load_user_story, save_story_data
+    from novel import load_user_story
     data = request.get_json()
     fragment_ids = data.get("fragment_ids", [])
 
@@ -521,27 +574,31 @@ def delete_multiple_fragments(user_id_str, story_id):
     if not story or "fragments" not in story:
         return jsonify({"error": "История не найдена"}), 404
 
+    changes = {}
     for fragment_id in fragment_ids:
         if fragment_id in story["fragments"]:
             del story["fragments"][fragment_id]
+            changes[f"fragments/{fragment_id}"] = None
 
     # Удалим все ссылки на эти фрагменты из choice-ов
     for frag_id in story["fragments"]:
         if "choices" in story["fragments"][frag_id]:
+            old_choices = story["fragments"][frag_id]["choices"]
             story["fragments"][frag_id]["choices"] = [
-                choice for choice in story["fragments"][frag_id]["choices"]
+                choice for choice in old_choices
                 if choice.get("target") not in fragment_ids
             ]
+            if len(story["fragments"][frag_id]["choices"]) != len(old_choices):
+                changes[f"fragments/{frag_id}/choices"] = story["fragments"][frag_id]["choices"]
 
-    save_story_data(user_id_str, story_id, story)
-    return jsonify({"status": "ok", "deleted": fragment_ids})
+    return commit_story_patch(user_id_str, story_id, changes, data, deleted=fragment_ids)
 
 
 
 @app.route('/api/story/<user_id_str>/<story_id>/fragment/<old_name>/rename', methods=['POST'])
 def rename_fragment(user_id_str, story_id, old_name):
     # ИЗМЕНЕНИЕ: Загружаем только одну историю
-    from novel import load_user_story, save_story_data
+    from novel import load_user_story
     data = request.get_json()
     new_name = data.get("newName")
 
@@ -567,22 +624,32 @@ def rename_fragment(user_id_str, story_id, old_name):
     if new_name in story["fragments"] and old_name != new_name:
         return jsonify({"error": "Фрагмент с таким именем уже существует"}), 409
 
+    if old_name == new_name:
+        return jsonify({"status": "ok", "story": story})
+
     story["fragments"][new_name] = story["fragments"].pop(old_name)
+    changes = {
+        f"fragments/{old_name}": None,
+        f"fragments/{new_name}": story["fragments"][new_name],
+    }
 
-    for fragment in story["fragments"].values():
+    for frag_id, fragment in story["fragments"].items():
         if "choices" in fragment:
+            renamed = False
             for choice in fragment["choices"]:
                 if choice.get("target") == old_name:
                     choice["target"] = new_name
+                    renamed = True
+            if renamed and frag_id != new_name:
+                changes[f"fragments/{frag_id}/choices"] = fragment["choices"]
 
-    save_story_data(user_id_str, story_id, story)
-    return jsonify({"status": "ok", "story": story})
+    return commit_story_patch(user_id_str, story_id, changes, data, story=story)
 
 
 @app.route('/api/story/<user_id_str>/<story_id>/connect', methods=['POST'])
 def connect_fragments(user_id_str, story_id):
     # ИЗМЕНЕНИЕ: Загружаем только одну историю
-    from novel import load_user_story, save_story_data
+    from novel import load_user_story
     data = request.get_json()
     source_id = data.get("source")
     target_id = data.get("target")
@@ -601,14 +668,13 @@ def connect_fragments(user_id_str, story_id):
         source_fragment["choices"] = []
     
     source_fragment["choices"].append({"target": target_id, "text": text})
-    save_story_data(user_id_str, story_id, story)
-    return jsonify({"status": "ok", "story": story})
+    return commit_story_patch(user_id_str, story_id, {f"fragments/{source_id}/choices": source_fragment["choices"]}, data, story=story)
 
 
 @app.route('/api/story/<user_id_str>/<story_id>/create_and_connect', methods=['POST'])
 def create_and_connect_fragment(user_id_str, story_id):
     # ИЗМЕНЕНИЕ: Загружаем только одну историю
-    from novel import load_user_story, save_story_data
+    from novel import load_user_story
     data = request.get_json()
     source_id = data.get("source")
     new_name = data.get("newName")
@@ -636,8 +702,10 @@ def create_and_connect_fragment(user_id_str, story_id):
         source_fragment["choices"] = []
     source_fragment["choices"].append({"target": new_name, "text": choice_text})
 
-    save_story_data(user_id_str, story_id, story)
-    return jsonify({"status": "ok", "story": story})
+    return commit_story_patch(user_id_str, story_id, {
+        f"fragments/{new_name}": story["fragments"][new_name],
+        f"fragments/{source_id}/choices": source_fragment["choices"],
+    }, data, story=story)
 
 @app.route('/api/tgfile/<file_id>')
 def get_telegram_file(file_id):
@@ -697,7 +765,7 @@ def get_telegram_file(file_id):
 @app.route('/api/story/<user_id_str>/<story_id>/choice', methods=['PUT'])
 def update_choice(user_id_str, story_id):
     # ИЗМЕНЕНИЕ: Загружаем только одну историю
-    from novel import load_user_story, save_story_data
+    from novel import load_user_story
     data = request.get_json()
     source_id = data.get("source")
     
@@ -728,15 +796,15 @@ def update_choice(user_id_str, story_id):
     if new_effects is not None:
         source_fragment["choices"][choice_index]["effects"] = new_effects
 
-    save_story_data(user_id_str, story_id, story)
-
-    return jsonify({"status": "ok", "updatedFragment": source_fragment})
+    return commit_story_patch(user_id_str, story_id, {
+        f"fragments/{source_id}/choices/{choice_index}": source_fragment["choices"][choice_index]
+    }, data, updatedFragment=source_fragment)
 
 
 @app.route('/api/story/<user_id_str>/<story_id>/choice', methods=['DELETE'])
 def delete_choice(user_id_str, story_id):
     # ИЗМЕНЕНИЕ: Загружаем только одну историю
-    from novel import load_user_story, save_story_data
+    from novel import load_user_story
     data = request.get_json()
     source_id = data.get("source")
     choice_index = data.get("choiceIndex")
@@ -752,8 +820,8 @@ def delete_choice(user_id_str, story_id):
     source_fragment = story["fragments"][source_id]
     if "choices" in source_fragment and len(source_fragment["choices"]) > choice_index:
         del source_fragment["choices"][choice_index]
-        save_story_data(user_id_str, story_id, story)
-        return jsonify({"status": "ok"})
+        # Массив в RTDB хранится как объект с индексами, поэтому после сдвига переписываем его целиком
+        return commit_story_patch(user_id_str, story_id, {f"fragments/{source_id}/choices": source_fragment["choices"]}, data)
     
     return jsonify({"error": "Связь не найдена"}), 404
 
@@ -925,7 +993,7 @@ def upload_media():
 @app.route('/api/story/<user_id_str>/<story_id>/fragment/<fragment_id>/add_media', methods=['POST'])
 def add_media(user_id_str, story_id, fragment_id):
     # ИЗМЕНЕНИЕ: Загружаем только одну историю
-    from novel import load_user_story, save_story_data
+    from novel import load_user_story
     data = request.get_json()
 
     file_id = data.get("file_id")
@@ -939,10 +1007,10 @@ def add_media(user_id_str, story_id, fragment_id):
         return jsonify({"error": "Фрагмент не найден"}), 404
 
     media_entry = {"file_id": file_id, "type": media_type}
-    story["fragments"][fragment_id].setdefault("media", []).append(media_entry)
-    save_story_data(user_id_str, story_id, story)
-
-    return jsonify({"status": "ok"})
+    media_list = story["fragments"][fragment_id].setdefault("media", [])
+    media_list.append(media_entry)
+    # Новый элемент дописывается по следующему индексу, остальные медиа не пересылаются
+    return commit_story_patch(user_id_str, story_id, {f"fragments/{fragment_id}/media/{len(media_list) - 1}": media_entry}, data)
 
 
 
@@ -951,7 +1019,7 @@ def add_media(user_id_str, story_id, fragment_id):
 @app.route('/api/story/<user_id_str>/<story_id>/fragment/<fragment_id>/choices', methods=['PUT'])
 def update_choices(user_id_str, story_id, fragment_id):
     # ИЗМЕНЕНИЕ: Загружаем только одну историю
-    from novel import load_user_story, save_story_data
+    from novel import load_user_story
     data = request.get_json()
     choices_array = data.get("choices")
 
@@ -964,14 +1032,13 @@ def update_choices(user_id_str, story_id, fragment_id):
         return jsonify({"error": "Фрагмент не найден"}), 404
 
     story["fragments"][fragment_id]["choices"] = choices_array
-    save_story_data(user_id_str, story_id, story)
-
-    return jsonify({"status": "ok", "updatedFragment": story["fragments"][fragment_id]})
+    return commit_story_patch(user_id_str, story_id, {f"fragments/{fragment_id}/choices": choices_array}, data,
+                              updatedFragment=story["fragments"][fragment_id])
     
 @app.route('/api/story/<user_id_str>/<story_id>/fragment/<fragment_id>/media', methods=['PUT'])
 def update_media(user_id_str, story_id, fragment_id):
     # ИЗМЕНЕНИЕ: Загружаем только одну историю
-    from novel import load_user_story, save_story_data
+    from novel import load_user_story
     data = request.get_json()
     media_array = data.get("media")
 
@@ -984,16 +1051,14 @@ def update_media(user_id_str, story_id, fragment_id):
         return jsonify({"error": "Фрагмент не найден"}), 404
 
     story["fragments"][fragment_id]["media"] = media_array
-    save_story_data(user_id_str, story_id, story)
-
-    return jsonify({"status": "ok"})
+    return commit_story_patch(user_id_str, story_id, {f"fragments/{fragment_id}/media": media_array}, data)
 
 
 # --- НОВЫЙ ЭНДПОИНТ: Создание пустого фрагмента ---
 @app.route('/api/story/<user_id_str>/<story_id>/create_fragment', methods=['POST'])
 def create_standalone_fragment(user_id_str, story_id):
     # ИЗМЕНЕНИЕ: Загружаем только одну историю
-    from novel import load_user_story, save_story_data
+    from novel import load_user_story
     data = request.get_json()
     new_name = data.get("newName")
 
@@ -1018,8 +1083,7 @@ def create_standalone_fragment(user_id_str, story_id):
         "media": []
     }
     
-    save_story_data(user_id_str, story_id, story)
-    return jsonify({"status": "ok", "story": story})
+    return commit_story_patch(user_id_str, story_id, {f"fragments/{new_name}": story["fragments"][new_name]}, data, story=story)
 
 
 # --- ЭНДПОИНТ: Сохранение заметки (ОБНОВЛЕНО) ---
@@ -1117,23 +1181,22 @@ def get_story_effects(user_id_str, story_id):
 
 @app.route('/api/stories/<user_id_str>', methods=['GET'])
 def get_story_list(user_id_str):
-    from novel import load_all_user_stories
+    from novel import load_story_meta_list
     try:
-        all_stories = load_all_user_stories(user_id_str)
+        all_stories = load_story_meta_list(user_id_str)
         result = []
 
         for story_id, story_data in all_stories.items():
-            if story_id == "secret_key":
-                continue
-
             result.append({
                 "id": story_id,
-                "title": story_data.get("title", "Без названия"),
+                "title": story_data.get("title") or "Без названия",
                 "public": story_data.get("public", False),
                 "user_name": story_data.get("user_name", None),
                 "neural": story_data.get("neural", False),
                 # 👇 ДОБАВЛЯЕМ ЭТУ СТРОКУ
-                "webgame_ready": story_data.get("webgame_ready", False) 
+                "webgame_ready": story_data.get("webgame_ready", False),
+                "fragments": story_data.get("fragments", 0),
+                "updated": story_data.get("updated")
             })
 
         return jsonify(result)
@@ -1144,7 +1207,7 @@ def get_story_list(user_id_str):
 # 2. Добавьте НОВЫЙ маршрут для переключения статуса WebGame
 @app.route('/api/story/<user_id_str>/<story_id>/webgame', methods=['POST'])
 def update_webgame_status(user_id_str, story_id):
-    from novel import load_user_story, save_story_data
+    from novel import load_user_story
     
     data = request.get_json()
     # Получаем статус, по умолчанию False
@@ -1154,10 +1217,7 @@ def update_webgame_status(user_id_str, story_id):
     if not story:
         return jsonify({"error": "История не найдена"}), 404
         
-    story["webgame_ready"] = new_status
-    save_story_data(user_id_str, story_id, story)
-    
-    return jsonify({"status": "ok", "webgame_ready": new_status})
+    return commit_story_patch(user_id_str, story_id, {"webgame_ready": new_status}, data, webgame_ready=new_status)
 
 import uuid # <-- 1. ДОБАВЬТЕ ЭТОТ ИМПОРТ
 # <-- 3. ДОБАВЬТЕ ЭТОТ НОВЫЙ МАРШРУТ (после get_stories_list) -->
@@ -1204,12 +1264,13 @@ def create_new_story(user_id_str):
         }
 
         # Сохраняем новую историю
-        save_story_data(user_id_str, story_id, new_story)
+        version = save_story_data(user_id_str, story_id, new_story)
 
         return jsonify({
             "status": "ok", 
             "story_id": story_id, 
-            "title": title
+            "title": title,
+            "version": version
         }), 201
 
     except Exception as e:
@@ -1224,13 +1285,15 @@ def delete_story(user_id_str, story_id):
     """
     Удаляет историю по user_id_str и story_id.
     """
-    from firebase_admin import db
+    from storage import db
+    from novel import drop_story_index
     try:
         ref = db.reference(f'users_story/{user_id_str}/{story_id}')
         if ref.get() is None:
             return jsonify({"error": "История не найдена"}), 404
 
         ref.delete()
+        drop_story_index(story_id, user_id_str)
         return jsonify({"status": "deleted", "story_id": story_id}), 200
 
     except Exception as e:
@@ -1241,7 +1304,7 @@ def delete_story(user_id_str, story_id):
 @app.route('/api/story/<user_id_str>/<story_id>/public', methods=['POST'])
 def update_story_public_status(user_id_str, story_id):
     # ИЗМЕНЕНИЕ: Загружаем только одну историю
-    from novel import load_user_story, save_story_data
+    from novel import load_user_story
 
     try:
         data = request.get_json()
@@ -1254,19 +1317,21 @@ def update_story_public_status(user_id_str, story_id):
             return jsonify({"error": "История не найдена"}), 404
 
         story["public"] = new_status
+        changes = {"public": new_status}
 
         if new_status and user_name:
             story["user_name"] = user_name
+            changes["user_name"] = user_name
         elif not new_status:
             story.pop("user_name", None)
+            changes["user_name"] = None
 
-        save_story_data(user_id_str, story_id, story)
-
-        return jsonify({
-            "status": "ok",
-            "public": new_status,
-            "user_name": story.get("user_name")
-        })
+        # commit_story_patch → save_story_patch в том же update добавляет историю в public_catalog или убирает из него
+        return commit_story_patch(
+            user_id_str, story_id, changes, data,
+            public=new_status,
+            user_name=story.get("user_name"),
+        )
     except Exception as e:
         logger.error(f"Ошибка при обновлении статуса публичности: {e}")
         return jsonify({"error": "Не удалось обновить статус"}), 500
@@ -1313,7 +1378,7 @@ def react_router_entry(user_story):
 
 @app.route('/api/auth/validate_access', methods=['POST'])
 def validate_access_route():
-    from firebase_admin import db
+    from storage import db
     
     data = request.get_json()
     user_id = data.get('user_id')
@@ -0,0 +1,113 @@
+"""
+Сравнение обычного и сжатого (story_blocks) хранения фрагментов большой истории.
+
+Генерирует синтетическую историю, записывает её в базу в обоих видах и меряет:
+  • объём ответа на чтение истории (JSON, как его отдаёт RTDB);
+  • время чтения из настроенного STORAGE_BACKEND вместе с раскодированием блоков;
+  • оценку полного времени загрузки с передачей по сети на --mbps.
+
+Запуск (по умолчанию — во временной SQLite-базе, Firebase не трогается):
+    python benchmarks/story_compression.py --fragments 2000 --runs 5
+С STORAGE_BACKEND=firebase данные пишутся во временный узел bench_story_compression
+и удаляются после замера.
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+if "STORAGE_BACKEND" not in os.environ:
+    os.environ["STORAGE_BACKEND"] = "sqlite"
+    os.environ.setdefault("STORAGE_SQLITE_PATH", os.path.join(tempfile.mkdtemp(), "bench.sqlite3"))
+
+from storage import db, init_storage  # noqa: E402
+from story_blocks import pack_story, unpack_story  # noqa: E402
+
+BENCH_ROOT = "bench_story_compression"
+WORDS = (
+    "тьма свет дорога замок дверь ключ король лес река старик меч тень огонь "
+    "шаг голос окно башня ночь утро город стража письмо тайна кровь камень"
+).split()
+
+
+def make_story(fragment_count: int, seed: int = 1) -> dict:
+    """История, похожая на сгенерированные нейросетью: ветки по 10 фрагментов, текст, выборы, эффекты."""
+    rng = random.Random(seed)
+    branches = [f"branch{i}" for i in range(max(1, fragment_count // 10))]
+    ids = ["main_1"] + [f"{rng.choice(branches)}_{i}" for i in range(2, fragment_count + 1)]
+    fragments = {}
+    for fragment_id in ids:
+        text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(40, 120))).capitalize() + "."
+        choices = [
+            {
+                "target": rng.choice(ids),
+                "text": " ".join(rng.choice(WORDS) for _ in range(3)),
+                "effects": [{"stat": "сила", "value": f"+{rng.randint(1, 5)}", "hide": False}],
+            }
+            for _ in range(rng.randint(1, 3))
+        ]
+        fragments[fragment_id] = {"text": text, "choices": choices, "media": []}
+    return {"title": "Benchmark", "owner_id": "bench", "neural": True, "fragments": fragments}
+
+
+def payload_bytes(value) -> int:
+    return len(json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+
+def time_reads(path: str, runs: int, decode: bool) -> list:
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        story = db.reference(path).get()
+        if decode:
+            story = unpack_story(story)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fragments", type=int, default=2000)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--mbps", type=float, default=10.0, help="пропускная способность для оценки передачи")
+    args = parser.parse_args()
+
+    init_storage()
+    story = make_story(args.fragments)
+    packed = pack_story(story)
+    assert unpack_story(packed)["fragments"] == story["fragments"]
+
+    plain_path = f"{BENCH_ROOT}/plain"
+    packed_path = f"{BENCH_ROOT}/packed"
+    db.reference(plain_path).set(story)
+    db.reference(packed_path).set(packed)
+    try:
+        results = []
+        for name, path, decode, value in (
+            ("обычный", plain_path, False, story),
+            ("сжатый", packed_path, True, packed),
+        ):
+            size = payload_bytes(value)
+            read = statistics.median(time_reads(path, args.runs, decode))
+            transfer = size * 8 / (args.mbps * 1_000_000)
+            results.append((name, size, read, transfer))
+    finally:
+        db.reference(BENCH_ROOT).delete()
+
+    print(f"Фрагментов: {args.fragments}, backend: {db.backend}, прогонов: {args.runs}, сеть: {args.mbps} Мбит/с")
+    print(f"{'режим':<10}{'байт':>12}{'чтение, мс':>14}{'передача, мс':>16}{'итого, мс':>12}")
+    for name, size, read, transfer in results:
+        print(f"{name:<10}{size:>12}{read * 1000:>14.1f}{transfer * 1000:>16.1f}{(read + transfer) * 1000:>12.1f}")
+    plain_size, packed_size = results[0][1], results[1][1]
+    print(f"Сжатие: {plain_size / packed_size:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Микробенчмарк подстановки атрибутов: прежний путь на регулярках против
+скомпилированного шаблона (story_template).
+
+На длинном фрагменте с подстановками {{{атрибут}}} и логическими блоками
+меряется время одного рендера: регулярками, компиляция+рендер (первый показ
+новой версии фрагмента) и рендер из кэша (все последующие показы и шаги).
+Перед замером проверяется, что оба пути дают одинаковый текст.
+
+    python benchmarks/template_render.py --blocks 400 --runs 200
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from story_template import TemplateCache, render_template  # noqa: E402
+
+MISSING = "значение не обнаружено в текущей игре"
+
+
+def regex_apply_effect_values(base_text: str, effects_dict: dict) -> str:
+    """Прежняя реализация apply_effect_values (без логирования) — эталон для сравнения."""
+    normalized_effects = {str(k).strip().lower(): v for k, v in effects_dict.items()}
+
+    def html_unescape_inside_braces(match):
+        inner = match.group(1) if match.group(1) is not None else match.group(2)
+        inner = inner.replace("&gt;", ">").replace("&lt;", "<").replace("&amp;", "&")
+        if match.group(1) is not None:
+            return "{{{" + inner + "}}}"
+        return "{{" + inner + "}}"
+
+    text = re.sub(r"\{\{\{(.*?)\}\}\}|\{\{(.*?)\}\}", html_unescape_inside_braces, base_text, flags=re.DOTALL)
+
+    logic_pattern = re.compile(
+        r"\{\{\s*([а-яА-ЯёЁa-zA-Z_]+)\s*:\s*([<>=])\s*(\d+)"
+        r"(?:\s*-\s*(\d+))?\s*\}\}(.*?)\{\{\s*\1\s*\}\}",
+        re.DOTALL | re.IGNORECASE,
+    )
+
+    def logic_replacer(match):
+        value = normalized_effects.get(match.group(1).strip().lower())
+        if value is None:
+            return ""
+        num1, num2 = int(match.group(3)), match.group(4)
+        check_num = random.randint(min(num1, int(num2)), max(num1, int(num2))) if num2 else num1
+        op = match.group(2)
+        if op == ">":
+            result = value > check_num
+        elif op == "<":
+            result = value < check_num
+        else:
+            result = value == check_num
+        return match.group(5) if result else ""
+
+    text = re.sub(logic_pattern, logic_replacer, text)
+
+    def triple_value_replacer(match):
+        value = normalized_effects.get(match.group(1).strip().lower())
+        return MISSING if value is None else str(value)
+
+    text = re.sub(r"\{\{\{\s*([а-яА-ЯёЁa-zA-Z_]+)\s*\}\}\}", triple_value_replacer, text)
+    if not text.strip():
+        return "Нет текста для отображения в текущем прохождении из-за несоответствия атрибутам."
+    return text
+
+
+def make_fragment(blocks: int, seed: int = 7) -> str:
+    rng = random.Random(seed)
+    stats = ["сила", "Ловкость", "удача", "мана", "золото"]
+    words = "ветер шумел над башней и стража молчала пока тени ползли к воротам".split()
+    parts = []
+    for _ in range(blocks):
+        parts.append(" ".join(rng.choice(words) for _ in range(rng.randint(10, 40))))
+        kind = rng.random()
+        stat = rng.choice(stats)
+        if kind < 0.5:
+            parts.append(f" У вас {{{{{{{stat}}}}}}} очков. ")
+        elif kind < 0.8:
+            op = rng.choice(["&gt;", "&lt;", "="])
+            parts.append(f"{{{{{stat}:{op}{rng.randint(0, 9)}}}}}<i>скрытый текст {{{{{{{stat}}}}}}}</i>{{{{{stat}}}}} ")
+        else:
+            parts.append(f" ((+{rng.randint(1, 5)})) ")
+    return "".join(parts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--blocks", type=int, default=400, help="число абзацев с плейсхолдерами")
+    parser.add_argument("--runs", type=int, default=200)
+    args = parser.parse_args()
+
+    text = make_fragment(args.blocks)
+    effects = {"Сила": 5, "ловкость": 2, "удача": 7, "золото": 120}
+    normalized = {str(k).strip().lower(): v for k, v in effects.items()}
+
+    def compiled(cache):
+        return render_template(cache.get(text, "basic"), normalized.get, lambda attr_raw: MISSING)
+
+    assert compiled(TemplateCache()) == regex_apply_effect_values(text, effects), "результаты расходятся"
+
+    warm_cache = TemplateCache()
+    compiled(warm_cache)
+    timings = {
+        "регулярки": timeit.timeit(lambda: regex_apply_effect_values(text, effects), number=args.runs),
+        "компиляция + рендер": timeit.timeit(lambda: compiled(TemplateCache()), number=args.runs),
+        "рендер из кэша": timeit.timeit(lambda: compiled(warm_cache), number=args.runs),
+    }
+
+    print(f"Текст: {len(text)} символов, {args.blocks} абзацев, прогонов: {args.runs}")
+    base = timings["регулярки"]
+    for name, total in timings.items():
+        per_call = total / args.runs * 1_000_000
+        print(f"{name:<22}{per_call:>10.1f} мкс/рендер  ×{base / total:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Накладные расходы на одновременные таймеры фрагментов: колесо таймеров
+(timer_wheel.TimerWheel) против отдельной спящей asyncio-задачи на каждый таймер,
+как было с active_timers / active_edit_tasks.
+
+Для --timers таймеров со случайными паузами меряется:
+  • память на ожидающие таймеры (tracemalloc);
+  • время постановки всех таймеров и отмены всех таймеров;
+  • число asyncio-задач, живущих в ожидании.
+Время меряется под tracemalloc, поэтому завышено (одинаково для обоих способов).
+Затем короткий прогон (--fire-window секунд) проверяет, что все таймеры
+срабатывают, и показывает опоздание срабатывания.
+
+    python benchmarks/timer_wheel.py --timers 10000
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from timer_wheel import TimerWheel  # noqa: E402
+
+
+async def _noop():
+    pass
+
+
+async def _sleeping_timer(delay: float):
+    await asyncio.sleep(delay)
+    await _noop()
+
+
+async def measure_tasks(delays: list) -> dict:
+    tracemalloc.start()
+    started = time.perf_counter()
+    tasks = {(i % 500, f"auto_{i}"): asyncio.create_task(_sleeping_timer(delay)) for i, delay in enumerate(delays)}
+    await asyncio.sleep(0)  # Задачи доходят до sleep, как в боте
+    schedule_time = time.perf_counter() - started
+    memory = tracemalloc.get_traced_memory()[0]
+    alive = len(asyncio.all_tasks()) - 1
+    started = time.perf_counter()
+    for task in tasks.values():
+        task.cancel()
+    await asyncio.gather(*tasks.values(), return_exceptions=True)
+    cancel_time = time.perf_counter() - started
+    tracemalloc.stop()
+    return {"memory": memory, "schedule": schedule_time, "cancel": cancel_time, "tasks": alive}
+
+
+async def measure_wheel(delays: list) -> dict:
+    wheel = TimerWheel()
+    tracemalloc.start()
+    started = time.perf_counter()
+    for i, delay in enumerate(delays):
+        wheel.schedule((i % 500, f"auto_{i}"), delay, _noop)
+    await asyncio.sleep(0)
+    schedule_time = time.perf_counter() - started
+    memory = tracemalloc.get_traced_memory()[0]
+    alive = len(asyncio.all_tasks()) - 1
+    started = time.perf_counter()
+    for i in range(len(delays)):
+        wheel.cancel((i % 500, f"auto_{i}"))
+    cancel_time = time.perf_counter() - started
+    tracemalloc.stop()
+    await asyncio.sleep(wheel.tick * 2)  # Драйвер завершается, когда таймеров не осталось
+    return {"memory": memory, "schedule": schedule_time, "cancel": cancel_time, "tasks": alive}
+
+
+async def measure_firing(count: int, window: float) -> dict:
+    wheel = TimerWheel()
+    lateness = []
+
+    async def record(due: float):
+        lateness.append(time.monotonic() - due)
+
+    rng = random.Random(2)
+    for i in range(count):
+        delay = rng.uniform(0, window)
+        wheel.schedule(i, delay, record, time.monotonic() + delay)
+    while len(wheel) or wheel.stats()["running"]:
+        await asyncio.sleep(wheel.tick)
+    return {
+        "fired": len(lateness),
+        "median_ms": statistics.median(lateness) * 1000,
+        "max_ms": max(lateness) * 1000,
+    }
+
+
+async def main_async(args):
+    rng = random.Random(1)
+    delays = [rng.uniform(1, 60) for _ in range(args.timers)]
+
+    results = {
+        "задачи": await measure_tasks(delays),
+        "колесо": await measure_wheel(delays),
+    }
+    print(f"Таймеров: {args.timers}")
+    print(f"{'способ':<10}{'память, КБ':>12}{'на таймер, Б':>14}{'постановка, мс':>16}{'отмена, мс':>12}{'задач':>8}")
+    for name, r in results.items():
+        print(
+            f"{name:<10}{r['memory'] / 1024:>12.0f}{r['memory'] / args.timers:>14.0f}"
+            f"{r['schedule'] * 1000:>16.1f}{r['cancel'] * 1000:>12.1f}{r['tasks']:>8}"
+        )
+    ratio = results["задачи"]["memory"] / max(results["колесо"]["memory"], 1)
+    print(f"Память: колесо в {ratio:.1f} раза меньше")
+
+    firing = await measure_firing(args.timers, args.fire_window)
+    print(
+        f"Срабатывание за {args.fire_window} с: {firing['fired']}/{args.timers}, "
+        f"опоздание медиана {firing['median_ms']:.0f} мс, максимум {firing['max_ms']:.0f} мс"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--timers", type=int, default=10000)
+    parser.add_argument("--fire-window", type=float, default=3.0, help="в пределах скольких секунд срабатывают таймеры прогона")
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Асинхронный шлюз к синхронному Firebase Admin SDK.
+
+Все вызовы db.reference(...).get()/set()/update() блокирующие. Если делать их
+прямо в async-хендлерах, event loop PTB стоит на каждом сетевом запросе и
+все остальные чаты ждут. Шлюз выполняет такие вызовы в отдельном
+ограниченном пуле потоков, ограничивает время ожидания и считает метрики
+очереди.
+
+Как и story_cache, это отдельный модуль: novel.py запускается как __main__,
+а background.py импортирует novel повторно, но пул и метрики должны быть
+общими для всего процесса.
+"""
+
+import asyncio
+import functools
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+DB_GATEWAY_WORKERS = int(os.environ.get("DB_GATEWAY_WORKERS", 16))
+DB_GATEWAY_TIMEOUT = float(os.environ.get("DB_GATEWAY_TIMEOUT", 20))
+
+
+class DBTimeoutError(TimeoutError):
+    """Вызов к базе не уложился в отведённое время."""
+
+
+class DBGateway:
+    """
+    Ограниченный пул потоков для блокирующих обращений к базе.
+    Очередь — задачи, отправленные в пул, но ещё не взятые потоком.
+    """
+
+    def __init__(self, max_workers: int = DB_GATEWAY_WORKERS, timeout: float = DB_GATEWAY_TIMEOUT):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="db-gateway")
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.in_flight = 0
+        self.max_queued = 0
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.total_run = 0.0
+
+    async def call(self, func, *args, timeout: float = None, **kwargs):
+        """
+        Выполняет func(*args, **kwargs) в пуле и возвращает результат.
+        При превышении timeout бросает DBTimeoutError; сам вызов при этом
+        доработает в фоне (отменить поток нельзя), но хендлер его больше не ждёт.
+        """
+        submitted_at = time.monotonic()
+        with self._lock:
+            self.calls += 1
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            self._executor, functools.partial(self._run, submitted_at, func, *args, **kwargs)
+        )
+        limit = self.timeout if timeout is None else timeout
+        try:
+            return await asyncio.wait_for(future, timeout=limit)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            name = getattr(func, "__qualname__", repr(func))
+            logger.error(f"DB gateway: вызов {name} не уложился в {limit} с")
+            raise DBTimeoutError(f"{name} timed out after {limit}s") from None
+
+    def _run(self, submitted_at: float, func, *args, **kwargs):
+        started_at = time.monotonic()
+        with self._lock:
+            self.queued -= 1
+            self.in_flight += 1
+            self.total_wait += started_at - submitted_at
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self.total_run += time.monotonic() - started_at
+
+    def stats(self) -> dict:
+        with self._lock:
+            finished = self.calls - self.queued - self.in_flight
+            return {
+                "workers": self.max_workers,
+                "timeout": self.timeout,
+                "queued": self.queued,
+                "max_queued": self.max_queued,
+                "in_flight": self.in_flight,
+                "calls": self.calls,
+                "errors": self.errors,
+                "timeouts": self.timeouts,
+                "avg_wait_ms": round(self.total_wait / finished * 1000, 1) if finished else 0.0,
+                "avg_run_ms": round(self.total_run / finished * 1000, 1) if finished else 0.0,
+            }
+
+
+db_gateway = DBGateway()
+
+
+async def db_call(func, *args, timeout: float = None, **kwargs):
+    """Сокращение для db_gateway.call(...)."""
+    return await db_gateway.call(func, *args, timeout=timeout, **kwargs)
@@ -0,0 +1,266 @@
+"""
+Общий планировщик правок сообщений (edit_message_text / caption / media / reply_markup).
+
+Пошаговый показ текста, авто-переходы и голосования раньше редактировали
+сообщения напрямую и независимо друг от друга, и в оживлённых чатах бот
+упирался во flood-лимиты Telegram (RetryAfter лавиной). Теперь все такие
+правки идут через планировщик:
+  • у каждого чата своя очередь и token bucket, плюс общий bucket на весь бот;
+  • новая правка того же сообщения тем же методом замещает ещё не отправленную —
+    уходит только последнее состояние, а все ожидающие получают его результат;
+  • RetryAfter блокирует чат на указанное время (с нарастающим множителем
+    при повторах), и правка повторяется, если её не успели заместить;
+  • правки, все отправители которых уже отменены (задача показа прервана), не отправляются.
+
+Как db_gateway и story_cache, это отдельный модуль: novel.py запускается как
+__main__, а background.py импортирует novel повторно, но лимиты общие на процесс.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+EDIT_CHAT_RATE = float(os.environ.get("EDIT_CHAT_RATE", 1.0))  # Правок в секунду на чат
+EDIT_CHAT_BURST = int(os.environ.get("EDIT_CHAT_BURST", 3))
+EDIT_GLOBAL_RATE = float(os.environ.get("EDIT_GLOBAL_RATE", 25.0))  # Правок в секунду на весь бот
+EDIT_GLOBAL_BURST = int(os.environ.get("EDIT_GLOBAL_BURST", 30))
+EDIT_MAX_RETRIES = int(os.environ.get("EDIT_MAX_RETRIES", 5))
+EDIT_BACKOFF_FACTOR = 1.5  # Множитель паузы при повторных RetryAfter подряд
+EDIT_IDLE_BUCKETS = 1000  # Сколько bucket'ов простаивающих чатов держать, прежде чем чистить
+
+
+class TokenBucket:
+    """Классический token bucket; block() запрещает отправку до указанного момента (RetryAfter)."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Сколько секунд ждать до следующего токена (0 — можно отправлять)."""
+        now = time.monotonic()
+        self._refill(now)
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def block(self, seconds: float) -> None:
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = min(self.tokens, 0.0)
+
+    def is_idle(self) -> bool:
+        return self.delay() == 0 and self.tokens >= self.capacity
+
+
+class _PendingEdit:
+    __slots__ = ("bot", "method", "kwargs", "futures", "submitted_at", "attempts")
+
+    def __init__(self, bot, method: str, kwargs: dict, future: asyncio.Future):
+        self.bot = bot
+        self.method = method
+        self.kwargs = kwargs
+        self.futures = [future]
+        self.submitted_at = time.monotonic()
+        self.attempts = 0
+
+    def abandoned(self) -> bool:
+        return all(future.done() for future in self.futures)
+
+    def resolve(self, result=None, error: BaseException = None) -> None:
+        for future in self.futures:
+            if future.done():
+                continue
+            if isinstance(error, asyncio.CancelledError):
+                future.cancel()
+            elif error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+def _retry_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class EditScheduler:
+    """
+    Очереди правок по чатам. Чат — chat_id, а для inline-сообщений (чат неизвестен)
+    отдельной «очередью» считается само inline_message_id.
+    """
+
+    def __init__(
+        self,
+        chat_rate: float = EDIT_CHAT_RATE,
+        chat_burst: int = EDIT_CHAT_BURST,
+        global_rate: float = EDIT_GLOBAL_RATE,
+        global_burst: int = EDIT_GLOBAL_BURST,
+        max_retries: int = EDIT_MAX_RETRIES,
+    ):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self._queues = {}
+        self._buckets = {}
+        self._workers = {}
+        self.depth = 0
+        self.max_depth = 0
+        self.submitted = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.retries = 0
+        self.failed = 0
+        self.total_wait = 0.0
+
+    async def edit(self, bot, method: str, **kwargs):
+        """
+        Ставит bot.<method>(**kwargs) в очередь и ждёт результата. Если правку
+        заместила более новая, возвращается результат той, что была отправлена;
+        ошибки Telegram (BadRequest и т.п.) пробрасываются вызывающему как раньше.
+        """
+        return await self.submit(bot, method, **kwargs)
+
+    def submit(self, bot, method: str, **kwargs) -> asyncio.Future:
+        inline_message_id = kwargs.get("inline_message_id")
+        if inline_message_id:
+            chat_key = message_key = inline_message_id
+        else:
+            chat_key = kwargs.get("chat_id")
+            message_key = (chat_key, kwargs.get("message_id"))
+
+        future = asyncio.get_running_loop().create_future()
+        self.submitted += 1
+        queue = self._queues.setdefault(chat_key, OrderedDict())
+        key = (message_key, method)
+        pending = queue.get(key)
+        if pending is not None:
+            # Ещё не отправлено — заменяем содержимое, место в очереди сохраняется
+            pending.kwargs = kwargs
+            pending.bot = bot
+            pending.futures.append(future)
+            self.coalesced += 1
+        else:
+            queue[key] = _PendingEdit(bot, method, kwargs, future)
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+
+        if chat_key not in self._workers:
+            self._workers[chat_key] = asyncio.create_task(self._drain(chat_key))
+        return future
+
+    def _chat_bucket(self, chat_key) -> TokenBucket:
+        bucket = self._buckets.get(chat_key)
+        if bucket is None:
+            if len(self._buckets) >= EDIT_IDLE_BUCKETS:
+                for idle_key in [k for k, b in self._buckets.items() if k not in self._workers and b.is_idle()]:
+                    del self._buckets[idle_key]
+            bucket = self._buckets[chat_key] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _drain(self, chat_key) -> None:
+        queue = self._queues[chat_key]
+        bucket = self._chat_bucket(chat_key)
+        try:
+            while queue:
+                key, pending = next(iter(queue.items()))
+                if pending.abandoned():
+                    del queue[key]
+                    self.depth -= 1
+                    self.dropped += 1
+                    continue
+
+                wait = max(bucket.delay(), self.global_bucket.delay())
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+
+                bucket.take()
+                self.global_bucket.take()
+                del queue[key]
+                self.depth -= 1
+
+                try:
+                    result = await getattr(pending.bot, pending.method)(**pending.kwargs)
+                except RetryAfter as e:
+                    self.retries += 1
+                    pending.attempts += 1
+                    pause = _retry_seconds(e) * EDIT_BACKOFF_FACTOR ** (pending.attempts - 1)
+                    bucket.block(pause)
+                    logger.warning(f"Edit scheduler: RetryAfter в чате {chat_key}, пауза {pause:.1f} с (попытка {pending.attempts})")
+                    if pending.attempts > self.max_retries:
+                        self._finish(pending, error=e)
+                    elif key in queue:
+                        # За время ожидания пришло более новое состояние — отправится оно
+                        queue[key].futures.extend(pending.futures)
+                        self.coalesced += 1
+                    else:
+                        queue[key] = pending
+                        queue.move_to_end(key, last=False)
+                        self.depth += 1
+                except Exception as e:
+                    self._finish(pending, error=e)
+                else:
+                    self._finish(pending, result)
+        except asyncio.CancelledError:
+            for pending in queue.values():
+                pending.resolve(error=asyncio.CancelledError())
+            self.depth -= len(queue)
+            queue.clear()
+            raise
+        finally:
+            self._workers.pop(chat_key, None)
+            if not queue:
+                self._queues.pop(chat_key, None)
+
+    def _finish(self, pending: _PendingEdit, result=None, error: BaseException = None) -> None:
+        if error is not None:
+            self.failed += 1
+        else:
+            self.sent += 1
+        self.total_wait += time.monotonic() - pending.submitted_at
+        pending.resolve(result, error)
+
+    def stats(self) -> dict:
+        finished = self.sent + self.failed
+        return {
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "active_chats": len(self._workers),
+            "submitted": self.submitted,
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "retries": self.retries,
+            "failed": self.failed,
+            "avg_wait_ms": round(self.total_wait / finished * 1000, 1) if finished else 0.0,
+        }
+
+
+edit_scheduler = EditScheduler()
+
+
+async def scheduled_edit(bot, method: str, **kwargs):
+    """Сокращение для edit_scheduler.edit(...)."""
+    return await edit_scheduler.edit(bot, method, **kwargs)
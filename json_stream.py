@@ -0,0 +1,119 @@
+"""
+Потоковое чтение и запись больших JSON-файлов (дампов Firebase).
+
+json.load держит в памяти весь дамп, а копия после json.dump(indent=2) — ещё
+больше. Здесь объект читается по ключам: вызывающий код сам решает, в какие
+узлы спускаться (begin_object/next_key), а какие значения декодировать целиком
+(read_value). В памяти одновременно лежит только текущее значение и буфер чтения.
+Запись симметрична: JsonStreamWriter пишет компактный JSON по мере обхода.
+"""
+
+import json
+
+_WHITESPACE = " \t\n\r"
+# Символы, которыми может продолжаться число: "12345." или "1e" на границе буфера — ещё не конец
+_NUMBER_CHARS = ".eE+-0123456789"
+
+
+class JsonStreamReader:
+    """Пошаговый разбор JSON-объекта из текстового файла."""
+
+    def __init__(self, fp, chunk_size: int = 1 << 16):
+        self._fp = fp
+        self._chunk_size = chunk_size
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _read_more(self, size: int = None) -> bool:
+        if self._eof:
+            return False
+        if self._pos > self._chunk_size:
+            self._buf = self._buf[self._pos:]
+            self._pos = 0
+        chunk = self._fp.read(size or self._chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buf += chunk
+        return True
+
+    def peek(self) -> str:
+        """Следующий значимый символ (пропуская пробелы); пустая строка в конце файла."""
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._read_more():
+                return ""
+
+    def _expect(self, char: str) -> None:
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Ожидался '{char}', найдено {found!r} (позиция {self._pos})")
+        self._pos += 1
+
+    def begin_object(self) -> None:
+        """Входит в объект: следующий вызов next_key вернёт его первый ключ."""
+        self._expect("{")
+
+    def next_key(self):
+        """Ключ следующего поля текущего объекта или None, если объект закончился."""
+        char = self.peek()
+        if char == ",":
+            self._pos += 1
+            char = self.peek()
+        if char == "}":
+            self._pos += 1
+            return None
+        if char != '"':
+            raise ValueError(f"Ожидался ключ объекта, найдено {char!r} (позиция {self._pos})")
+        key = self.read_value()
+        self._expect(":")
+        return key
+
+    def read_value(self):
+        """Декодирует следующее значение целиком."""
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                # Значение не поместилось в буфер — дочитываем (с ростом, чтобы не было квадратичности)
+                if not self._read_more(max(self._chunk_size, len(self._buf) - self._pos)):
+                    raise
+                continue
+            # Число или литерал на границе буфера мог оборваться — убеждаемся, что за ним что-то есть
+            # и что это не продолжение числа (raw_decode отдаёт "12345." как 12345)
+            if not self._eof and (end == len(self._buf) or self._buf[end] in _NUMBER_CHARS) and self._read_more():
+                continue
+            self._pos = end
+            return value
+
+
+class JsonStreamWriter:
+    """Компактная потоковая запись JSON-объектов."""
+
+    def __init__(self, fp):
+        self._fp = fp
+        self._first = []
+
+    def begin_object(self) -> None:
+        self._fp.write("{")
+        self._first.append(True)
+
+    def key(self, key: str) -> None:
+        if not self._first[-1]:
+            self._fp.write(",")
+        self._first[-1] = False
+        self._fp.write(json.dumps(str(key), ensure_ascii=False))
+        self._fp.write(":")
+
+    def value(self, value) -> None:
+        self._fp.write(json.dumps(value, ensure_ascii=False, separators=(",", ":")))
+
+    def end_object(self) -> None:
+        self._first.pop()
+        self._fp.write("}")
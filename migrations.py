@@ -0,0 +1,162 @@
+"""
+Возобновляемые массовые миграции по users_story.
+
+Миграция описывает, что записать для одной истории (transform), а раннер
+обходит пользователей и их истории по shallow-ключам, не загружая users_story
+целиком, копит записи в multi-location update ограниченного размера (по числу
+путей и по объёму в байтах) и вместе с каждой пачкой сохраняет курсор в
+migrations/{name}. Прерванная миграция (рестарт, ошибка) продолжается с последней
+записанной пачки. Миграция, которой мало переписать данные вслепую (например,
+перенос фрагментов, пока историю могут править), задаёт migrate_story и пишет
+каждую историю сама — с проверкой версии.
+"""
+
+import json
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional
+
+from db_gateway import db_call
+from storage import db, shallow_keys
+from story_blocks import read_story
+
+logger = logging.getLogger(__name__)
+
+MIGRATION_BATCH_PATHS = 500  # Максимум путей в одном multi-location update
+# Максимум байт в одном multi-location update: одно дерево fragments — это один путь любого размера
+MIGRATION_BATCH_BYTES = 4 * 1024 * 1024
+
+
+@dataclass
+class Migration:
+    """
+    name — ключ в migrations/{name} и аргумент /migrate.
+    transform(user_id, story_id, story) возвращает {путь от корня: значение} или {};
+    story — содержимое истории в обычном виде (см. story_blocks.read_story), либо None, если needs_story=False (тогда история не читается).
+    migrate_story(user_id, story_id) — вместо transform: сама читает и записывает историю
+    (вызывается в потоке db_call) и возвращает число сделанных записей; пачки для неё не копятся.
+    finish() вызывается один раз после успешного завершения.
+    """
+
+    name: str
+    description: str
+    transform: Optional[Callable[[str, str, Optional[dict]], Dict[str, Any]]] = None
+    needs_story: bool = True
+    finish: Optional[Callable[[], None]] = None
+    migrate_story: Optional[Callable[[str, str], int]] = None
+
+
+MIGRATIONS: Dict[str, Migration] = {}
+
+
+def register_migration(migration: Migration) -> Migration:
+    MIGRATIONS[migration.name] = migration
+    return migration
+
+
+def load_migration_state(name: str) -> dict:
+    return db.reference(f"migrations/{name}").get() or {}
+
+
+def _update_size(updates: dict) -> int:
+    """Примерный объём multi-location update в байтах (как JSON в теле запроса)."""
+    return sum(len(path.encode("utf-8")) + len(json.dumps(value, ensure_ascii=False).encode("utf-8")) for path, value in updates.items())
+
+
+async def run_migration(migration: Migration, restart: bool = False, report=None) -> dict:
+    """
+    Выполняет (или продолжает) миграцию. Курсор — последняя обработанная пара
+    (user_id, story_id) в порядке сортировки ключей; он пишется в той же записи,
+    что и пачка, поэтому данные и курсор не расходятся.
+    report(state) — корутина, вызывается после каждой пачки для отчёта о скорости.
+    Возвращает итоговое состояние migrations/{name}.
+    """
+    state_path = f"migrations/{migration.name}"
+    state = {} if restart else await db_call(load_migration_state, migration.name)
+    if state.get("finished") and not restart:
+        return state
+
+    cursor_user = state.get("cursor_user")
+    cursor_story = state.get("cursor_story")
+    state = {
+        "processed": state.get("processed", 0),
+        "written": state.get("written", 0),
+        "started": state.get("started") or int(time.time()),
+        "finished": False,
+    }
+    run_started = time.monotonic()
+    run_processed = 0
+    root_ref = db.reference("/")
+    pending = {}
+    pending_bytes = 0
+    last_position = (cursor_user, cursor_story)
+
+    async def flush(finished: bool = False):
+        nonlocal pending, pending_bytes
+        state["cursor_user"], state["cursor_story"] = last_position
+        state["updated"] = int(time.time())
+        state["finished"] = finished
+        elapsed = time.monotonic() - run_started
+        state["rate"] = round(run_processed / elapsed, 1) if elapsed > 0 else 0.0
+        pending[state_path] = dict(state)
+        await db_call(root_ref.update, pending)
+        pending = {}
+        pending_bytes = 0
+        if report:
+            await report(dict(state))
+
+    # RTDB не умеет shallow-запрос со сдвигом, поэтому ключи пользователей берутся
+    # одним shallow-чтением (только ключи), а уже пройденные отсекаются по курсору
+    user_keys = sorted(await db_call(shallow_keys, "users_story"))
+    if cursor_user is not None:
+        user_keys = [uid for uid in user_keys if uid >= cursor_user]
+
+    for user_id in user_keys:
+        story_keys = await db_call(db.reference(f"users_story/{user_id}").get, shallow=True)
+        if not isinstance(story_keys, dict):
+            continue
+        # Вложенные узлы (истории) в shallow-ответе приходят как True, служебные поля — значением
+        story_ids = sorted(key for key, value in story_keys.items() if value is True)
+        if user_id == cursor_user and cursor_story is not None:
+            story_ids = [sid for sid in story_ids if sid > cursor_story]
+
+        for story_id in story_ids:
+            if migration.migrate_story:
+                written = await db_call(migration.migrate_story, str(user_id), story_id)
+                state["written"] += written or 0
+                state["processed"] += 1
+                run_processed += 1
+                last_position = (user_id, story_id)
+                # Курсор сохраняется каждые MIGRATION_BATCH_PATHS историй
+                if run_processed % MIGRATION_BATCH_PATHS == 0:
+                    await flush()
+                continue
+
+            story = None
+            if migration.needs_story:
+                story = await db_call(read_story, user_id, story_id)
+                if not isinstance(story, dict):
+                    continue
+            updates = migration.transform(str(user_id), story_id, story) or {}
+            updates_bytes = _update_size(updates)
+            # Пачка уходит раньше, чем превысит лимит; история крупнее лимита пишется отдельным запросом
+            if pending and pending_bytes + updates_bytes > MIGRATION_BATCH_BYTES:
+                await flush()
+            pending.update(updates)
+            pending_bytes += updates_bytes
+            state["written"] += len(updates)
+            state["processed"] += 1
+            run_processed += 1
+            last_position = (user_id, story_id)
+            if len(pending) >= MIGRATION_BATCH_PATHS or pending_bytes >= MIGRATION_BATCH_BYTES:
+                await flush()
+
+    await flush(finished=True)
+    if migration.finish:
+        migration.finish()
+    logger.info(
+        f"Миграция {migration.name} завершена: историй {state['processed']}, путей {state['written']}"
+    )
+    return state
+
@@ -43,19 +43,35 @@ import os
 import random
 import re
 import tempfile
+import threading
 import time
 from asyncio import create_task, sleep
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 
 import datetime
 from io import BytesIO
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Set, Tuple
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Set, Tuple
 import uuid
 from uuid import uuid4
 
 import firebase_admin
-from firebase_admin import credentials, db
+import firebase_admin.exceptions  # FirebaseError в except: сам firebase_admin подмодуль не импортирует
+from storage import db, init_storage, query_children, shallow_keys
+
+from story_cache import get_by_path, set_by_path, story_cache
+from story_template import (
+    render_template, render_timed_edits, resume_timed_edits, template_cache, timed_edit_cache, timed_edit_plan, timed_template_cache
+)
+from story_blocks import (
+    BLOCKS_FIELD, COMPRESSED_MODE, FRAGMENTS_ROOT, SHARDED_MODE,
+    decode_block, encode_block, fragment_branch, pack_fragments, read_story, unpack_story,
+)
+from db_gateway import db_call, db_gateway
+from edit_scheduler import edit_scheduler, scheduled_edit
+from timer_wheel import fragment_timers
+from json_stream import JsonStreamReader, JsonStreamWriter
+from migrations import MIGRATIONS, Migration, load_migration_state, register_migration, run_migration
 
 
 import networkx as nx
@@ -96,18 +112,6 @@ BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 
 if not BOT_TOKEN:
     raise RuntimeError("TELEGRAM_BOT_TOKEN не задан в переменных окружения")
-def init_firebase():
-    """
-    Инициализирует приложение Firebase, если оно еще не было инициализировано.
-    """
-    try:
-        firebase_admin.get_app()
-    except ValueError:
-        cred = credentials.Certificate('/etc/secrets/firebase-key.json')
-        firebase_admin.initialize_app(cred, {
-            'databaseURL': 'https://otlzhka-default-rtdb.europe-west1.firebasedatabase.app/'
-        })
-
 # Состояния для ConversationHandler (создание истории)
 # Существующие состояния + новое
 ASK_TITLE, ADD_CONTENT, ASK_CONTINUE_TEXT, ASK_BRANCH_TEXT, EDIT_STORY_MAP, \
@@ -168,52 +172,150 @@ def ensure_global_user_secret(user_id: str):
     except Exception as e:
         logger.error(f"Ошибка при проверке глобального secret_key для {user_id}: {e}")
 
-async def delete_inline_stories(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != ADMIN_USER_ID:
-        await update.message.reply_text("У вас нет прав на выполнение этой команды.")
-        return
+# Плановая очистка story_settings от старых инлайн-запусков.
+# В правилах базы для story_settings нужен ".indexOn": ["launch_ts"]
+STORY_SETTINGS_TTL_DAYS = float(os.environ.get("STORY_SETTINGS_TTL_DAYS", 14))
+STORY_SETTINGS_SWEEP_INTERVAL = int(os.environ.get("STORY_SETTINGS_SWEEP_INTERVAL", 3600))  # секунды
+STORY_SETTINGS_SWEEP_BATCH = 200  # Записей за один запрос и один multi-location update
+# Записей без launch_ts за один запрос: они приходят целиком (с прогрессом и голосами), поэтому пачка меньше
+STORY_SETTINGS_LEGACY_BATCH = 100
+
+# Итоги последнего прогона очистки (для /delete и логов)
+STORY_SETTINGS_SWEEP_STATS = {"runs": 0, "last_run": None, "last_deleted": 0, "total_deleted": 0}
+
 
+def parse_launch_ts(launch_info) -> int | None:
+    """Переводит launch_time (iso_timestamp_utc) в эпоху в секундах; None, если времени нет или оно некорректно."""
+    timestamp_str = launch_info.get("iso_timestamp_utc") if isinstance(launch_info, dict) else None
     try:
-        
-        ref = db.reference('story_settings')
-        all_stories = ref.get()
+        launch_time = datetime.datetime.fromisoformat(timestamp_str)
+        if launch_time.tzinfo is None:
+            launch_time = launch_time.replace(tzinfo=datetime.timezone.utc)
+        return int(launch_time.timestamp())
+    except (TypeError, ValueError):
+        return None
 
-        if not all_stories:
-            await update.message.reply_text("Нет активных историй для удаления.")
-            return
 
-        now = datetime.datetime.now(timezone.utc)
-        deleted_count = 0
+def launch_ts_from_launch_time(launch_info) -> int:
+    """Как parse_launch_ts, но без корректного launch_time — текущее время."""
+    launch_ts = parse_launch_ts(launch_info)
+    return launch_ts if launch_ts is not None else int(time.time())
 
-        for inline_message_id, story_data in all_stories.items():
-            launch_info = story_data.get("launch_time")
-            
-            # Удаляем истории без ключа launch_time или без iso_timestamp_utc
-            if not launch_info or "iso_timestamp_utc" not in launch_info:
-                logger.info(f"Удаление истории {inline_message_id}: отсутствует launch_time или iso_timestamp_utc")
-                db.reference(f'story_settings/{inline_message_id}').delete()
-                deleted_count += 1
-                continue
 
-            # Пытаемся разобрать timestamp
-            timestamp_str = launch_info.get("iso_timestamp_utc")
-            try:
-                launch_time = datetime.datetime.fromisoformat(timestamp_str)
-                if launch_time.tzinfo is None:
-                    launch_time = launch_time.replace(tzinfo=timezone.utc)
-            except Exception as e:
-                logger.warning(f"Некорректный формат времени для {inline_message_id}: {e}, запись будет удалена.")
-                db.reference(f'story_settings/{inline_message_id}').delete()
-                deleted_count += 1
-                continue
+def sweep_stale_story_settings(cutoff_ts: int) -> dict:
+    """
+    Удаляет записи story_settings с launch_ts <= cutoff_ts.
+    Записи выбираются индексированным запросом пачками по STORY_SETTINGS_SWEEP_BATCH
+    и удаляются одним multi-location update на пачку. Узлы без launch_ts
+    (прогресс по историям, старые запуски) запрос не затрагивает.
+    Возвращает {"deleted": ..., "batches": ...}.
+    """
+    deleted = 0
+    batches = 0
+    root_ref = db.reference('/')
+    while True:
+        stale = query_children(
+            'story_settings', 'launch_ts',
+            start_at=0, end_at=cutoff_ts, limit_to_first=STORY_SETTINGS_SWEEP_BATCH
+        )
+        if not stale:
+            break
+        root_ref.update({f'story_settings/{key}': None for key in stale})
+        deleted += len(stale)
+        batches += 1
+        if len(stale) < STORY_SETTINGS_SWEEP_BATCH:
+            break
+    return {"deleted": deleted, "batches": batches}
 
-            # Проверяем, устарела ли история
-            if now - launch_time >= timedelta(weeks=2):
-                logger.info(f"Удаление истории {inline_message_id}, дата запуска: {timestamp_str}")
-                db.reference(f'story_settings/{inline_message_id}').delete()
-                deleted_count += 1
 
-        await update.message.reply_text(f"Удалено устаревших или некорректных историй: {deleted_count}")
+def sweep_legacy_story_settings(cutoff_ts: int) -> dict:
+    """
+    Разбирает записи story_settings без launch_ts (созданные до его появления),
+    которых не видит плановая очистка. В порядке индекса launch_ts такие записи
+    идут первыми (null раньше чисел), поэтому они выбираются тем же индексом
+    пачками по STORY_SETTINGS_LEGACY_BATCH. Записи без корректного launch_time
+    и запущенные не позже cutoff_ts удаляются, остальным дописывается launch_ts —
+    дальше их удалит плановая очистка. Каждая пачка — один multi-location update,
+    и следующий запрос уже не видит разобранных записей.
+    Возвращает {"deleted": ..., "backfilled": ...}.
+    """
+    deleted = 0
+    backfilled = 0
+    root_ref = db.reference('/')
+    while True:
+        entries = query_children('story_settings', 'launch_ts', limit_to_first=STORY_SETTINGS_LEGACY_BATCH)
+        legacy = {
+            key: value for key, value in entries.items()
+            if not isinstance(value, dict) or value.get("launch_ts") is None
+        }
+        if not legacy:
+            break
+        updates = {}
+        for key, value in legacy.items():
+            launch_ts = parse_launch_ts(value.get("launch_time") if isinstance(value, dict) else None)
+            if launch_ts is None or launch_ts <= cutoff_ts:
+                updates[f'story_settings/{key}'] = None
+                deleted += 1
+            else:
+                updates[f'story_settings/{key}/launch_ts'] = launch_ts
+                backfilled += 1
+        root_ref.update(updates)
+        # Пачка дошла до записей с launch_ts — записей без него больше нет
+        if len(legacy) < len(entries) or len(entries) < STORY_SETTINGS_LEGACY_BATCH:
+            break
+    return {"deleted": deleted, "backfilled": backfilled}
+
+
+async def run_story_settings_sweep() -> dict:
+    cutoff_ts = int(time.time() - STORY_SETTINGS_TTL_DAYS * 86400)
+    result = await db_call(sweep_stale_story_settings, cutoff_ts)
+    STORY_SETTINGS_SWEEP_STATS["runs"] += 1
+    STORY_SETTINGS_SWEEP_STATS["last_run"] = datetime.datetime.now(ZoneInfo("Europe/Moscow")).strftime("%d.%m.%Y %H:%M")
+    STORY_SETTINGS_SWEEP_STATS["last_deleted"] = result["deleted"]
+    STORY_SETTINGS_SWEEP_STATS["total_deleted"] += result["deleted"]
+    logger.info(
+        f"Очистка story_settings: удалено {result['deleted']} записей старше "
+        f"{STORY_SETTINGS_TTL_DAYS:g} дн. за {result['batches']} пачек"
+    )
+    return result
+
+
+async def story_settings_sweep_job(context: ContextTypes.DEFAULT_TYPE):
+    """Задача JobQueue: периодически удаляет устаревшие инлайн-запуски."""
+    try:
+        await run_story_settings_sweep()
+    except Exception as e:
+        logger.error(f"Ошибка плановой очистки story_settings: {e}")
+
+
+async def delete_inline_stories(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Админ-команда: запускает очистку story_settings немедленно.
+    Сначала удаляет записи по индексу launch_ts, затем разбирает старые записи
+    без launch_ts (см. sweep_legacy_story_settings).
+    """
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("У вас нет прав на выполнение этой команды.")
+        return
+
+    try:
+        sweep_result = await run_story_settings_sweep()
+
+        cutoff_ts = int(time.time() - STORY_SETTINGS_TTL_DAYS * 86400)
+        legacy_result = await db_call(sweep_legacy_story_settings, cutoff_ts)
+        logger.info(
+            f"Записи story_settings без launch_ts: удалено {legacy_result['deleted']}, "
+            f"launch_ts дописан {legacy_result['backfilled']}"
+        )
+
+        stats = STORY_SETTINGS_SWEEP_STATS
+        await update.message.reply_text(
+            f"Удалено по launch_ts: {sweep_result['deleted']} (пачек: {sweep_result['batches']})\n"
+            f"Удалено устаревших или некорректных историй без launch_ts: {legacy_result['deleted']}\n"
+            f"Дописан launch_ts: {legacy_result['backfilled']}\n"
+            f"Плановая очистка: прогонов {stats['runs']}, всего удалено {stats['total_deleted']}, "
+            f"последний прогон {stats['last_run']}"
+        )
 
     except Exception as e:
         logger.error(f"Ошибка при удалении историй: {e}")
@@ -409,38 +511,168 @@ def convert_choices_in_story(data):
             convert_choices_in_story(item)
     return data
 
+ADMIN_IMPORT_BATCH_SIZE = 100  # Записей users_story на один multi-location update при загрузке дампа
+
+
+def _story_import_updates(user_id: str, story_id: str, value) -> dict:
+    """Пути multi-location update для одной записи users_story/{user_id}/{story_id} из дампа."""
+    updates = {f"users_story/{user_id}/{story_id}": value}
+    if isinstance(value, dict):
+        updates[f"stories_index/{story_id}/owner_id"] = user_id
+        updates[f"stories_index/{story_id}/updated"] = int(time.time())
+        updates[f"stories_index/{story_id}/version"] = {".sv": {"increment": 1}}
+        updates[f"story_meta/{user_id}/{story_id}"] = build_story_meta(value)
+    return updates
+
+
+def stream_convert_dump(
+    src_path,
+    dst_path,
+    push: bool = False,
+    import_id: str = None,
+    skip: int = 0,
+    on_batch=None,
+) -> dict:
+    """
+    Потоково конвертирует дамп базы: src_path читается по одной записи, результат
+    пишется компактным JSON в dst_path. Ко всем значениям применяется
+    convert_choices_in_story, историям в users_story проставляется owner_id.
+    Повторяющиеся story_id ищутся по словарю story_id -> первый владелец.
+
+    При push=True записи users_story (вместе со stories_index и story_meta)
+    отправляются в базу пачками по ADMIN_IMPORT_BATCH_SIZE; в той же записи
+    обновляется admin_imports/{import_id}/done, поэтому прерванную загрузку можно
+    продолжить, передав skip=done. on_batch(done) вызывается после каждой пачки.
+    """
+    story_owners = {}
+    duplicates = defaultdict(list)
+    stats = {"users": 0, "stories": 0, "pushed": 0, "skipped": 0}
+    root_ref = db.reference('/')
+    pending = {}
+    pending_count = 0
+    position = 0
+
+    def flush(finished: bool = False):
+        nonlocal pending, pending_count
+        if not push or (not pending and not finished):
+            return
+        pending[f"admin_imports/{import_id}/done"] = position
+        pending[f"admin_imports/{import_id}/updated"] = int(time.time())
+        if finished:
+            pending[f"admin_imports/{import_id}/finished"] = True
+        root_ref.update(pending)
+        stats["pushed"] += pending_count
+        pending = {}
+        pending_count = 0
+        if on_batch:
+            on_batch(position)
+
+    with open(src_path, 'r', encoding='utf-8') as src, open(dst_path, 'w', encoding='utf-8') as dst:
+        reader = JsonStreamReader(src)
+        writer = JsonStreamWriter(dst)
+        reader.begin_object()
+        writer.begin_object()
+
+        while (top_key := reader.next_key()) is not None:
+            writer.key(top_key)
+            if reader.peek() != "{":
+                writer.value(convert_choices_in_story(reader.read_value()))
+                continue
+
+            reader.begin_object()
+            writer.begin_object()
+            while (child_key := reader.next_key()) is not None:
+                writer.key(child_key)
+                if top_key != "users_story" or reader.peek() != "{":
+                    writer.value(convert_choices_in_story(reader.read_value()))
+                    continue
+
+                # users_story/{user_id}: истории читаются и пишутся по одной
+                user_id = str(child_key)
+                stats["users"] += 1
+                reader.begin_object()
+                writer.begin_object()
+                while (story_id := reader.next_key()) is not None:
+                    value = convert_choices_in_story(reader.read_value())
+                    if isinstance(value, dict):
+                        value["owner_id"] = user_id
+                        stats["stories"] += 1
+                        first_owner = story_owners.setdefault(story_id, user_id)
+                        if first_owner != user_id:
+                            if not duplicates[story_id]:
+                                duplicates[story_id].append(first_owner)
+                            duplicates[story_id].append(user_id)
+                    writer.key(story_id)
+                    writer.value(value)
+
+                    position += 1
+                    if push:
+                        if position <= skip:
+                            stats["skipped"] += 1
+                            continue
+                        pending.update(_story_import_updates(user_id, story_id, value))
+                        pending_count += 1
+                        story_cache.invalidate(story_id)
+                        if pending_count >= ADMIN_IMPORT_BATCH_SIZE:
+                            flush()
+                writer.end_object()
+            writer.end_object()
+        writer.end_object()
+
+    flush(finished=True)
+    stats["duplicates"] = dict(duplicates)
+    return stats
+
+
 async def handle_admin_json_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Принимает JSON-дамп и конвертирует его потоково (stream_convert_dump).
+    С подписью «push» у файла записи users_story ещё и загружаются в базу;
+    повторная отправка того же файла продолжает загрузку с места остановки.
+    """
     document = update.message.document
     if not document or not document.file_name.endswith('.json'):
         await update.message.reply_text("Это не JSON-файл. Пожалуйста, отправьте корректный файл.")
         return ADMIN_UPLOAD
 
+    push = (update.message.caption or "").strip().lower() == "push"
+    if push and update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("У вас нет прав на выполнение этой команды.")
+        return ADMIN_UPLOAD
+
     file = await document.get_file()
     tmp_dir = Path(tempfile.gettempdir())
     file_path = tmp_dir / f"{file.file_id}.json"
+    converted_path = tmp_dir / f"converted_{file.file_id}.json"
 
     await file.download_to_drive(str(file_path))
 
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-
-        # --- Добавить owner_id ко всем историям ---
-        users_story = data.get("users_story", {})
-        for user_id, stories in users_story.items():
-            for story_id, story_data in stories.items():
-                if isinstance(story_data, dict):
-                    story_data["owner_id"] = user_id
+        import_id = document.file_unique_id
+        skip = 0
+        if push:
+            progress = await db_call(db.reference(f"admin_imports/{import_id}").get) or {}
+            if progress.get("finished"):
+                await update.message.reply_text("Этот файл уже полностью загружен в базу.")
+                return ConversationHandler.END
+            skip = int(progress.get("done", 0))
+
+        status_message = await update.message.reply_text(
+            f"⏳ Обработка дампа{f', продолжаем с записи {skip + 1}' if skip else ''}..."
+        )
+        loop = asyncio.get_running_loop()
 
-        # --- Найти повторяющиеся story_id в users_story ---
-        story_to_users = defaultdict(list)
-        for user_id, stories in users_story.items():
-            for story_id in stories:
-                story_to_users[story_id].append(user_id)
+        def on_batch(done: int):
+            asyncio.run_coroutine_threadsafe(
+                status_message.edit_text(f"⏳ Загружено записей users_story: {done}"), loop
+            )
 
-        repeated_stories = {sid: uids for sid, uids in story_to_users.items() if len(uids) > 1}
+        # Разбор большого файла — долгий блокирующий I/O, выполняем вне event loop
+        result = await asyncio.to_thread(
+            stream_convert_dump, file_path, converted_path, push, import_id, skip, on_batch
+        )
 
-        html_result = ""
+        repeated_stories = result["duplicates"]
         if repeated_stories:
             html_result = "<b>Повторяющиеся story_id в users_story:</b>\n\n"
             for sid, user_ids in repeated_stories.items():
@@ -448,12 +680,12 @@ async def handle_admin_json_file(update: Update, context: ContextTypes.DEFAULT_T
         else:
             html_result = "Повторяющихся story_id не найдено."
 
-        # --- Преобразовать choices (ваша логика) ---
-        converted_data = convert_choices_in_story(data)
-
-        converted_path = tmp_dir / f"converted_{file.file_id}.json"
-        with open(converted_path, 'w', encoding='utf-8') as f:
-            json.dump(converted_data, f, ensure_ascii=False, indent=2)
+        html_result += f"\n\nПользователей: {result['users']} | Историй: {result['stories']}"
+        if push:
+            html_result += (
+                f"\nЗагружено в базу: {result['pushed']} (пропущено как уже загруженные: {result['skipped']})"
+                "\nСписки соавторов и публичный каталог пересобираются командой /rebuildmeta."
+            )
 
         with open(converted_path, 'rb') as f:
             await update.message.reply_document(
@@ -468,6 +700,9 @@ async def handle_admin_json_file(update: Update, context: ContextTypes.DEFAULT_T
     except Exception as e:
         await update.message.reply_text(f"Ошибка при обработке: {e}")
         return ADMIN_UPLOAD
+    finally:
+        for path in (file_path, converted_path):
+            path.unlink(missing_ok=True)
 
 def get_faq_tree_data():
     """Получает структуру дерева FAQ (в виде JSON-строки) из БД."""
@@ -580,14 +815,14 @@ def clone_tutorial_logic(user_id, tutorial_id):
         new_story_id = uuid.uuid4().hex[:10]
 
         # 3. КОПИРОВАНИЕ ДАННЫХ ИСТОРИИ (users_story)
-        src_story_ref = db.reference(f'users_story/{source_owner}/{source_story_id}')
-        story_content = src_story_ref.get()
+        story_content = read_story(source_owner, source_story_id)
         
         if not story_content:
             return False, "Source story data missing"
 
-        # Очищаем и обновляем метаданные
+        # Очищаем и обновляем метаданные; копия хранится в обычном режиме (фрагменты внутри истории)
         story_content_copy = copy.deepcopy(story_content)
+        story_content_copy.pop('storage_mode', None)
         story_content_copy['owner_id'] = user_id
         story_content_copy['title'] = f"[Обучение] {tut_data.get('title', 'History')}"
         story_content_copy.pop('secret_key', None) # Удаляем старый ключ
@@ -600,6 +835,7 @@ def clone_tutorial_logic(user_id, tutorial_id):
             "owner_id": user_id,
             "updated": int(time.time())
         })
+        db.reference(f'story_meta/{user_id}/{new_story_id}').set(build_story_meta(story_content_copy))
 
         # 4. КОПИРОВАНИЕ КАРТЫ (story_maps)
         src_map_ref = db.reference(f'story_maps/{source_owner}/{source_story_id}')
@@ -1166,36 +1402,54 @@ def ensure_assets_exist(user_id, story_id, story_data, export_data):
 from zoneinfo import ZoneInfo
 ITEMS_PER_PAGE = 15
 
-def get_next_save_slot(user_id: int) -> int:
-    """Находит ближайший свободный слот для сохранения, начиная с 1."""
-    try:
-        ref = db.reference(f'user_saves/{user_id}')
-        saves = ref.get()
-        if not saves:
-            return 1
-        
-        # saves может быть списком (если ключи 0,1,2...) или словарем
-        if isinstance(saves, list):
-            existing_ids = {i for i, _ in enumerate(saves) if _ is not None}
-        else:
-            existing_ids = {int(k) for k in saves.keys()}
-            
-        slot = 1
-        while slot in existing_ids:
-            slot += 1
-        return slot
-    except Exception as e:
-        logger.error(f"Ошибка при поиске слота сохранения: {e}")
-        return 1
+# Поля сохранения, которые дублируются в user_saves_meta для меню загрузки
+SAVE_META_FIELDS = ("title", "timestamp", "type", "story_id")
+# Поля сводки, по которым сортирует меню загрузки (None — по номеру слота)
+SAVE_MENU_SORT_FIELDS = {"id": None, "title": "title_key", "time": "timestamp"}
 
 
+def build_save_meta(save: dict) -> dict:
+    """Сводка сохранения для user_saves_meta."""
+    meta = {field: save[field] for field in SAVE_META_FIELDS if field in save}
+    # order_by_child сравнивает строки с учётом регистра, поэтому для сортировки хранится нижний регистр
+    meta["title_key"] = str(save.get("title", "Unknown")).lower()
+    return meta
 
 
+def _slots_as_dict(data) -> dict:
+    """user_saves с ключами 1, 2, 3... RTDB может вернуть списком — приводим к {slot_id: value}."""
+    if isinstance(data, list):
+        return {str(i): value for i, value in enumerate(data) if value is not None}
+    return data if isinstance(data, dict) else {}
+
+
+def allocate_save_slot(user_id: int) -> int:
+    """
+    Выдаёт номер нового слота через транзакцию на счётчике user_saves_counter/{user_id},
+    поэтому одновременные сохранения (например, два чекпоинта подряд) не получат один слот.
+    Если счётчика ещё нет, он начинается после самого большого из уже занятых слотов:
+    их номера читаются до транзакции, потому что колбэк может выполняться повторно
+    и не должен обращаться к базе. Освобождённые номера повторно не выдаются.
+    """
+    counter_ref = db.reference(f'user_saves_counter/{user_id}')
+    last_existing = 0
+    current = counter_ref.get()
+    if not isinstance(current, int) or current <= 0:
+        existing_ids = [int(k) for k in shallow_keys(f'user_saves/{user_id}') if k.isdigit()]
+        last_existing = max(existing_ids, default=0)
+
+    def increment(current):
+        if isinstance(current, int) and current > 0:
+            return current + 1
+        return last_existing + 1
+
+    return counter_ref.transaction(increment)
 
 
 def perform_save(user_id: int, story_id: str, save_type: str, owner_id: str, story_title: str):
     """
     Создает слепок состояния из story_settings и сохраняет в user_saves.
+    Сводка сохранения (SAVE_META_FIELDS) пишется в user_saves_meta тем же update.
     save_type: 'manual' или 'checkpoint'
     """
     try:
@@ -1208,8 +1462,8 @@ def perform_save(user_id: int, story_id: str, save_type: str, owner_id: str, sto
             logger.warning(f"Нечего сохранять для {user_id} в истории {story_id}")
             return False
 
-        # 2. Определяем номер слота
-        slot_id = get_next_save_slot(user_id)
+        # 2. Получаем номер слота
+        slot_id = allocate_save_slot(user_id)
 
         # 3. Формируем данные сохранения
         current_time = datetime.datetime.now(ZoneInfo("Europe/Moscow")).strftime("%d.%m.%Y %H:%M")
@@ -1221,32 +1475,267 @@ def perform_save(user_id: int, story_id: str, save_type: str, owner_id: str, sto
             "story_id": str(story_id), # Важно сохранить ID истории, чтобы знать, что загружать
             "type": save_type,
             "timestamp": current_time,
-            "data": progress_data # Сам слепок
         }
+        updates = {}
+        seq = None
+
+        if save_type == "checkpoint":
+            # Слепок уходит в кольцо чекпоинтов, в слоте остаётся только ссылка на него
+            seq, evicted_slots = push_checkpoint(user_id, story_id, slot_id, progress_data)
+            save_data["checkpoint_seq"] = seq
+            updates.update(evicted_slot_updates(user_id, evicted_slots))
+        else:
+            save_data["data"] = progress_data # Сам слепок
 
-        # 4. Сохраняем
-        save_ref = db.reference(f'user_saves/{user_id}/{slot_id}')
-        save_ref.set(save_data)
+        # 4. Сохраняем слот и его сводку одной записью
+        updates[f'user_saves/{user_id}/{slot_id}'] = save_data
+        updates[f'user_saves_meta/{user_id}/{slot_id}'] = build_save_meta(save_data)
+        try:
+            db.reference('/').update(updates)
+        except Exception:
+            if seq is not None:
+                rollback_checkpoint(user_id, story_id, seq, evicted_slots)
+            raise
         logger.info(f"Сохранение {slot_id} ({save_type}) создано для пользователя {user_id}")
         return True
     except Exception as e:
         logger.error(f"Ошибка при создании сохранения: {e}")
         return False
 
-def get_user_saves(user_id: int):
-    """Получает все сохранения пользователя."""
+
+# Сколько чекпоинтов хранится на пару (пользователь, история); старые вытесняются
+CHECKPOINT_RING_SIZE = max(1, int(os.environ.get("CHECKPOINT_RING_SIZE", 5)))
+
+
+def _checkpoint_effects_delta(old: dict, new: dict) -> tuple[dict, list]:
+    """Разница атрибутов между двумя чекпоинтами: (изменённые значения, удалённые атрибуты)."""
+    changed = {stat: value for stat, value in new.items() if old.get(stat) != value}
+    removed = [stat for stat in old if stat not in new]
+    return changed, removed
+
+
+def _materialize_checkpoint_effects(entries: list, seq: int) -> dict | None:
+    """
+    Восстанавливает атрибуты чекпоинта seq по записям кольца, упорядоченным по seq:
+    от ближайшего опорного (keyframe) применяются дельты до нужной записи.
+    """
+    effects = None
+    for entry in entries:
+        if entry.get("keyframe"):
+            effects = dict(entry.get("effects") or {})
+        elif effects is not None:
+            effects.update(entry.get("changed") or {})
+            for stat in entry.get("removed") or []:
+                effects.pop(stat, None)
+        if entry.get("seq") == seq:
+            return effects
+    return None
+
+
+def _ring_entries(ring) -> list:
+    entries = (ring or {}).get("entries") if isinstance(ring, dict) else None
+    if not isinstance(entries, dict):
+        return []
+    return sorted((e for e in entries.values() if isinstance(e, dict)), key=lambda e: e.get("seq", 0))
+
+
+def push_checkpoint(user_id: int, story_id: str, slot_id: int, progress_data: dict) -> tuple[int, list]:
+    """
+    Добавляет чекпоинт в кольцо user_checkpoints/{user_id}/{story_id} (транзакцией).
+    Первая запись кольца хранит атрибуты целиком, остальные — дельту к предыдущей.
+    Если записей стало больше CHECKPOINT_RING_SIZE, старейшие вытесняются, а новая
+    старейшая запись становится опорной. Возвращает (seq, слоты вытесненных чекпоинтов).
+    """
+    effects = dict(progress_data.get("current_effects") or {})
+    extra = {k: v for k, v in progress_data.items() if k not in ("current_effects", "fragment_id")}
+    evicted_slots = []
+
+    def push(ring):
+        evicted_slots.clear()
+        entries = _ring_entries(ring)
+        seq = (ring.get("seq", 0) if isinstance(ring, dict) else 0) + 1
+
+        entry = {"seq": seq, "slot_id": slot_id, "fragment_id": progress_data.get("fragment_id")}
+        if extra:
+            entry["extra"] = extra
+        previous = _materialize_checkpoint_effects(entries, entries[-1]["seq"]) if entries else None
+        if previous is None:
+            entry.update({"keyframe": True, "effects": effects})
+        else:
+            entry["changed"], entry["removed"] = _checkpoint_effects_delta(previous, effects)
+        entries.append(entry)
+
+        if len(entries) > CHECKPOINT_RING_SIZE:
+            drop = len(entries) - CHECKPOINT_RING_SIZE
+            new_oldest = entries[drop]
+            keyframe_effects = _materialize_checkpoint_effects(entries, new_oldest["seq"])
+            evicted_slots.extend(e.get("slot_id") for e in entries[:drop] if e.get("slot_id") is not None)
+            entries = entries[drop:]
+            for key in ("changed", "removed"):
+                new_oldest.pop(key, None)
+            new_oldest.update({"keyframe": True, "effects": keyframe_effects or {}})
+
+        return {"seq": seq, "entries": {f"c{e['seq']}": e for e in entries}}
+
+    ring = db.reference(f'user_checkpoints/{user_id}/{story_id}').transaction(push)
+    return ring["seq"], list(evicted_slots)
+
+
+def evicted_slot_updates(user_id: int, slot_ids) -> dict:
+    """Пути multi-location update, удаляющие слоты вытесненных чекпоинтов и их сводки."""
+    updates = {}
+    for slot_id in slot_ids:
+        updates[f'user_saves/{user_id}/{slot_id}'] = None
+        updates[f'user_saves_meta/{user_id}/{slot_id}'] = None
+    return updates
+
+
+def rollback_checkpoint(user_id: int, story_id: str, seq: int, evicted_slots: list) -> None:
+    """
+    Откатывает push_checkpoint, если слот чекпоинта записать не удалось: запись seq
+    убирается из кольца (следующая за ней дельта, если её успели добавить, становится
+    опорной), чтобы кольцо не ссылалось на несуществующий слот и следующее вытеснение
+    не удаляло его. Записей вытесненных чекпоинтов в кольце уже нет, поэтому их слоты
+    удаляются отдельно.
+    """
+    def drop(ring):
+        entries = _ring_entries(ring)
+        index = next((i for i, e in enumerate(entries) if e.get("seq") == seq), None)
+        if index is None:
+            return ring
+        if index + 1 < len(entries) and not entries[index + 1].get("keyframe"):
+            successor = entries[index + 1]
+            successor_effects = _materialize_checkpoint_effects(entries, successor["seq"])
+            for key in ("changed", "removed"):
+                successor.pop(key, None)
+            successor.update({"keyframe": True, "effects": successor_effects or {}})
+        del entries[index]
+        return {"seq": ring.get("seq", seq), "entries": {f"c{e['seq']}": e for e in entries}}
+
     try:
-        ref = db.reference(f'user_saves/{user_id}')
-        return ref.get()
+        db.reference(f'user_checkpoints/{user_id}/{story_id}').transaction(drop)
+        if evicted_slots:
+            db.reference('/').update(evicted_slot_updates(user_id, evicted_slots))
+    except Exception as e:
+        logger.error(f"Не удалось откатить чекпоинт {seq} пользователя {user_id} в истории {story_id}: {e}")
+
+
+def materialize_checkpoint(user_id: int, story_id: str, seq: int) -> dict | None:
+    """Собирает полный прогресс чекпоинта seq из кольца; None, если чекпоинт уже вытеснен."""
+    entries = _ring_entries(db.reference(f'user_checkpoints/{user_id}/{story_id}').get())
+    effects = _materialize_checkpoint_effects(entries, seq)
+    if effects is None:
+        return None
+    entry = next(e for e in entries if e.get("seq") == seq)
+    progress = dict(entry.get("extra") or {})
+    progress["current_effects"] = effects
+    progress["fragment_id"] = entry.get("fragment_id")
+    return progress
+
+
+def load_user_saves_meta(user_id: int) -> dict:
+    """
+    Возвращает {slot_id: сводка} для всех сохранений пользователя.
+    Читаются только shallow-ключи user_saves/{user_id} и узел user_saves_meta/{user_id}.
+    Сохранения без сводки (созданные до её появления) загружаются один раз целиком,
+    и сводка для них достраивается; сводки без title_key дополняются, сводки удалённых
+    сохранений убираются.
+    """
+    try:
+        slot_ids = [k for k in shallow_keys(f'user_saves/{user_id}') if k.isdigit()]
+        all_meta = _slots_as_dict(db.reference(f'user_saves_meta/{user_id}').get())
+
+        result = {}
+        repairs = {}
+        for slot_id in slot_ids:
+            meta = all_meta.get(slot_id)
+            if not isinstance(meta, dict):
+                save = db.reference(f'user_saves/{user_id}/{slot_id}').get()
+                if not isinstance(save, dict):
+                    continue
+                meta = build_save_meta(save)
+                repairs[f"user_saves_meta/{user_id}/{slot_id}"] = meta
+            elif "title_key" not in meta:
+                meta = build_save_meta(meta)
+                repairs[f"user_saves_meta/{user_id}/{slot_id}"] = meta
+            result[slot_id] = meta
+
+        for slot_id in set(all_meta) - set(slot_ids):
+            repairs[f"user_saves_meta/{user_id}/{slot_id}"] = None
+
+        if repairs:
+            db.reference('/').update(repairs)
+            logger.info(f"user_saves_meta/{user_id}: достроено/очищено записей: {len(repairs)}")
+
+        return result
     except Exception as e:
         logger.error(f"Ошибка получения сохранений: {e}")
         return {}
 
+
+def load_saves_page(user_id: int, settings: dict) -> tuple[list, int]:
+    """
+    Возвращает ([(save_id, сводка), ...], всего_сохранений) для текущей страницы меню загрузки.
+    Страница читается из компактных сводок user_saves_meta, слепки data не загружаются.
+    Число сохранений и номера слотов берутся shallow-запросом. При сортировке по номеру
+    загружаются ровно сводки страницы, при сортировке по полю — сводки до конца страницы
+    (порядок и лимит задаёт база). Если сводки не совпадают с сохранениями (сохранения
+    старше user_saves_meta), они один раз достраиваются (load_user_saves_meta).
+    Номер страницы в settings поправляется, если он вышел за границы.
+    """
+    meta_path = f'user_saves_meta/{user_id}'
+    try:
+        slot_ids = sorted((k for k in shallow_keys(f'user_saves/{user_id}') if k.isdigit()), key=int)
+        if set(slot_ids) != set(shallow_keys(meta_path)):
+            load_user_saves_meta(user_id)
+    except Exception as e:
+        logger.error(f"Ошибка получения сохранений: {e}")
+        return [], 0
+
+    total_items = len(slot_ids)
+    if not total_items:
+        return [], 0
+
+    total_pages = math.ceil(total_items / ITEMS_PER_PAGE)
+    if settings['page'] >= total_pages:
+        settings['page'] = total_pages - 1
+    start_idx = settings['page'] * ITEMS_PER_PAGE
+    end_idx = start_idx + ITEMS_PER_PAGE
+    field = SAVE_MENU_SORT_FIELDS.get(settings['sort_by'], "timestamp")
+    reverse = settings['sort_rev']
+
+    try:
+        if field is None:
+            ordered_ids = slot_ids[::-1] if reverse else slot_ids
+            page_ids = ordered_ids[start_idx:end_idx]
+            first_id, last_id = min(page_ids, key=int), max(page_ids, key=int)
+            data = query_children(meta_path, start_at=first_id, end_at=last_id)
+            return [(s_id, data[s_id]) for s_id in page_ids if data.get(s_id)], total_items
+
+        if field == "title_key":
+            # Сводки без title_key (записанные до него) в порядке по этому полю идут первыми
+            oldest = query_children(meta_path, field, limit_to_first=1)
+            if any("title_key" not in meta for meta in oldest.values() if isinstance(meta, dict)):
+                load_user_saves_meta(user_id)
+
+        if reverse:
+            data = query_children(meta_path, field, limit_to_last=end_idx)
+            items = list(data.items())[::-1]
+        else:
+            data = query_children(meta_path, field, limit_to_first=end_idx)
+            items = list(data.items())
+        return [(s_id, meta) for s_id, meta in items[start_idx:end_idx] if meta], total_items
+    except Exception as e:
+        logger.error(f"Ошибка получения страницы сохранений: {e}")
+        return [], total_items
+
 def delete_user_save(user_id: int, save_id: str):
-    """Удаляет конкретное сохранение."""
+    """Удаляет конкретное сохранение вместе с его сводкой."""
     try:
-        ref = db.reference(f'user_saves/{user_id}/{save_id}')
-        ref.delete()
+        db.reference('/').update({
+            f'user_saves/{user_id}/{save_id}': None,
+            f'user_saves_meta/{user_id}/{save_id}': None,
+        })
         return True
     except Exception as e:
         logger.error(f"Ошибка удаления сохранения: {e}")
@@ -1255,6 +1744,7 @@ def delete_user_save(user_id: int, save_id: str):
 def load_save_to_settings(user_id: int, save_id: str):
     """
     Загружает данные из сохранения обратно в story_settings.
+    Для чекпоинтов прогресс собирается из кольца user_checkpoints (materialize_checkpoint).
     Возвращает кортеж (успех, owner_id, story_id, fragment_id).
     """
     try:
@@ -1262,12 +1752,15 @@ def load_save_to_settings(user_id: int, save_id: str):
         save_ref = db.reference(f'user_saves/{user_id}/{save_id}')
         save_snapshot = save_ref.get()
 
-        if not save_snapshot or 'data' not in save_snapshot:
+        if not save_snapshot:
             return False, None, None, None
 
         story_id = save_snapshot.get('story_id')
         owner_id = save_snapshot.get('owner_id')
         progress_data = save_snapshot.get('data')
+        if progress_data is None and 'checkpoint_seq' in save_snapshot and story_id:
+            # Чекпоинт хранится дельтой в кольце — собираем полный прогресс
+            progress_data = materialize_checkpoint(user_id, story_id, save_snapshot['checkpoint_seq'])
 
         if not story_id or not progress_data:
             return False, None, None, None
@@ -1302,11 +1795,11 @@ async def manual_save_callback(update: Update, context: ContextTypes.DEFAULT_TYP
     # Для надежности здесь сделаем быстрый запрос названия:
     try:
         story_ref = db.reference(f'users_story/{owner_id}/{story_id}/title')
-        story_title = story_ref.get() or "Без названия"
+        story_title = await db_call(story_ref.get) or "Без названия"
     except:
         story_title = "История"
 
-    success = perform_save(user_id, story_id, "Ручное", owner_id, story_title)
+    success = await db_call(perform_save, user_id, story_id, "Ручное", owner_id, story_title)
     
     if success:
         await query.answer("✅ Прогресс успешно сохранен!", show_alert=True)
@@ -1323,12 +1816,6 @@ async def load_menu_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     query = update.callback_query
     user_id = query.from_user.id
-    
-    saves = get_user_saves(user_id)
-    
-    if not saves:
-        await query.answer("У вас нет сохранений.", show_alert=True)
-        return
 
     # Инициализируем начальное состояние в user_data
     context.user_data['load_menu_settings'] = {
@@ -1337,8 +1824,14 @@ async def load_menu_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         'sort_rev': True     # По умолчанию новые сверху (True = убывание)
     }
 
+    page_items, total_items = await db_call(load_saves_page, user_id, context.user_data['load_menu_settings'])
+
+    if not total_items:
+        await query.answer("У вас нет сохранений.", show_alert=True)
+        return
+
     # Генерируем текст и клавиатуру
-    text, reply_markup = get_menu_content(saves, context.user_data['load_menu_settings'])
+    text, reply_markup = get_menu_content(page_items, total_items, context.user_data['load_menu_settings'])
     
     await query.edit_message_text(
         text=text,
@@ -1355,13 +1848,8 @@ async def load_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     data = query.data
     user_id = query.from_user.id
     
-    # Получаем настройки и список сохранений
+    # Получаем настройки меню
     settings = context.user_data.get('load_menu_settings', {'page': 0, 'sort_by': 'time', 'sort_rev': True})
-    saves = get_user_saves(user_id)
-    
-    if not saves:
-        await query.answer("Сохранения не найдены.", show_alert=True)
-        return
 
     # --- ЛОГИКА СОРТИРОВКИ ---
     if data.startswith('menu_sort_'):
@@ -1388,11 +1876,18 @@ async def load_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
         # (в данном примере просто уменьшаем/увеличиваем, перерисовка ограничит)
         settings['page'] += 1
 
+    # Загружаем только записи нужной страницы
+    page_items, total_items = await db_call(load_saves_page, user_id, settings)
+
+    if not total_items:
+        await query.answer("Сохранения не найдены.", show_alert=True)
+        return
+
     # Сохраняем обновленные настройки
     context.user_data['load_menu_settings'] = settings
     
     # Перерисовываем меню
-    text, reply_markup = get_menu_content(saves, settings)
+    text, reply_markup = get_menu_content(page_items, total_items, settings)
     
     # Чтобы не было ошибок "Message is not modified", оборачиваем в try
     try:
@@ -1405,50 +1900,25 @@ async def load_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
         pass # Игнорируем, если контент не изменился
     await query.answer()
 
-def get_menu_content(saves, settings):
+def get_menu_content(page_items, total_items, settings):
     """
     Вспомогательная функция. 
-    Превращает сырые данные и настройки в готовый текст и клавиатуру.
+    Превращает страницу сохранений (из load_saves_page) и настройки в готовый текст и клавиатуру.
     """
     # 1. Нормализация данных в список словарей
     save_list = []
-    iterator = enumerate(saves) if isinstance(saves, list) else saves.items()
-    for s_id, s_data in iterator:
-        if not s_data: continue
-        # Создаем копию и добавляем ID внутрь для удобства сортировки
-        item = s_data.copy()
+    for s_id, s_data in page_items:
+        # Создаем копию и добавляем ID внутрь для удобства отображения
+        item = dict(s_data)
         item['real_id'] = s_id
-        # Гарантируем наличие полей для сортировки
         item['title'] = item.get('title', 'Unknown')
         item['timestamp'] = item.get('timestamp', '')
         save_list.append(item)
 
-    # 2. Сортировка
-    key = settings['sort_by']
-    reverse = settings['sort_rev']
-    
-    if key == 'id':
-        save_list.sort(key=lambda x: str(x['real_id']), reverse=reverse)
-    elif key == 'title':
-        save_list.sort(key=lambda x: x['title'].lower(), reverse=reverse)
-    elif key == 'time':
-        # Тут предполагается, что timestamp - это строка, которую можно сортировать лексикографически (ISO)
-        # или timestamp (число). Если формат даты 'DD.MM.YYYY', сортировка будет некорректной без парсинга.
-        save_list.sort(key=lambda x: x['timestamp'], reverse=reverse)
-
-    # 3. Пагинация
-    total_items = len(save_list)
+    # 2. Пагинация (страница уже выбрана и поправлена в load_saves_page)
     total_pages = math.ceil(total_items / ITEMS_PER_PAGE)
-    
-    # Корректировка текущей страницы (чтобы не уйти за границы при удалении)
     current_page = settings['page']
-    if current_page >= total_pages:
-        current_page = max(0, total_pages - 1)
-        settings['page'] = current_page
-
-    start_idx = current_page * ITEMS_PER_PAGE
-    end_idx = start_idx + ITEMS_PER_PAGE
-    page_items = save_list[start_idx:end_idx]
+    page_items = save_list
 
     # 4. Сборка клавиатуры
     keyboard = []
@@ -1519,7 +1989,7 @@ async def delete_save_callback(update: Update, context: ContextTypes.DEFAULT_TYP
     user_id = query.from_user.id
     save_id = query.data.split('_')[2]
     
-    if delete_user_save(user_id, save_id):
+    if await db_call(delete_user_save, user_id, save_id):
         await query.answer("Сохранение удалено.")
         # Обновляем меню
         await load_menu_start(update, context)
@@ -1532,7 +2002,7 @@ async def load_game_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_id = query.from_user.id
     save_id = query.data.split('_')[2]
     
-    success, owner_id, story_id, fragment_id = load_save_to_settings(user_id, save_id)
+    success, owner_id, story_id, fragment_id = await db_call(load_save_to_settings, user_id, save_id)
     
     if success:
         # Формируем callback "Продолжить"
@@ -1627,67 +2097,20 @@ def load_story_settings(inline_message_id: str) -> dict:
         logger.error(f"Неожиданная ошибка при загрузке story_settings/{inline_message_id}: {e}")
         return {}
 
-def load_all_user_stories(user_id_str: str) -> dict:
-    """
-    Загружает все истории пользователя по user_id_str.
-    Фильтрует 'secret_key' и другие служебные поля, возвращая только словари историй.
-    """
-    try:
-        if not firebase_admin._DEFAULT_APP_NAME:
-            logger.error("Firebase приложение не инициализировано.")
-            return {}
-
-        ref = db.reference(f'users_story/{user_id_str}')
-        data = ref.get()
-
-        if data is not None and isinstance(data, dict):
-            # ЛАКОНИЧНОЕ РЕШЕНИЕ:
-            # Возвращаем только те элементы, значение которых — словарь (dict).
-            # Это автоматически уберет 'secret_key' (str) и любые другие будущие строковые поля.
-            return {k: v for k, v in data.items() if isinstance(v, dict)}
-        else:
-            logger.info(f"У пользователя {user_id_str} не найдено историй.")
-            return {}
-
-    except firebase_admin.exceptions.FirebaseError as e:
-        logger.error(f"Ошибка Firebase при загрузке историй пользователя {user_id_str}: {e}")
-        return {}
-    except Exception as e:
-        logger.error(f"Неожиданная ошибка при загрузке историй пользователя {user_id_str}: {e}")
-        return {}
-
 
 def load_all_coop_stories_with_user(user_id_str: str) -> dict:
     """
-    Загружает все истории всех пользователей, в которых user_id_str есть в списке coop_edit.
+    Возвращает истории, в которых user_id_str есть в списке coop_edit:
+        {story_id: {"owner_id": ..., "title": ...}}
+    Читается только обратный индекс coop_index/{user_id_str}, который ведёт save_story_patch.
     """
     try:
         if not firebase_admin._DEFAULT_APP_NAME:
             logger.error("Firebase приложение не инициализировано.")
             return {}
 
-        ref = db.reference('users_story')
-        all_users_data = ref.get()
-
-        if not all_users_data:
-            return {}
-
-        result = {}
-        for other_user_id, stories in all_users_data.items():
-            if not isinstance(stories, dict):
-                continue
-            
-            # --- ИСПРАВЛЕНИЕ ЗДЕСЬ ---
-            for story_id, story_data in stories.items():
-                # Пропускаем secret_key и любой мусор, который не является словарем истории
-                if not isinstance(story_data, dict):
-                    continue
-                    
-                coop_list = story_data.get("coop_edit", [])
-                if user_id_str in coop_list:
-                    result[story_id] = story_data
-
-        return result
+        entries = db.reference(f'coop_index/{user_id_str}').get() or {}
+        return {story_id: entry for story_id, entry in entries.items() if isinstance(entry, dict)}
 
     except firebase_admin.exceptions.FirebaseError as e:
         logger.error(f"Ошибка Firebase при загрузке coop-историй пользователя {user_id_str}: {e}")
@@ -1701,38 +2124,44 @@ def load_story_by_id_fallback(story_id: str) -> dict:
     """
     Загружает историю по её story_id, даже если пользователь не является её владельцем или coop-редактором.
     Используется для публичного или fallback-доступа (например, только для чтения).
+    Поиск идёт через stories_index (с самовосстановлением индекса), без выгрузки всего users_story.
     """
-    logger.info(f"История {story_id}.")    
-    try:
-        
-        if not firebase_admin._DEFAULT_APP_NAME:
-            logger.error("Firebase приложение не инициализировано.")
-            return {}
-
-        all_users_ref = db.reference('users_story')
-        all_stories = all_users_ref.get()
+    logger.info(f"История {story_id}.")
+    story_data = load_story_by_id(story_id)
+    if not story_data:
+        logger.info(f"История {story_id} не найдена ни у одного пользователя.")
+        return {}
+    return story_data
 
-        if not all_stories or not isinstance(all_stories, dict):
-            logger.warning("Не удалось загрузить список всех историй пользователей.")
-            return {}
 
-        for user_id, stories in all_stories.items():
-            if not isinstance(stories, dict):
-                continue
-            story_data = stories.get(story_id)
-            if story_data:
-                logger.info(f"История {story_id} найдена у пользователя {user_id} через fallback-доступ.")
-                return story_data
+STORAGE_MODE_RETRIES = 3  # Сколько раз перечитывать историю, если её правят во время смены режима
 
-        logger.info(f"История {story_id} не найдена ни у одного пользователя.")
-        return {}
 
-    except firebase_admin.exceptions.FirebaseError as e:
-        logger.error(f"Ошибка Firebase при fallback-загрузке истории {story_id}: {e}")
-        return {}
-    except Exception as e:
-        logger.error(f"Неожиданная ошибка при fallback-загрузке истории {story_id}: {e}")
-        return {}
+def set_story_storage_mode(owner_id: str, story_id: str, mode: str | None):
+    """
+    Переводит историю в режим хранения mode (COMPRESSED_MODE, SHARDED_MODE или None —
+    обычное дерево fragments). Фрагменты переписываются одной правкой save_story_patch,
+    поэтому версия, story_cache и журнал изменений остаются согласованными.
+    Версия читается до истории, и запись проверяет её: если историю успели изменить,
+    она перечитывается (до STORAGE_MODE_RETRIES раз), а не перезаписывается старой копией.
+    Возвращает результат save_story_patch, True, если режим уже такой,
+    None, если истории нет, и False, если запись не удалась.
+    """
+    for _ in range(STORAGE_MODE_RETRIES):
+        version = get_story_version(story_id)
+        story = read_story(owner_id, story_id)
+        if not isinstance(story, dict):
+            return None
+        if story.get("storage_mode") == mode:
+            return True
+        try:
+            return save_story_patch(
+                owner_id, story_id, {"storage_mode": mode, "fragments": story.get("fragments") or {}}, version
+            )
+        except StoryVersionConflict:
+            continue
+    logger.warning(f"История {story_id}: режим хранения не изменён, историю правят слишком часто.")
+    return False
 
 
 def load_user_story(user_id_str: str, story_id: str) -> dict:
@@ -1746,34 +2175,29 @@ def load_user_story(user_id_str: str, story_id: str) -> dict:
             logger.error("Firebase приложение не инициализировано.")
             return {}
 
-        # Попытка загрузить напрямую
-        ref = db.reference(f'users_story/{user_id_str}/{story_id}')
-        data = ref.get()
+        # Владелец и версия берутся из stories_index, сама история — из story_cache, если версия совпадает
+        owner_id, story_data = load_story_with_owner(story_id, heal=False)
+        if story_data and owner_id == str(user_id_str):
+            return story_data
+
+        # Попытка загрузить напрямую (история могла ещё не попасть в индекс)
+        data = read_story(user_id_str, story_id)
 
         if data is not None and isinstance(data, dict):
+            if not owner_id:
+                bump_story_version(story_id, user_id_str)
             return data
 
-        # Если не нашли — ищем среди всех
+        # Если не нашли — проверяем coop-доступ к истории владельца из stories_index
         logger.info(f"История {story_id} не найдена у пользователя {user_id_str}. Пытаемся найти владельца...")
 
-        all_users_ref = db.reference('users_story')
-        all_stories = all_users_ref.get()
-
-        if not all_stories or not isinstance(all_stories, dict):
-            logger.warning("Не удалось загрузить список всех историй пользователей.")
-            return {}
-
-        for possible_owner_id, stories in all_stories.items():
-            if not isinstance(stories, dict):
-                continue
-            story_data = stories.get(story_id)
-            if story_data:
-                try:
-                    actual_owner = get_owner_id_or_raise(int(user_id_str), story_id, story_data)
-                    logger.info(f"История {story_id} найдена у пользователя {actual_owner} с правом coop_edit для {user_id_str}.")
-                    return story_data
-                except PermissionError:
-                    continue
+        if story_data and owner_id != str(user_id_str):
+            try:
+                actual_owner = get_owner_id_or_raise(int(user_id_str), story_id, story_data)
+                logger.info(f"История {story_id} найдена у пользователя {actual_owner} с правом coop_edit для {user_id_str}.")
+                return story_data
+            except (PermissionError, ValueError):
+                pass
 
         logger.info(f"История {story_id} недоступна для пользователя {user_id_str} ни напрямую, ни по coop_edit.")
         return {}
@@ -1825,65 +2249,850 @@ def load_data() -> dict:
         logger.error(f"Неожиданная ошибка при загрузке данных из Firebase: {e}. Возвращена пустая структура.")
         return {"users_story": {}, "story_settings": {}}
 
+# Кэш промахов по индексу: story_id -> время, до которого повторный поиск не выполняется.
+# Защищает от повторных обходов users_story при вводе несуществующих ID.
+# Записи добавляются в порядке срока, поэтому просроченные снимаются с начала,
+# а при переполнении вытесняются самые старые.
+STORY_INDEX_MISS_TTL = 600
+STORY_INDEX_MISS_MAX = 10000
+_story_index_misses: "OrderedDict[str, float]" = OrderedDict()
+_story_index_misses_lock = threading.Lock()
+
+
+def _story_index_missed(story_id: str) -> bool:
+    """True, если story_id недавно не нашёлся ни у одного пользователя."""
+    now = time.time()
+    with _story_index_misses_lock:
+        while _story_index_misses and next(iter(_story_index_misses.values())) <= now:
+            _story_index_misses.popitem(last=False)
+        return story_id in _story_index_misses
+
+
+def _remember_story_index_miss(story_id: str) -> None:
+    with _story_index_misses_lock:
+        _story_index_misses.pop(story_id, None)
+        _story_index_misses[story_id] = time.time() + STORY_INDEX_MISS_TTL
+        while len(_story_index_misses) > STORY_INDEX_MISS_MAX:
+            _story_index_misses.popitem(last=False)
+
+
+def is_indexable_story_key(story_id: str) -> bool:
+    """Проверяет, что строка похожа на ключ истории (hex-ID или числовой ID обучающих историй)."""
+    return bool(re.fullmatch(r'[0-9a-f]{10}|\d{1,4}', str(story_id)))
+
+
+def heal_story_index(story_id: str) -> str | None:
+    """
+    Ищет владельца истории, отсутствующей в stories_index, и восстанавливает запись индекса.
+    Вместо выгрузки всего users_story читаются только ключи пользователей (shallow)
+    и ключи конкретной истории у каждого из них — это O(пользователей) запросов,
+    поэтому промах запоминается на STORY_INDEX_MISS_TTL.
+    Запись индекса дополняется (update), а не перезаписывается: версия продолжает
+    расти, и кэши других процессов со старой версией сбрасываются.
+    """
+    if _story_index_missed(story_id):
+        return None
+
+    user_ids = db.reference('users_story').get(shallow=True) or {}
+    for uid in user_ids:
+        story_keys = db.reference(f'users_story/{uid}/{story_id}').get(shallow=True)
+        if isinstance(story_keys, dict):
+            db.reference(f'stories_index/{story_id}').update({
+                "owner_id": str(uid),
+                "updated": int(time.time()),
+                "version": {".sv": {"increment": 1}},
+            })
+            with _story_index_misses_lock:
+                _story_index_misses.pop(story_id, None)
+            story_cache.invalidate(story_id)
+            logger.info(f"Индекс stories_index/{story_id} восстановлен → {uid}")
+            return str(uid)
+
+    _remember_story_index_miss(story_id)
+    return None
+
+
+def read_story_index(story_id: str) -> dict | None:
+    """
+    Читает запись stories_index/{story_id} ({owner_id, updated, version}).
+    Возвращает None, если записи нет или story_id не может быть ключом RTDB.
+    """
+    # Ключи RTDB не могут содержать . $ # [ ] /
+    if not story_id or len(str(story_id)) > 128 or re.search(r'[.$#\[\]/]', str(story_id)):
+        return None
+    index = db.reference(f"stories_index/{story_id}").get()
+    if isinstance(index, dict) and index.get("owner_id"):
+        return index
+    return None
+
+
+def resolve_story_owner(story_id: str, heal: bool = True) -> str | None:
+    """
+    Возвращает owner_id истории по stories_index.
+    Если записи нет и heal=True, пытается восстановить её (см. heal_story_index).
+    """
+    try:
+        index = read_story_index(story_id)
+        if index:
+            return str(index["owner_id"])
+        if heal and story_id and not re.search(r'[.$#\[\]/]', str(story_id)):
+            return heal_story_index(story_id)
+        return None
+    except Exception as e:
+        logger.error(f"Ошибка поиска владельца истории {story_id}: {e}")
+        return None
+
+
+def load_story_with_owner(story_id: str, heal: bool = True, index: dict | None = None) -> tuple[str | None, dict | None]:
+    """
+    Получает историю и её владельца через stories_index.
+    Сначала проверяется story_cache: запись из кэша используется, только если её
+    версия совпадает с version в индексе (индекс читается в любом случае, чтобы узнать владельца).
+    Если индекс устарел (история у владельца не найдена), запись индекса пересобирается.
+    index — уже прочитанная запись stories_index, чтобы не читать её повторно.
+    """
+    try:
+        if index is None:
+            index = read_story_index(story_id)
+        if index:
+            owner = str(index["owner_id"])
+            version = index.get("version", 0)
+            cached = story_cache.get(story_id, version)
+            if cached and cached[0] == owner:
+                return cached
+        elif heal and story_id and not re.search(r'[.$#\[\]/]', str(story_id)):
+            owner = heal_story_index(story_id)
+            version = 0
+        else:
+            return None, None
+
+        if not owner:
+            return None, None
+
+        story = read_story(owner, story_id)
+        if isinstance(story, dict):
+            story_cache.put(story_id, owner, story, version)
+            return owner, story
+
+        # Индекс указывает на несуществующую историю — пробуем найти актуального владельца
+        logger.warning(f"stories_index/{story_id} указывает на {owner}, но история не найдена. Пересобираем индекс.")
+        story_cache.invalidate(story_id)
+        owner = heal_story_index(story_id) if heal else None
+        if not owner:
+            # История могла переехать к другому владельцу, поэтому её story_meta, каталог,
+            # журнал и фрагменты не трогаем — удаляется только устаревшая запись индекса
+            db.reference(f"stories_index/{story_id}").delete()
+            return None, None
+        story = read_story(owner, story_id)
+        return (owner, story) if isinstance(story, dict) else (None, None)
+    except Exception as e:
+        logger.error(f"Ошибка поиска истории {story_id}: {e}")
+        return None, None
+
+
 def load_story_by_id(story_id: str) -> dict | None:
     """
     Получает историю по story_id через индекс stories_index.
     """
+    _, story = load_story_with_owner(story_id)
+    return story
+
+
+class PlayStoryView(dict):
+    """
+    Заголовок шардированной истории, в fragments которого загружены не все фрагменты
+    (см. load_story_for_play). Недостающие догружает ensure_play_fragments;
+    save_story_data пишет из такого вида только загруженные фрагменты.
+    """
+
+    def __init__(self, story_id: str, header: dict):
+        super().__init__(header)
+        self.story_id = story_id
+        self["fragments"] = dict(self.get("fragments") or {})
+
+
+def ensure_play_fragments(story: dict, fragment_ids) -> None:
+    """
+    Догружает в вид истории фрагменты fragment_ids из story_fragments (по одному
+    чтению на фрагмент, уже загруженные не читаются). Для полных историй ничего не делает.
+    """
+    if not isinstance(story, PlayStoryView):
+        return
+    fragments = story["fragments"]
+    for fragment_id in fragment_ids:
+        if not fragment_id or fragment_id in fragments or re.search(r'[.$#\[\]/]', str(fragment_id)):
+            continue
+        fragment = db.reference(f"{FRAGMENTS_ROOT}/{story.story_id}/{fragment_id}").get()
+        if isinstance(fragment, dict):
+            fragments[fragment_id] = fragment
+
+
+def load_story_for_play(story_id: str, fragment_ids=()) -> tuple[str | None, dict | None]:
+    """
+    История для прохождения: (owner_id, story) как у load_story_with_owner.
+    Для шардированной истории (storage_mode в stories_index) читаются только заголовок
+    и фрагменты fragment_ids — возвращается PlayStoryView. Остальные истории и записи
+    индекса без storage_mode (например, после heal_story_index) загружаются целиком,
+    как раньше, так что play-пути работают с обоими форматами.
+    """
     try:
-        index = db.reference(f"stories_index/{story_id}").get()
-        if not index or "owner_id" not in index:
-            return None
+        index = read_story_index(story_id)
+        if not index or index.get("storage_mode") != SHARDED_MODE:
+            return load_story_with_owner(story_id, index=index)
+
+        owner = str(index["owner_id"])
+        cached = story_cache.get(story_id, index.get("version", 0))
+        if cached and cached[0] == owner:
+            return cached
+
+        header = db.reference(f"users_story/{owner}/{story_id}").get()
+        if not isinstance(header, dict) or header.get("storage_mode") != SHARDED_MODE:
+            return load_story_with_owner(story_id, index=index)
+        story = PlayStoryView(story_id, header)
+        ensure_play_fragments(story, fragment_ids)
+        return owner, story
+    except Exception as e:
+        logger.error(f"Ошибка загрузки истории {story_id} для прохождения: {e}")
+        return None, None
 
-        owner = index["owner_id"]
-        story = db.reference(f"users_story/{owner}/{story_id}").get()
-        return story
 
+def bump_story_version(story_id: str, owner_id: str | None = None) -> None:
+    """
+    Отмечает изменение истории: увеличивает stories_index/{story_id}/version на сервере
+    (атомарно, через ServerValue increment) и сбрасывает запись в story_cache.
+    Должна вызываться после любой записи внутрь users_story/{owner}/{story_id}.
+    """
+    story_cache.invalidate(story_id)
+    try:
+        index_update = {
+            "updated": int(time.time()),
+            "version": {".sv": {"increment": 1}},
+        }
+        if owner_id is not None:
+            index_update["owner_id"] = str(owner_id)
+        db.reference(f'stories_index/{story_id}').update(index_update)
     except Exception as e:
-        logger.error(f"Ошибка поиска истории {story_id}: {e}")
-        return None
+        logger.error(f"Ошибка обновления версии истории {story_id}: {e}")
+
+
+def drop_story_index(story_id: str, owner_id: str | None = None, purge_fragments: bool = True) -> None:
+    """
+    Удаляет запись stories_index, story_meta, public_catalog, coop_index соавторов
+    и кэш истории (используется при удалении истории).
+    Если owner_id не передан, владелец берётся из индекса.
+    С purge_fragments удаляются и фрагменты шардированной истории (story_fragments/{story_id}).
+    """
+    story_cache.invalidate(story_id)
+    try:
+        if owner_id is None:
+            index = read_story_index(story_id)
+            owner_id = index["owner_id"] if index else None
+        updates = {
+            f"stories_index/{story_id}": None,
+            f"public_catalog/{story_id}": None,
+            f"story_changelog/{story_id}": None,
+        }
+        if purge_fragments:
+            updates[f"{FRAGMENTS_ROOT}/{story_id}"] = None
+        if owner_id is not None:
+            updates[f"story_meta/{owner_id}/{story_id}"] = None
+            # Соавторы берутся из story_meta, поэтому история может быть уже удалена
+            coop_list = db.reference(f"story_meta/{owner_id}/{story_id}/coop_edit").get() or []
+            for coop_user_id in coop_list:
+                updates[f"coop_index/{coop_user_id}/{story_id}"] = None
+        db.reference('/').update(updates)
+    except Exception as e:
+        logger.error(f"Ошибка удаления индекса истории {story_id}: {e}")
+
+
+# Поля истории, которые копируются в story_meta/{owner}/{story_id}.
+# Списки историй строятся только по story_meta и не скачивают фрагменты.
+STORY_META_FIELDS = ("title", "author", "user_name", "public", "neural", "webgame_ready", "coop_edit")
+
+
+def build_story_meta(story: dict) -> dict:
+    """Собирает компактную запись story_meta из полной истории."""
+    meta = {field: story[field] for field in STORY_META_FIELDS if story.get(field) is not None}
+    meta["title"] = story.get("title") or ""
+    meta["fragments"] = len(story.get("fragments") or {})
+    meta["updated"] = int(time.time())
+    return meta
+
+
+def is_complete_story_meta(meta) -> bool:
+    """
+    Запись story_meta считается полной, если в ней есть title и число фрагментов.
+    Неполные записи появляются, когда частичная правка пишет в историю,
+    для которой story_meta ещё не строилась.
+    """
+    return isinstance(meta, dict) and "title" in meta and "fragments" in meta
+
+
+def story_meta_changes(owner_id: str, story_id: str, changes: dict) -> dict:
+    """
+    По изменениям истории (формат save_story_patch) строит изменения story_meta
+    для того же multi-location update.
+    """
+    base_path = f"story_meta/{owner_id}/{story_id}"
+    meta_updates = {f"{base_path}/updated": int(time.time())}
+    for path, value in changes.items():
+        if path in STORY_META_FIELDS:
+            meta_updates[f"{base_path}/{path}"] = value
+    return meta_updates
+
+
+def coop_index_changes(owner_id: str, story_id: str, changes: dict, meta: dict) -> dict:
+    """
+    Изменения обратного индекса coop_index/{user_id}/{story_id} = {owner_id, title}
+    для правки истории. Нужны, только если правка меняет coop_edit или title;
+    прежний список соавторов берётся из meta (запись story_meta до правки).
+    """
+    if "coop_edit" not in changes and "title" not in changes:
+        return {}
+
+    old_list = meta.get("coop_edit") or []
+    new_list = changes["coop_edit"] if "coop_edit" in changes else old_list
+    new_list = [str(uid) for uid in (new_list or [])]
+
+    updates = {}
+    for coop_user_id in set(map(str, old_list)) - set(new_list):
+        updates[f"coop_index/{coop_user_id}/{story_id}"] = None
+    if new_list:
+        title = changes["title"] if "title" in changes else meta.get("title")
+        for coop_user_id in new_list:
+            updates[f"coop_index/{coop_user_id}/{story_id}"] = {"owner_id": str(owner_id), "title": title or ""}
+    return updates
+
+
+# Ключи сортировки public_catalog: имя поля и порядок (True — по убыванию).
+# Для запросов order_by_child в правилах базы нужен ".indexOn": ["updated", "title_key", "plays"]
+PUBLIC_CATALOG_SORTS = {
+    "recent": ("updated", True),
+    "title": ("title_key", False),
+    "popular": ("plays", True),
+}
+PUBLIC_STORIES_PER_PAGE = 10
+
+
+def public_catalog_changes(owner_id: str, story_id: str, changes: dict, meta: dict) -> dict:
+    """
+    Изменения public_catalog/{story_id} для правки истории.
+    Запись есть только у публичных историй с указанным автором (user_name) и хранит
+    поля для сортировки на сервере: updated, title_key и счётчик запусков plays.
+    """
+    if not any(field in changes for field in ("public", "title", "user_name")):
+        return {}
+    if not is_complete_story_meta(meta):
+        # story_meta ещё не построена: без флага public состояние неизвестно
+        if "public" not in changes:
+            return {}
+        meta = {"title": db.reference(f"users_story/{owner_id}/{story_id}/title").get() or ""}
+
+    state = dict(meta)
+    state.update({field: changes[field] for field in ("public", "title", "user_name") if field in changes})
+    path = f"public_catalog/{story_id}"
+    if not state.get("public") or not state.get("user_name"):
+        return {path: None}
+
+    title = state.get("title") or ""
+    return {
+        f"{path}/owner_id": str(owner_id),
+        f"{path}/title": title,
+        f"{path}/title_key": title.lower()[:100],
+        f"{path}/author": state["user_name"],
+        f"{path}/updated": int(time.time()),
+        # increment на 0 создаёт счётчик, если его нет, и не трогает существующий
+        f"{path}/plays": {".sv": {"increment": 0}},
+    }
+
+
+def record_public_play(story_id: str) -> None:
+    """Увеличивает счётчик запусков публичной истории (ключ сортировки "popular")."""
+    try:
+        db.reference(f"public_catalog/{story_id}/plays").set({".sv": {"increment": 1}})
+    except Exception as e:
+        logger.error(f"Ошибка обновления счётчика запусков истории {story_id}: {e}")
 
 
+def load_public_catalog_page(sort: str, page: int) -> tuple[list, bool]:
+    """
+    Возвращает ([(story_id, entry), ...], есть_следующая_страница) для страницы каталога.
+    Сервер сортирует по ключу и отдаёт не больше page * PUBLIC_STORIES_PER_PAGE + 1 записей;
+    если индекса в правилах базы нет, каталог читается целиком и сортируется здесь.
+    """
+    field, descending = PUBLIC_CATALOG_SORTS.get(sort, PUBLIC_CATALOG_SORTS["recent"])
+    limit = page * PUBLIC_STORIES_PER_PAGE + 1
+    try:
+        if descending:
+            data = query_children("public_catalog", field, limit_to_last=limit)
+        else:
+            data = query_children("public_catalog", field, limit_to_first=limit)
+    except Exception as e:
+        logger.warning(f"Запрос public_catalog по {field} не выполнен ({e}), читаем каталог целиком.")
+        data = db.reference("public_catalog").get() or {}
+
+    # Записи без owner_id — «осиротевшие» счётчики plays, их не показываем
+    items = [
+        (story_id, entry) for story_id, entry in data.items()
+        if isinstance(entry, dict) and entry.get("owner_id")
+    ]
+    default = "" if field == "title_key" else 0
+    items.sort(key=lambda item: item[1].get(field, default), reverse=descending)
+
+    start = (page - 1) * PUBLIC_STORIES_PER_PAGE
+    return items[start:start + PUBLIC_STORIES_PER_PAGE], len(items) > page * PUBLIC_STORIES_PER_PAGE
+
+
+def _is_fragment_path(path: str) -> bool:
+    return path == "fragments" or path.startswith("fragments/")
+
+
+def write_packed_fragment_changes(base_path: str, changes: dict) -> tuple[dict, int]:
+    """
+    Переводит правку фрагментов сжатой истории в запись блоков fragment_blocks.
+    Замена fragments целиком превращается в новые блоки; точечные пути применяются
+    к блоку своей ветки транзакцией, чтобы параллельные правки разных фрагментов
+    одной ветки (в том числе без проверки версии) не затирали друг друга.
+    Возвращает (остальные изменения для общего update, изменение числа фрагментов).
+    """
+    rest = {path: value for path, value in changes.items() if not _is_fragment_path(path)}
+    if "fragments" in changes:
+        rest[BLOCKS_FIELD] = pack_fragments(changes["fragments"] or {}) or None
+        return rest, 0
+
+    by_branch = {}
+    for path, value in changes.items():
+        if _is_fragment_path(path):
+            keys = path.split("/")[1:]
+            by_branch.setdefault(fragment_branch(keys[0]), []).append((keys, value))
+
+    count_delta = 0
+    for branch, items in by_branch.items():
+        sizes = {}
+
+        def apply_to_block(block, items=items, sizes=sizes):
+            fragments = decode_block(block)
+            sizes["before"] = len(fragments)
+            for keys, value in items:
+                set_by_path(fragments, keys, copy.deepcopy(value))
+            sizes["after"] = len(fragments)
+            return encode_block(fragments) if fragments else None
+
+        db.reference(f"{base_path}/{BLOCKS_FIELD}/{branch}").transaction(apply_to_block)
+        count_delta += sizes.get("after", 0) - sizes.get("before", 0)
+    return rest, count_delta
+
+
+def fragment_layout_updates(base_path: str, story_id: str, changes: dict, mode: str | None) -> tuple[dict, int]:
+    """
+    Пути multi-location update (от корня) для правки истории в режиме хранения mode:
+    обычный — как есть внутри base_path, compressed — через блоки
+    (write_packed_fragment_changes), sharded — fragments/... → story_fragments/{story_id}/...
+    При замене fragments целиком представления других режимов удаляются, так что
+    смена storage_mode вместе с fragments переносит фрагменты без остатков.
+    Возвращает (updates, изменение числа фрагментов — только для compressed).
+    """
+    count_delta = 0
+    if mode == COMPRESSED_MODE:
+        changes, count_delta = write_packed_fragment_changes(base_path, changes)
+    updates = {}
+    for path, value in changes.items():
+        if mode == SHARDED_MODE and _is_fragment_path(path):
+            updates[f"{FRAGMENTS_ROOT}/{story_id}{path[len('fragments'):]}"] = value
+        else:
+            updates[f"{base_path}/{path}"] = value
+    if "fragments" in changes or BLOCKS_FIELD in changes:
+        if mode != SHARDED_MODE:
+            updates[f"{FRAGMENTS_ROOT}/{story_id}"] = None
+        if mode is not None:
+            updates[f"{base_path}/fragments"] = None
+        if mode != COMPRESSED_MODE:
+            updates[f"{base_path}/{BLOCKS_FIELD}"] = None
+    return updates, count_delta
+
+
+def changes_touch_fragment_set(changes: dict) -> bool:
+    """True, если правка добавляет/удаляет фрагменты (меняется их количество)."""
+    return any(path == "fragments" or (path.startswith("fragments/") and path.count("/") == 1) for path in changes)
+
+
+def load_story_meta_list(owner_id: str) -> dict:
+    """
+    Возвращает {story_id: meta} для всех историй пользователя.
+    Читаются только shallow-ключи users_story/{owner_id} и узел story_meta/{owner_id}.
+    Истории без полной записи story_meta (созданные до её появления) загружаются
+    один раз целиком, и запись для них достраивается; записи удалённых историй убираются.
+    """
+    try:
+        if not firebase_admin._DEFAULT_APP_NAME:
+            logger.error("Firebase приложение не инициализировано.")
+            return {}
+
+        story_keys = db.reference(f'users_story/{owner_id}').get(shallow=True) or {}
+        # В shallow-ответе истории (вложенные узлы) приходят как True, secret_key — строкой
+        story_ids = [key for key, value in story_keys.items() if value is True]
+        all_meta = db.reference(f'story_meta/{owner_id}').get() or {}
+
+        result = {}
+        repairs = {}
+        for story_id in story_ids:
+            meta = all_meta.get(story_id)
+            if not is_complete_story_meta(meta):
+                story = read_story(owner_id, story_id)
+                if not isinstance(story, dict):
+                    continue
+                meta = build_story_meta(story)
+                repairs[f"story_meta/{owner_id}/{story_id}"] = meta
+            result[story_id] = meta
+
+        for story_id in set(all_meta) - set(story_ids):
+            repairs[f"story_meta/{owner_id}/{story_id}"] = None
+
+        if repairs:
+            db.reference('/').update(repairs)
+            logger.info(f"story_meta/{owner_id}: достроено/очищено записей: {len(repairs)}")
+
+        return result
+
+    except firebase_admin.exceptions.FirebaseError as e:
+        logger.error(f"Ошибка Firebase при загрузке story_meta пользователя {owner_id}: {e}")
+        return {}
+    except Exception as e:
+        logger.error(f"Неожиданная ошибка при загрузке story_meta пользователя {owner_id}: {e}")
+        return {}
+
+
+
+
+# Сколько последних версий истории помнит story_changelog (для дельты при конфликте записи)
+STORY_CHANGELOG_DEPTH = 50
+# Если с версии клиента изменилось больше путей, в ответе на конфликт отдаётся вся история
+STORY_DELTA_MAX_PATHS = 100
 
 
-def save_story_data(user_id_str: str, story_id: str, story_content: dict):
+# Результат save_current_story_from_context: запись отменена из-за пересекающихся правок
+STORY_SAVE_CONFLICT = "conflict"
+
+
+class StoryVersionConflict(Exception):
+    """Запись отклонена: история изменилась после того, как клиент её прочитал."""
+
+    def __init__(self, current_version: int):
+        super().__init__(f"story version conflict (current: {current_version})")
+        self.current_version = current_version
+
+
+def _changelog_key(version: int) -> str:
+    # Ключи с нулями слева сортируются в порядке версий
+    return f"v{version:010d}"
+
+
+def get_story_version(story_id: str) -> int:
+    """Текущая версия истории из stories_index (0, если записи нет)."""
+    index = read_story_index(story_id)
+    version = index.get("version", 0) if index else 0
+    return version if isinstance(version, int) else 0
+
+
+def load_user_story_versioned(user_id_str: str, story_id: str) -> tuple[dict, int]:
+    """
+    load_user_story вместе с версией. Версия читается до истории, поэтому она
+    не новее загруженных данных: в худшем случае запись получит лишний конфликт,
+    но чужая правка не будет потеряна.
+    """
+    version = get_story_version(story_id)
+    return load_user_story(user_id_str, story_id), version
+
+
+def story_delta_since(owner_id: str, story_id: str, since_version: int) -> dict:
+    """
+    Изменения истории после since_version:
+        {"version": текущая, "changes": {путь: текущее значение, ...}}
+    Пути берутся из story_changelog, значения — из базы (None — узел удалён).
+    Если журнал не покрывает весь промежуток (версия слишком старая или её подняли
+    без журнала, например bump_story_version) или путей слишком много, вместо
+    changes возвращается "story" — история целиком.
+    """
+    current = get_story_version(story_id)
+    result = {"version": current}
+    if since_version is None or since_version >= current:
+        result["changes"] = {}
+        return result
+
+    entries = {}
+    if current - since_version <= STORY_CHANGELOG_DEPTH:
+        entries = query_children(
+            f"story_changelog/{story_id}",
+            start_at=_changelog_key(since_version + 1),
+            end_at=_changelog_key(current),
+        )
+    paths = set()
+    for changed in entries.values():
+        paths.update(changed or [])
+
+    if len(entries) != current - since_version or len(paths) > STORY_DELTA_MAX_PATHS:
+        result["story"] = read_story(owner_id, story_id) or {}
+        return result
+
+    # Путь внутри уже попавшего в дельту узла отдельно не читаем
+    ordered = sorted(paths)
+    roots = [p for i, p in enumerate(ordered) if not any(p.startswith(q + "/") for q in ordered[:i])]
+    result["changes"] = read_story_paths(owner_id, story_id, roots)
+    return result
+
+
+def read_story_paths(owner_id: str, story_id: str, paths: list) -> dict:
+    """
+    {путь: значение} для путей внутри истории (None — узла нет). У сжатой истории
+    пути внутри fragments берутся из раскодированных блоков, каждый блок читается один раз;
+    у шардированной — из story_fragments.
+    """
+    base_path = f"users_story/{owner_id}/{story_id}"
+    mode = None
+    if any(_is_fragment_path(path) for path in paths):
+        mode = db.reference(f"{base_path}/storage_mode").get()
+    values = {}
+    blocks = {}
+    for path in paths:
+        if mode == SHARDED_MODE and _is_fragment_path(path):
+            values[path] = db.reference(f"{FRAGMENTS_ROOT}/{story_id}{path[len('fragments'):]}").get()
+            continue
+        if not (mode == COMPRESSED_MODE and _is_fragment_path(path)):
+            values[path] = db.reference(f"{base_path}/{path}").get()
+            continue
+        keys = path.split("/")[1:]
+        if not keys:
+            story = read_story(owner_id, story_id) or {}
+            values[path] = story.get("fragments")
+            continue
+        branch = fragment_branch(keys[0])
+        if branch not in blocks:
+            blocks[branch] = decode_block(db.reference(f"{base_path}/{BLOCKS_FIELD}/{branch}").get())
+        node = blocks[branch]
+        for key in keys:
+            if isinstance(node, list) and key.isdigit() and int(key) < len(node):
+                node = node[int(key)]
+            elif isinstance(node, dict):
+                node = node.get(key)
+            else:
+                node = None
+                break
+        values[path] = node
+    return values
+
+
+def _paths_overlap(a: str, b: str) -> bool:
+    return a == b or a.startswith(b + "/") or b.startswith(a + "/")
+
+
+def rebase_story_changes(changes: dict, base: dict, server: dict) -> dict | None:
+    """
+    Переносит локальные правки (diff_story_paths от base) на актуальную историю server.
+    Правки соавтора в других узлах сохраняются; если же один и тот же узел изменён
+    и локально, и на сервере, и результаты расходятся, возвращается None —
+    такой конфликт решает пользователь, молча побеждать не должна ни одна сторона.
+    """
+    server_changes = diff_story_paths(base, server)
+    for path, value in changes.items():
+        for server_path in server_changes:
+            if _paths_overlap(path, server_path) and get_by_path(server, path.split("/")) != value:
+                return None
+    return changes
+
+
+def diff_story_paths(old: dict, new: dict, prefix: str = "") -> dict:
+    """
+    Сравнивает две версии истории и возвращает изменения в формате multi-location update:
+        {"fragments/main_1/text": "новый текст", "fragments/old_name": None, ...}
+    Словари сравниваются рекурсивно, списки и скаляры — целиком.
+    Ключи, отсутствующие в new, попадают в результат со значением None (удаление).
+    """
+    changes = {}
+    for key in set(old) | set(new):
+        path = f"{prefix}{key}"
+        if key not in new:
+            changes[path] = None
+        elif key not in old:
+            changes[path] = new[key]
+        elif isinstance(old[key], dict) and isinstance(new[key], dict) and new[key]:
+            changes.update(diff_story_paths(old[key], new[key], f"{path}/"))
+        elif old[key] != new[key]:
+            changes[path] = new[key]
+    return changes
+
+
+def save_story_patch(user_id_str: str, story_id: str, changes: dict, expected_version: int | None = None):
+    """
+    Частичное сохранение истории одним multi-location update:
+        changes = {"fragments/main_1/text": "...", "fragments/main_2": None}
+    Пути задаются относительно users_story/{user_id_str}/{story_id}, None удаляет узел.
+    Версия (stories_index/{story_id}/version) увеличивается транзакцией; если передан
+    expected_version и текущая версия другая, запись не выполняется и бросается
+    StoryVersionConflict. Из двух писателей с одной версией проходит только один,
+    а версия никогда не откатывается назад. Затем одним запросом пишутся сами изменения,
+    owner_id/updated в stories_index, список изменённых путей в story_changelog, поля
+    story_meta и, если правка их касается, coop_index и public_catalog, поэтому объём
+    передаваемых данных зависит от правки, а не от размера истории.
+    Пути не должны пересекаться (например, "fragments/a" и "fragments/a/text").
+    Возвращает новую версию (или True, если изменений нет), False при ошибке.
+    """
+    if not changes:
+        return True
+    try:
+        if not firebase_admin._DEFAULT_APP_NAME:
+            logger.error("Firebase приложение не инициализировано. Сохранение отменено.")
+            return False
+
+        def bump_version(current):
+            current = current if isinstance(current, int) and not isinstance(current, bool) else 0
+            if expected_version is not None and current != expected_version:
+                raise StoryVersionConflict(current)
+            return current + 1
+
+        new_version = db.reference(f"stories_index/{story_id}/version").transaction(bump_version)
+
+        base_path = f'users_story/{user_id_str}/{story_id}'
+        # Режим хранения нужен, только если правка касается фрагментов
+        mode = None
+        if "storage_mode" in changes:
+            mode = changes["storage_mode"]
+        elif any(_is_fragment_path(path) for path in changes):
+            mode = db.reference(f"{base_path}/storage_mode").get()
+        updates, fragment_count_delta = fragment_layout_updates(base_path, story_id, changes, mode)
+        if "storage_mode" in changes:
+            # Копия режима в индексе позволяет load_story_for_play не читать историю целиком
+            updates[f"stories_index/{story_id}/storage_mode"] = mode
+        updates[f"stories_index/{story_id}/owner_id"] = str(user_id_str)
+        updates[f"stories_index/{story_id}/updated"] = int(time.time())
+        updates[f"story_changelog/{story_id}/{_changelog_key(new_version)}"] = sorted(changes)
+        if new_version > STORY_CHANGELOG_DEPTH:
+            updates[f"story_changelog/{story_id}/{_changelog_key(new_version - STORY_CHANGELOG_DEPTH)}"] = None
+        # Прежние значения story_meta нужны только для правок, влияющих на coop_index и public_catalog
+        meta = {}
+        if any(field in changes for field in ("title", "coop_edit", "public", "user_name")):
+            meta = db.reference(f"story_meta/{user_id_str}/{story_id}").get() or {}
+        updates.update(coop_index_changes(user_id_str, story_id, changes, meta))
+        updates.update(public_catalog_changes(user_id_str, story_id, changes, meta))
+        updates.update(story_meta_changes(user_id_str, story_id, changes))
+        if mode == COMPRESSED_MODE and changes_touch_fragment_set(changes):
+            # Число фрагментов сжатой истории известно из блоков — пишется тем же запросом,
+            # при точечной правке — серверным инкрементом, как и блоки, без чтения счётчика
+            count_path = f"story_meta/{user_id_str}/{story_id}/fragments"
+            if "fragments" in changes:
+                updates[count_path] = len(changes["fragments"] or {})
+            elif fragment_count_delta:
+                updates[count_path] = {".sv": {"increment": fragment_count_delta}}
+        db.reference('/').update(updates)
+
+        if mode in (None, SHARDED_MODE) and changes_touch_fragment_set(changes):
+            fragments_path = f"{FRAGMENTS_ROOT}/{story_id}" if mode == SHARDED_MODE else f"{base_path}/fragments"
+            fragment_keys = db.reference(fragments_path).get(shallow=True) or {}
+            db.reference(f"story_meta/{user_id_str}/{story_id}/fragments").set(len(fragment_keys))
+
+        # Если в кэше лежала ровно предыдущая версия — обновляем её на месте,
+        # чтобы следующая правка не скачивала историю целиком
+        story_cache.apply_patch(story_id, changes, new_version)
+
+        logger.info(f"История {story_id} частично сохранена ({len(changes)} путей), версия {new_version}.")
+        return new_version
+
+    except StoryVersionConflict:
+        raise
+    except firebase_admin.exceptions.FirebaseError as e:
+        logger.error(f"Ошибка Firebase при частичном сохранении истории {story_id}: {e}")
+    except Exception as e:
+        logger.error(f"Неожиданная ошибка при частичном сохранении истории {story_id}: {e}")
+    story_cache.invalidate(story_id)
+    return False
+
+
+def save_story_data(user_id_str: str, story_id: str, story_content: dict, expected_version: int | None = None):
     """
     Сохраняет историю по пути:
         users_story/{user_id_str}/{story_id}
     И создаёт индекс:
-        stories_index/{story_id} = {owner_id: user_id_str}
+        stories_index/{story_id} = {owner_id: user_id_str, updated, version}
     Для быстрого поиска историй без знания user_id.
+    version увеличивается при каждой записи и служит ключом инвалидации story_cache.
+
+    Поля story_content сливаются с сохранённой историей на верхнем уровне.
+    Если актуальная версия истории есть в story_cache, в базу уходят только
+    изменившиеся пути; иначе — поля верхнего уровня. В обоих случаях это один
+    update() без предварительного чтения всей истории.
+    С expected_version запись выполняется, только если история не менялась с этой
+    версии (иначе StoryVersionConflict, см. save_story_patch).
+    Возвращает новую версию или None, если ничего не записано.
     """
     try:
         if not firebase_admin._DEFAULT_APP_NAME:
             logger.error("Firebase приложение не инициализировано. Сохранение отменено.")
             return
 
-        # --- 1. Сохранение самой истории
-        story_ref = db.reference(f'users_story/{user_id_str}/{story_id}')
+        base_story = None
+        index = read_story_index(story_id)
+        if index and str(index["owner_id"]) == str(user_id_str):
+            cached = story_cache.get(story_id, index.get("version", 0))
+            if cached:
+                base_story = cached[1]
+
+        # В виде для прохождения загружены не все фрагменты: отсутствие фрагмента
+        # не означает удаления, поэтому фрагменты пишутся по одному
+        partial_fragments = None
+        if isinstance(story_content, PlayStoryView):
+            story_content = dict(story_content)
+            partial_fragments = story_content.pop("fragments")
+
+        if base_story is not None:
+            merged = dict(base_story)
+            merged.update(story_content)
+            changes = diff_story_paths(base_story, merged)
+        else:
+            changes = dict(story_content)
 
-        current_data = story_ref.get() or {}
-        current_data.update(story_content)
-        story_ref.set(current_data)
+        if partial_fragments is not None:
+            base_fragments = (base_story or {}).get("fragments") or {}
+            for fragment_id, fragment in partial_fragments.items():
+                if base_story is None or base_fragments.get(fragment_id) != fragment:
+                    changes[f"fragments/{fragment_id}"] = fragment
 
-        # --- 2. Сохранение индекса истории
-        index_ref = db.reference(f'stories_index/{story_id}')
-        index_ref.set({
-            "owner_id": user_id_str,
-            "updated": int(time.time())  # по желанию — можно хранить timestamp
-        })
+        if not changes:
+            logger.info(f"История {story_id} не изменилась, запись пропущена.")
+            return None
 
+        new_version = save_story_patch(user_id_str, story_id, changes, expected_version)
+        if not isinstance(new_version, int) or isinstance(new_version, bool):
+            logger.error(f"История {story_id} не сохранена.")
+            return None
         logger.info(f"История {story_id} сохранена. Индекс stories_index обновлён → {user_id_str}")
+        return new_version
 
+    except StoryVersionConflict:
+        raise
     except firebase_admin.exceptions.FirebaseError as e:
         logger.error(f"Ошибка Firebase при сохранении истории {story_id}: {e}")
     except Exception as e:
         logger.error(f"Неожиданная ошибка при сохранении истории: {e}")
+    return None
+
+
+def remember_story_version(context: ContextTypes.DEFAULT_TYPE, story_id: str, version: int, story: dict | None = None) -> None:
+    """
+    Запоминает версию истории, загруженной в редактор, и копию её содержимого:
+    с версией сверяется следующее сохранение, а от копии считаются локальные правки,
+    если историю за это время изменил соавтор.
+    """
+    context.user_data.setdefault('story_versions', {})[story_id] = version
+    if story is not None:
+        context.user_data.setdefault('story_bases', {})[story_id] = copy.deepcopy(story)
 
 
 def save_current_story_from_context(context: ContextTypes.DEFAULT_TYPE):
     """
-    Извлекает данные текущей истории из user_data и сохраняет их в Firebase,
-    используя save_story_data_firebase.
+    Извлекает данные текущей истории из user_data и сохраняет их в Firebase.
+    Если с момента загрузки историю изменил соавтор, локальные правки переносятся
+    поверх его версии (rebase_story_changes). Если правки пересекаются, ничего
+    не записывается: локальная копия остаётся как есть, а функция возвращает
+    STORY_SAVE_CONFLICT, чтобы редактор сообщил об этом пользователю.
     """
     if 'user_id_str' in context.user_data and \
        'story_id' in context.user_data and \
@@ -1892,11 +3101,73 @@ def save_current_story_from_context(context: ContextTypes.DEFAULT_TYPE):
         user_id = context.user_data['user_id_str']
         story_id = context.user_data['story_id']
         story_data = context.user_data['current_story']
-        save_story_data(user_id, story_id, story_data)
+        # Версия и содержимое, с которыми работает редактор этого пользователя (см. remember_story_version)
+        versions = context.user_data.setdefault('story_versions', {})
+        bases = context.user_data.setdefault('story_bases', {})
+        expected_version = versions.get(story_id)
+        base = bases.get(story_id)
+        try:
+            if base is not None:
+                changes = diff_story_paths(base, story_data)
+                new_version = save_story_patch(user_id, story_id, changes, expected_version)
+            else:
+                new_version = save_story_data(user_id, story_id, story_data, expected_version)
+        except StoryVersionConflict as conflict:
+            logger.warning(
+                f"Конфликт версий истории {story_id}: редактор на {expected_version}, "
+                f"в базе {conflict.current_version}."
+            )
+            if base is None:
+                return STORY_SAVE_CONFLICT
+            server, server_version = load_user_story_versioned(user_id, story_id)
+            changes = rebase_story_changes(changes, base, server or {})
+            if changes is None:
+                logger.warning(f"История {story_id}: правки пересекаются с правками соавтора, запись отменена.")
+                return STORY_SAVE_CONFLICT
+            try:
+                new_version = save_story_patch(user_id, story_id, changes, server_version)
+            except StoryVersionConflict:
+                return STORY_SAVE_CONFLICT
+            if isinstance(new_version, int) and not isinstance(new_version, bool):
+                # Локальная копия = версия соавтора + наши правки
+                story_data = copy.deepcopy(server or {})
+                for path, value in changes.items():
+                    set_by_path(story_data, path.split("/"), copy.deepcopy(value))
+                context.user_data['current_story'] = story_data
+                base = None
+        if not isinstance(new_version, int) or isinstance(new_version, bool):
+            return None
+        versions[story_id] = new_version
+        if base is not None:
+            # Копия догоняет сохранённую версию без полного копирования истории
+            for path, value in changes.items():
+                set_by_path(base, path.split("/"), copy.deepcopy(value))
+        else:
+            bases[story_id] = copy.deepcopy(story_data)
+        return new_version
     else:
         logger.warning("Попытка сохранить текущую историю из контекста, но не все данные найдены в context.user_data (user_id_str, story_id, current_story).")
 
 
+async def save_story_in_editor(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """
+    save_current_story_from_context для обработчиков редактора: при конфликте
+    с правками соавтора сообщает пользователю, что изменения не сохранены.
+    Возвращает False, если запись отменена из-за конфликта.
+    """
+    result = await db_call(save_current_story_from_context, context)
+    if result != STORY_SAVE_CONFLICT:
+        return True
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=(
+            "⚠️ Соавтор успел изменить те же места истории, поэтому ваши последние правки не сохранены.\n"
+            "Откройте историю заново, чтобы увидеть актуальную версию, и повторите изменения."
+        ),
+    )
+    return False
+
+
 def save_story_bookmark(user_id_str: str, story_id: str, bookmark_data: dict):
     """
     Сохраняет одну заметку для истории.
@@ -1908,6 +3179,7 @@ def save_story_bookmark(user_id_str: str, story_id: str, bookmark_data: dict):
         ref = db.reference(f'users_story/{user_id_str}/{story_id}/bookmarks').push()
         # Сохраняем данные заметки
         ref.set(bookmark_data)
+        bump_story_version(story_id)
         logger.info(f"Заметка для истории {story_id} сохранена с ID: {ref.key}")
         # Возвращаем ID и данные для отправки клиенту
         return { "id": ref.key, **bookmark_data }
@@ -1936,6 +3208,7 @@ def update_story_bookmark(user_id_str: str, story_id: str, note_id: str, new_tex
         # Указываем путь прямо к текстовому полю заметки
         ref = db.reference(f'users_story/{user_id_str}/{story_id}/bookmarks/{note_id}/text')
         ref.set(new_text)
+        bump_story_version(story_id)
         logger.info(f"Текст заметки {note_id} для истории {story_id} обновлен.")
         return True
     except Exception as e:
@@ -1950,6 +3223,7 @@ def delete_story_bookmark(user_id_str: str, story_id: str, note_id: str):
         # Указываем путь к корню удаляемой заметки
         ref = db.reference(f'users_story/{user_id_str}/{story_id}/bookmarks/{note_id}')
         ref.delete()
+        bump_story_version(story_id)
         logger.info(f"Заметка {note_id} для истории {story_id} удалена.")
         return True
     except Exception as e:
@@ -2074,12 +3348,13 @@ async def delete_story_confirmed(update: Update, context: ContextTypes.DEFAULT_T
     story_ref = db.reference(f'users_story/{user_id_owner}/{story_id_to_delete}')
 
     try:
-        if story_ref.get() is None:
+        if await db_call(story_ref.get) is None:
             logger.info(f"Попытка удалить несуществующую историю: users_story/{user_id_owner}/{story_id_to_delete}")
             if query:
                 await query.answer("История не найдена или уже удалена.", show_alert=True)
         else:
-            story_ref.delete()
+            await db_call(story_ref.delete)
+            await db_call(drop_story_index, story_id_to_delete, user_id_owner)
             logger.info(f"История {story_id_to_delete} пользователя {user_id_owner} удалена из Firebase.")
             if query:
                 await query.answer("История удалена.", show_alert=True)
@@ -2125,23 +3400,21 @@ def _save_story_state_to_firebase_sync(inline_message_id: str, story_state_data:
     elif 'launch_time' in existing_data and 'launch_time' not in story_state_data:
         story_state_data['launch_time'] = existing_data['launch_time']
 
-    # Логика конвертации типов (set -> list и т.д.)
+    # Время запуска в эпохе — по индексу launch_ts работает плановая очистка
+    if 'launch_ts' not in story_state_data:
+        story_state_data['launch_ts'] = existing_data.get('launch_ts') or launch_ts_from_launch_time(
+            story_state_data['launch_time']
+        )
+
+    # Голоса хранятся как {user_id: choice_idx, "_fragment": fragment_id} (см. record_poll_vote)
     if 'poll_details' in story_state_data and story_state_data['poll_details']:
         poll_details = story_state_data['poll_details']
         if 'votes' in poll_details:
-            votes_data = poll_details['votes']
-            if isinstance(votes_data, dict):
-                story_state_data['poll_details']['votes'] = {
-                    str(idx): list(user_set or [])
-                    for idx, user_set in votes_data.items()
-                }
-            elif isinstance(votes_data, list):
-                story_state_data['poll_details']['votes'] = {
-                    str(i): list(v) if isinstance(v, list) else []
-                    for i, v in enumerate(votes_data)
-                }
-        if 'voted_users' in poll_details and isinstance(poll_details['voted_users'], set):
-            poll_details['voted_users'] = list(poll_details['voted_users'])
+            poll_details['votes'] = serialize_votes_for_db(
+                poll_details['votes'], story_state_data.get('current_fragment_id')
+            )
+        # Список проголосовавших выводится из votes и отдельно не хранится
+        poll_details.pop('voted_users', None)
 
     logger.info(f"Saving to Firebase for {inline_message_id}: {story_state_data}")
     
@@ -2162,7 +3435,7 @@ async def save_story_state_to_firebase(inline_message_id: str, story_state_data:
     data_copy = copy.deepcopy(story_state_data)
     
     # Запускаем синхронную функцию в отдельном потоке
-    await asyncio.to_thread(_save_story_state_to_firebase_sync, inline_message_id, data_copy)
+    await db_call(_save_story_state_to_firebase_sync, inline_message_id, data_copy)
 
 
 def update_user_attributes(inline_message_id: str, user_attributes: dict):
@@ -2220,72 +3493,318 @@ def load_story_state_from_firebase(inline_message_id: str) -> dict | None:
     story_state = ref.get()
     if story_state:
         logger.info(f"Loaded from Firebase for {inline_message_id}: {story_state}")
-        # Конвертируем обратно list в set для votes и voted_users
-        if 'poll_details' in story_state and story_state['poll_details']:
-            if 'votes' in story_state['poll_details']:
-                votes_raw = story_state['poll_details']['votes']
-                if isinstance(votes_raw, dict):
-                    story_state['poll_details']['votes'] = {
-                        idx_str: set(user_list)
-                        for idx_str, user_list in votes_raw.items()
-                    }
-                else:
-                    logger.warning(f"'votes' expected to be dict, got {type(votes_raw)}: {votes_raw}")
-            if 'voted_users' in story_state['poll_details']:
-                 story_state['poll_details']['voted_users'] = set(story_state['poll_details']['voted_users'])
+        # poll_details/votes возвращается как есть: разбирает его deserialize_votes_from_db
         return story_state
     return None
 
 
 
 
-async def transfer_to_index(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def cache_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Админ-команда: показывает статистику story_cache (попадания, размер, вытеснения)."""
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("У вас нет прав на выполнение этой команды.")
+        return
+
+    stats = story_cache.stats()
+    templates = template_cache.stats()
+    plans = timed_edit_cache.stats()
+    value_plans = timed_template_cache.stats()
+    await update.message.reply_html(
+        "<b>Кэш историй</b>\n"
+        f"Записей: {stats['entries']}\n"
+        f"Размер: {stats['bytes'] / 1024:.1f} / {stats['max_bytes'] / 1024:.0f} КБ\n"
+        f"Попадания: {stats['hits']} | Промахи: {stats['misses']} (устаревшие: {stats['stale']})\n"
+        f"Hit rate: {stats['hit_rate'] * 100:.1f}%\n"
+        f"Вытеснено: {stats['evictions']}\n\n"
+        "<b>Шаблоны фрагментов</b>\n"
+        f"Записей: {templates['entries']} | Попадания: {templates['hits']} | Промахи: {templates['misses']}\n"
+        "<b>Планы таймеров</b>\n"
+        f"Записей: {plans['entries']} | Попадания: {plans['hits']} | Промахи: {plans['misses']}\n"
+        "<b>Планы таймеров с атрибутами</b>\n"
+        f"Записей: {value_plans['entries']} | Попадания: {value_plans['hits']} | Промахи: {value_plans['misses']}"
+    )
+
+
+async def db_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Админ-команда: показывает нагрузку на db_gateway (очередь, таймауты, задержки)."""
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("У вас нет прав на выполнение этой команды.")
+        return
+
+    stats = db_gateway.stats()
+    renders = RENDER_READ_STATS["renders"]
+    reads_per_render = RENDER_READ_STATS["reads"] / renders if renders else 0.0
+    await update.message.reply_html(
+        "<b>Шлюз базы данных</b>\n"
+        f"Потоков: {stats['workers']} | Таймаут: {stats['timeout']:.0f} с\n"
+        f"В очереди: {stats['queued']} (максимум: {stats['max_queued']})\n"
+        f"Выполняется: {stats['in_flight']}\n"
+        f"Вызовов: {stats['calls']} | Ошибок: {stats['errors']} | Таймаутов: {stats['timeouts']}\n"
+        f"Ожидание в очереди: {stats['avg_wait_ms']} мс | Выполнение: {stats['avg_run_ms']} мс\n"
+        f"Рендеров фрагментов: {renders} | Чтений прогресса на рендер: "
+        f"{reads_per_render:.2f} (максимум: {RENDER_READ_STATS['max_reads']})"
+    )
+
+
+async def edit_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Админ-команда: показывает очередь планировщика правок (edit_scheduler)."""
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("У вас нет прав на выполнение этой команды.")
+        return
+
+    stats = edit_scheduler.stats()
+    await update.message.reply_html(
+        "<b>Планировщик правок сообщений</b>\n"
+        f"В очереди: {stats['depth']} (максимум: {stats['max_depth']}) | Активных чатов: {stats['active_chats']}\n"
+        f"Поставлено: {stats['submitted']} | Отправлено: {stats['sent']} | Ошибок: {stats['failed']}\n"
+        f"Замещено более новыми: {stats['coalesced']} | Отброшено (отменены): {stats['dropped']}\n"
+        f"RetryAfter: {stats['retries']} | Среднее ожидание: {stats['avg_wait_ms']} мс"
+    )
+
+
+async def timer_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Админ-команда: показывает колесо таймеров фрагментов (авто-переходы и пошаговый показ)."""
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("У вас нет прав на выполнение этой команды.")
+        return
+
+    stats = fragment_timers.stats()
+    levels = " / ".join(str(count) for count in stats["per_level"])
+    await update.message.reply_html(
+        "<b>Таймеры фрагментов</b>\n"
+        f"Ожидают: {stats['pending']} (максимум: {stats['max_pending']}) | Выполняются: {stats['running']}\n"
+        f"По уровням колеса: {levels} | Overflow: {stats['overflow']}\n"
+        f"Поставлено: {stats['scheduled']} | Сработало: {stats['fired']} | "
+        f"Отменено: {stats['cancelled']} | Ошибок: {stats['errors']}"
+    )
+
+
+STORIES_INDEX_BATCH_SIZE = 500  # Максимум путей в одном multi-location update
+
+
+def _stories_index_transform(user_id: str, story_id: str, story) -> dict:
+    return {
+        f"stories_index/{story_id}/owner_id": user_id,
+        f"stories_index/{story_id}/updated": int(time.time()),
+    }
+
+
+def _story_meta_transform(user_id: str, story_id: str, story: dict) -> dict:
+    return {f"story_meta/{user_id}/{story_id}": build_story_meta(story)}
+
+
+def _migrate_story_to_sharded(user_id: str, story_id: str) -> int:
     """
-    Переносит все истории из users_story → stories_index
-    только если у истории есть owner_id.
+    Переносит фрагменты истории в story_fragments/{story_id}, в users_story остаётся заголовок.
+    Каждая история пишется сразу после чтения и с проверкой версии (set_story_storage_mode),
+    поэтому правка, сделанная во время миграции, не затирается.
     """
+    result = set_story_storage_mode(user_id, story_id, SHARDED_MODE)
+    if result is False:
+        logger.error(f"Миграция sharded_layout: история {story_id} не перенесена.")
+    return 1 if isinstance(result, int) and not isinstance(result, bool) else 0
+
+
+register_migration(Migration(
+    name="stories_index",
+    description="stories_index по фактическому расположению историй",
+    transform=_stories_index_transform,
+    needs_story=False,
+    finish=_story_index_misses.clear,
+))
+register_migration(Migration(
+    name="story_meta",
+    description="story_meta для всех историй (полная пересборка, включая уже заполненные)",
+    transform=_story_meta_transform,
+))
+register_migration(Migration(
+    name="sharded_layout",
+    description="фрагменты историй в story_fragments/{story_id}/{fragment_id} (заголовок остаётся в users_story)",
+    migrate_story=_migrate_story_to_sharded,
+))
+
+
+def _migration_report_text(name: str, state: dict) -> str:
+    status = "✔ завершена" if state.get("finished") else "⏳ выполняется"
+    return (
+        f"Миграция {name}: {status}\n"
+        f"📚 Историй: {state.get('processed', 0)} | Путей записано: {state.get('written', 0)}\n"
+        f"⚡ Скорость: {state.get('rate', 0)} ист/с\n"
+        f"📍 Курсор: {state.get('cursor_user') or '—'}/{state.get('cursor_story') or '—'}"
+    )
+
+
+async def _run_migration_with_report(update: Update, name: str, restart: bool) -> None:
+    """Запускает миграцию и обновляет одно сообщение в чате админа после каждой пачки."""
+    status_message = await update.message.reply_text(f"⏳ Миграция {name} запущена...")
+
+    async def report(state: dict):
+        try:
+            await status_message.edit_text(_migration_report_text(name, state))
+        except BadRequest:
+            pass  # Текст не изменился
+
     try:
-        users_story_ref = db.reference("users_story")
-        users_story_data = users_story_ref.get()
+        state = await run_migration(MIGRATIONS[name], restart=restart, report=report)
+        await report(state)
+    except Exception as e:
+        logger.error(f"Ошибка миграции {name}: {e}")
+        await update.message.reply_text(
+            f"❌ Миграция {name} прервана: {e}\nПовторите /migrate {name}, чтобы продолжить с курсора."
+        )
 
-        if not users_story_data:
-            await update.message.reply_text("⚠ users_story пуст — нечего переносить.")
-            return
 
-        migrated = 0
-        skipped = 0
+async def migrate_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Админ-команда /migrate [имя] [restart].
+    Без аргументов показывает список миграций и их состояние; с именем — запускает
+    миграцию или продолжает её с сохранённого курсора; restart начинает заново.
+    """
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("У вас нет прав на выполнение этой команды.")
+        return
+
+    args = context.args or []
+    if not args:
+        lines = []
+        for name, migration in MIGRATIONS.items():
+            state = await db_call(load_migration_state, name)
+            if state.get("finished"):
+                status = "завершена"
+            elif state:
+                status = f"остановлена на {state.get('processed', 0)} историях"
+            else:
+                status = "не запускалась"
+            lines.append(f"• {name} — {migration.description} ({status})")
+        await update.message.reply_text("Миграции:\n" + "\n".join(lines) + "\n\n/migrate <имя> [restart]")
+        return
 
-        for user_id, stories in users_story_data.items():
-            if not isinstance(stories, dict):
-                continue
-            
-            for story_id, story_data in stories.items():
-                # --- ИСПРАВЛЕНИЕ: Проверка типа данных ---
-                if not isinstance(story_data, dict):
-                    continue
+    name = args[0]
+    if name not in MIGRATIONS:
+        await update.message.reply_text(f"Неизвестная миграция: {name}")
+        return
 
-                owner_id = story_data.get("owner_id")
+    await _run_migration_with_report(update, name, restart=len(args) > 1 and args[1] == "restart")
 
-                if not owner_id:
-                    skipped += 1
-                    continue
 
-                index_ref = db.reference(f"stories_index/{story_id}")
-                index_ref.set({
-                    "owner_id": owner_id,
-                    "updated": int(time.time())
-                })
+async def compress_story_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Админ-команда /compress <story_id> [off].
+    Включает (или с off — выключает) сжатое хранение фрагментов истории
+    и показывает размер фрагментов в обоих видах.
+    """
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("У вас нет прав на выполнение этой команды.")
+        return
+
+    args = context.args or []
+    if not args:
+        await update.message.reply_text("Использование: /compress <story_id> [off]")
+        return
+
+    story_id = args[0]
+    compressed = not (len(args) > 1 and args[1] == "off")
+    owner_id, story = await db_call(load_story_with_owner, story_id)
+    if not story:
+        await update.message.reply_text(f"История {story_id} не найдена.")
+        return
+
+    fragments = story.get("fragments") or {}
+    raw_size = len(json.dumps(fragments, ensure_ascii=False).encode("utf-8"))
+    packed_size = sum(len(block) for block in pack_fragments(fragments).values())
+    result = await db_call(set_story_storage_mode, owner_id, story_id, COMPRESSED_MODE if compressed else None)
+    if result is None or result is False:
+        await update.message.reply_text(f"Не удалось изменить режим хранения истории {story_id}.")
+        return
+
+    mode = "сжатый" if compressed else "обычный"
+    await update.message.reply_text(
+        f"История {story_id}: режим хранения — {mode}.\n"
+        f"Фрагментов: {len(fragments)}\n"
+        f"JSON: {raw_size / 1024:.1f} КБ, блоки: {packed_size / 1024:.1f} КБ"
+    )
+
+
+async def backfill_stories_index(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Админ-команда: пересобирает stories_index по фактическому расположению историй
+    (миграция stories_index, всегда с начала). Заменяет старую команду /transfer.
+    """
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("У вас нет прав на выполнение этой команды.")
+        return
+
+    await _run_migration_with_report(update, "stories_index", restart=True)
+
+
+async def rebuild_story_meta(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Админ-команда: достраивает story_meta для всех пользователей и пересобирает
+    coop_index и public_catalog.
+    Для каждого пользователя вызывается load_story_meta_list, которая загружает
+    целиком только истории без полной записи story_meta; coop_index и
+    public_catalog строятся по story_meta.
+    """
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("У вас нет прав на выполнение этой команды.")
+        return
+
+    try:
+        user_ids = await db_call(db.reference("users_story").get, shallow=True) or {}
+        users_done = 0
+        stories_total = 0
+        coop_index = {}
+        public_metas = {}
+        for uid in user_ids:
+            user_meta = await db_call(load_story_meta_list, str(uid))
+            stories_total += len(user_meta)
+            users_done += 1
+            for story_id, meta in user_meta.items():
+                for coop_user_id in meta.get("coop_edit") or []:
+                    coop_index.setdefault(str(coop_user_id), {})[story_id] = {
+                        "owner_id": str(uid),
+                        "title": meta.get("title", ""),
+                    }
+                if meta.get("public") and meta.get("user_name"):
+                    public_metas[story_id] = (str(uid), meta)
+
+        coop_ref = db.reference("coop_index")
+        if coop_index:
+            await db_call(coop_ref.set, coop_index)
+        else:
+            await db_call(coop_ref.delete)
+
+        # Счётчики запусков сохраняются, остальные поля каталога строятся заново
+        old_catalog = await db_call(db.reference("public_catalog").get) or {}
+        catalog = {}
+        for story_id, (owner_id, meta) in public_metas.items():
+            title = meta.get("title", "")
+            old_entry = old_catalog.get(story_id)
+            catalog[story_id] = {
+                "owner_id": owner_id,
+                "title": title,
+                "title_key": title.lower()[:100],
+                "author": meta["user_name"],
+                "updated": meta.get("updated", int(time.time())),
+                "plays": old_entry.get("plays", 0) if isinstance(old_entry, dict) else 0,
+            }
+        catalog_ref = db.reference("public_catalog")
+        if catalog:
+            await db_call(catalog_ref.set, catalog)
+        else:
+            await db_call(catalog_ref.delete)
 
-                migrated += 1
-        
         await update.message.reply_text(
-            f"✔ Перенос завершён.\n"
-            f"📦 Создано записей: {migrated}\n"
-            f"⛔ Пропущено (нет owner_id): {skipped}"
+            f"✔ story_meta пересобрана.\n"
+            f"👤 Пользователей: {users_done}\n"
+            f"📚 Историй: {stories_total}\n"
+            f"🤝 Соавторов в coop_index: {len(coop_index)}\n"
+            f"🌟 Публичных историй в каталоге: {len(catalog)}"
         )
-
     except Exception as e:
-        await update.message.reply_text(f"❌ Ошибка переноса: {e}")
+        logger.error(f"Ошибка пересборки story_meta: {e}")
+        await update.message.reply_text(f"❌ Ошибка пересборки story_meta: {e}")
 
 
 
@@ -2342,7 +3861,7 @@ async def start_interactive_training(update: Update, context: ContextTypes.DEFAU
     # Сообщение "Подождите..."
     wait_message = await query.message.reply_text("⏳ Подождите, копирую обучающие материалы...")
 
-    data = load_data()
+    data = await db_call(load_data)
     users_story = data.get("users_story", {})
     story_maps = data.get("story_maps", {})
 
@@ -2430,7 +3949,7 @@ async def start_interactive_training(update: Update, context: ContextTypes.DEFAU
         
         # --- копируем саму историю (перезапись) ---
         user_story_target[new_sid] = story_data.copy()
-        save_story_data(user_id, new_sid, story_data)
+        await db_call(save_story_data, user_id, new_sid, story_data)
 
         # --- копируем карты ---
         if isinstance(source_maps, dict):
@@ -2442,7 +3961,7 @@ async def start_interactive_training(update: Update, context: ContextTypes.DEFAU
                     )
 
     # Сохраняем результат в БД
-    db.reference(f"story_maps/{user_id}").set(user_maps_target)
+    await db_call(db.reference(f"story_maps/{user_id}").set, user_maps_target)
     # Здесь важно не перезатереть secret_key пользователя, поэтому используем .update() для stories
     # Или просто полагаемся на save_story_data внутри цикла, а здесь ничего не делаем.
     # Но так как user_story_target обновлялся в памяти, можно так:
@@ -2497,7 +4016,7 @@ async def transfer_story_command(update: Update, context: ContextTypes.DEFAULT_T
         # ======== Если команда вызвана без аргументов → просто показываем список историй ========
         if not context.args:
             # Загружаем с проверкой
-            raw_stories = user_000_ref.get() or {}
+            raw_stories = await db_call(user_000_ref.get) or {}
             user_stories = {k: v for k, v in raw_stories.items() if isinstance(v, dict)}
 
             if not user_stories:
@@ -2534,16 +4053,16 @@ async def transfer_story_command(update: Update, context: ContextTypes.DEFAULT_T
         source_content = None
 
         index_ref = db.reference(f'stories_index/{target_story_id}')
-        index_data = index_ref.get()
+        index_data = await db_call(index_ref.get)
 
         if index_data and 'owner_id' in index_data:
             source_owner_id = index_data['owner_id']
-            source_content = db.reference(f'users_story/{source_owner_id}/{target_story_id}').get()
+            source_content = await db_call(read_story, source_owner_id, target_story_id)
 
         # Fallback-поиск (С ИСПРАВЛЕНИЕМ)
         if not source_content:
             all_users_ref = db.reference('users_story')
-            all_data = all_users_ref.get()
+            all_data = await db_call(all_users_ref.get)
 
             if all_data:
                 for uid, stories in all_data.items():
@@ -2555,7 +4074,7 @@ async def transfer_story_command(update: Update, context: ContextTypes.DEFAULT_T
                         # Проверяем, что это не secret_key или мусор
                         if isinstance(potential_content, dict):
                             source_owner_id = uid
-                            source_content = potential_content
+                            source_content = await db_call(read_story, uid, target_story_id)
                             break
 
         if not source_content:
@@ -2567,7 +4086,7 @@ async def transfer_story_command(update: Update, context: ContextTypes.DEFAULT_T
 
         # ======== Поиск свободного ID у 000 =========
 
-        user_000_shallow = user_000_ref.get(shallow=True)
+        user_000_shallow = await db_call(user_000_ref.get, shallow=True)
         existing_ids = set(user_000_shallow.keys()) if user_000_shallow else set()
 
         new_story_id = None
@@ -2586,13 +4105,14 @@ async def transfer_story_command(update: Update, context: ContextTypes.DEFAULT_T
         new_content = copy.deepcopy(source_content)
         new_content["owner_id"] = target_user_id
 
-        save_story_data(target_user_id, new_story_id, new_content)
+        await db_call(save_story_data, target_user_id, new_story_id, new_content)
         logger.info(f"История {new_story_id} успешно скопирована пользователю 000")
 
         # ======== Генерация WebApp-кнопок ========
 
-        user_stories_full = user_000_ref.get() or {}
-        sorted_story_ids = sorted(user_stories_full.keys())
+        # Нужны только ключи историй: shallow-чтение вместо загрузки всех историй 000
+        user_story_keys = await db_call(user_000_ref.get, shallow=True) or {}
+        sorted_story_ids = sorted(key for key, value in user_story_keys.items() if value is True)
 
         keyboard_rows = [
             [
@@ -2640,7 +4160,6 @@ async def transfer_story_command(update: Update, context: ContextTypes.DEFAULT_T
             pass
 
 #===============================================================        
-STORY_LOCKS = defaultdict(asyncio.Lock)
 
 import logging
 import datetime # Для времени запуска
@@ -2661,7 +4180,7 @@ async def process_choice_effects_to_user_attributes(
     """
     Обрабатывает эффекты: set/modify, в том числе с диапазонами и модификаторами.
     """
-    story_state = load_story_state_from_firebase(inline_message_id)
+    story_state = await db_call(load_story_state_from_firebase, inline_message_id)
 
     # --- привести user_attributes к нижнему регистру ---
     raw_attr = story_state.get("user_attributes", {})
@@ -2769,11 +4288,9 @@ def advanced_replace_attributes(text: str, group_attributes: dict) -> str:
     - диапазоны {{удача: 3-8}}
     - HTML-escape (&gt; &lt;)
     - нечувствителен к регистру
-    """
-    import random
-    from html import unescape
-    import re
 
+    Текст компилируется в токены один раз (story_template, кэш по хэшу содержимого).
+    """
     # --- 1. Нормализация атрибутов ---
     normalized = {}
     for k, v in group_attributes.items():
@@ -2781,69 +4298,13 @@ def advanced_replace_attributes(text: str, group_attributes: dict) -> str:
         normalized.setdefault(key, []).append(v)
 
     def get_max_value(attr: str):
-        values = normalized.get(attr.lower())
+        values = normalized.get(attr)
         return max(values) if values else None
 
-    # --- 2. HTML-unescape внутри {{...}} и {{{...}}} ---
-    def html_unescape_inside(match):
-        inner = match.group(1) if match.group(1) is not None else match.group(2)
-        inner = unescape(inner)
-        # сохраняем тип скобок
-        return "{{{" + inner + "}}}" if match.group(1) else "{{" + inner + "}}"
-
-    text = re.sub(
-        r"\{\{\{(.*?)\}\}\}|\{\{(.*?)\}\}",
-        html_unescape_inside,
-        text,
-        flags=re.DOTALL
-    )
-
-    # --- 3. Логические блоки {{атрибут:>6}}...{{атрибут}} ---
-    ATTR_PATTERN = r"[а-яА-ЯёЁa-zA-Z_]+"  # универсальный шаблон для имени атрибута
-
-    logic_pattern = re.compile(
-        rf"\{{\{{\s*({ATTR_PATTERN})\s*:\s*([<>=])\s*(\d+)"
-        rf"(?:\s*-\s*(\d+))?\s*\}}\}}(.*?)\{{\{{\s*\1\s*\}}\}}",
-        re.DOTALL | re.IGNORECASE
-    )
-
-    def logic_replacer(match):
-        attr_raw = match.group(1)
-        attr = attr_raw.strip().lower()
-        op = match.group(2)
-        num1 = int(match.group(3))
-        num2 = match.group(4)
-        inside_text = match.group(5)
-
-        current_value = get_max_value(attr)
-        if current_value is None:
-            return ""
-
-        check_num = random.randint(min(num1, int(num2)), max(num1, int(num2))) if num2 else num1
-
-        if op == ">":
-            ok = current_value > check_num
-        elif op == "<":
-            ok = current_value < check_num
-        else:  # "="
-            ok = current_value == check_num
-
-        return inside_text if ok else ""
-
-    text = re.sub(logic_pattern, logic_replacer, text)
-
-    # --- 4. Простые подстановки {{{атрибут}}} ---
-    triple_pattern = re.compile(rf"\{{\{{\{{\s*({ATTR_PATTERN})\s*\}}\}}\}}")
+    tokens = template_cache.get(text, "html")
+    text = render_template(tokens, get_max_value, lambda attr_raw: f"({attr_raw}: нет данных)")
 
-    def triple_replacer(match):
-        attr_raw = match.group(1)
-        attr = attr_raw.strip().lower()
-        value = get_max_value(attr)
-        return str(value) if value is not None else f"({attr_raw}: нет данных)"
-
-    text = re.sub(triple_pattern, triple_replacer, text)
-
-    # --- 5. Если результат пуст ---
+    # --- 2. Если результат пуст ---
     if not text.strip():
         return "Нет текста для отображения — условия не выполнены."
 
@@ -2864,6 +4325,13 @@ def deserialize_votes_from_db(votes_data) -> dict:
 
     if isinstance(votes_data, dict):
         for key, user_ids in votes_data.items():
+            # Формат транзакций: {"<user_id>": choice_idx, "_fragment": "..."}
+            if isinstance(user_ids, int) and not isinstance(user_ids, bool):
+                try:
+                    clean_votes.setdefault(user_ids, set()).add(int(key))
+                except (ValueError, TypeError):
+                    pass
+                continue
             try:
                 idx = int(key)
                 logger.debug(f"Обработка голосов: ключ={key}, значение={user_ids}")
@@ -2886,6 +4354,77 @@ def deserialize_votes_from_db(votes_data) -> dict:
 
     return {}
 
+
+def serialize_votes_for_db(votes, fragment_id: str | None) -> dict:
+    """
+    Приводит голоса к формату хранения poll_details/votes:
+        {"<user_id>": choice_idx, ..., "_fragment": fragment_id}
+    Принимает {choice_idx: set(user_ids)} из памяти, старый формат из базы или уже готовый узел.
+    Метка _fragment не даёт запоздалому голосу попасть в голосование следующего фрагмента.
+    """
+    if isinstance(votes, dict) and "_fragment" in votes:
+        return dict(votes)
+    node = {}
+    for choice_idx, user_ids in deserialize_votes_from_db(votes).items():
+        for uid in user_ids:
+            node[str(uid)] = int(choice_idx)
+    if fragment_id:
+        node["_fragment"] = fragment_id
+    return node
+
+
+class PollVoteRejected(Exception):
+    """Голос не записан: already_voted, closed (победитель уже определён) или stale."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+def record_poll_vote(inline_message_id: str, fragment_id: str, user_id: int, choice_idx: int,
+                     required_votes: int) -> tuple[str, dict]:
+    """
+    Записывает голос poll_details/votes/{user_id} = choice_idx транзакцией RTDB.
+    Транзакция повторяется, если узел голосов изменил другой процесс, поэтому
+    проверки «уже голосовал» и «голосование закрыто» атомарны без локальных блокировок.
+
+    Возвращает (status, votes), где votes — {choice_idx: set(user_ids)} после записи:
+        "won"      — этот голос довёл вариант до порога (ровно один на голосование);
+        "accepted" — голос записан, порог не достигнут;
+        "already_voted" / "closed" / "stale" — голос отклонён, votes пуст.
+    """
+    ref = db.reference(f'story_settings/{inline_message_id}/poll_details/votes')
+
+    def apply_vote(current):
+        if not current:
+            raise PollVoteRejected("stale")
+        if isinstance(current, dict) and "_fragment" in current:
+            if current["_fragment"] != fragment_id:
+                raise PollVoteRejected("stale")
+            votes = dict(current)
+        else:
+            # Голосование, начатое до перехода на транзакции
+            votes = serialize_votes_for_db(current, fragment_id)
+
+        tallies = deserialize_votes_from_db(votes)
+        if any(len(voters) >= required_votes for voters in tallies.values()):
+            raise PollVoteRejected("closed")
+        if str(user_id) in votes:
+            raise PollVoteRejected("already_voted")
+
+        votes[str(user_id)] = choice_idx
+        return votes
+
+    try:
+        new_votes = ref.transaction(apply_vote)
+    except PollVoteRejected as e:
+        return e.reason, {}
+
+    tallies = deserialize_votes_from_db(new_votes)
+    status = "won" if len(tallies.get(choice_idx, ())) >= required_votes else "accepted"
+    return status, tallies
+
+
 async def display_fragment_for_interaction(context: CallbackContext, inline_message_id: str, target_user_id_str: str, story_id: str, fragment_id: str):
     """
     Отображает фрагмент истории, обрабатывая текст, медиа и варианты выбора (голосование).
@@ -2894,8 +4433,8 @@ async def display_fragment_for_interaction(context: CallbackContext, inline_mess
     log_prefix = f"[{inline_message_id}][{story_id}][{fragment_id}]"
     logger.info(f"{log_prefix} Отображение фрагмента для пользователя {target_user_id_str}.")
 
-    # --- NEW: загружаем историю напрямую через индекс ---
-    story_definition = load_story_by_id(story_id)
+    # --- NEW: загружаем историю напрямую через индекс (у шардированной — только этот фрагмент) ---
+    _, story_definition = await db_call(load_story_for_play, story_id, [fragment_id])
 
     if not story_definition:
         logger.warning(f"{log_prefix} ❗ История не найдена.")
@@ -2927,7 +4466,7 @@ async def display_fragment_for_interaction(context: CallbackContext, inline_mess
     current_poll_data_from_firebase = None
 
     # Загружаем сохраненное состояние из Firebase
-    story_state_from_firebase = load_story_state_from_firebase(inline_message_id)
+    story_state_from_firebase = await db_call(load_story_state_from_firebase, inline_message_id)
     logger.info(f"===== Данные загружены из firebase: {story_state_from_firebase} ")
     if story_state_from_firebase:
         logger.info(f"{log_prefix} Загружено состояние из Firebase.")
@@ -2940,8 +4479,7 @@ async def display_fragment_for_interaction(context: CallbackContext, inline_mess
         if "poll_details" in story_state_from_firebase and story_state_from_firebase.get("current_fragment_id") == fragment_id:
             poll_details_fb = story_state_from_firebase["poll_details"]
             votes = deserialize_votes_from_db(poll_details_fb.get("votes"))
-            
-            voted_users_list = poll_details_fb.get("voted_users", [])
+            voted_users_list = [uid for voters in votes.values() for uid in voters]
             
             current_poll_data_from_firebase = {
                 "type": "poll",
@@ -2983,7 +4521,7 @@ async def display_fragment_for_interaction(context: CallbackContext, inline_mess
     if len(choices) > 1 and required_votes_for_poll is None:
         logger.error(f"{log_prefix} КРИТИЧЕСКАЯ ОШИБКА: Порог голосов не установлен, но у фрагмента есть варианты выбора.")
         try:
-            await context.bot.edit_message_text(inline_message_id=inline_message_id, text="Ошибка конфигурации голосования: порог не установлен.")
+            await scheduled_edit(context.bot, "edit_message_text", inline_message_id=inline_message_id, text="Ошибка конфигурации голосования: порог не установлен.")
         except Exception as e:
             logger.error(f"{log_prefix} Не удалось отредактировать сообщение об ошибке порога: {e}")
         return
@@ -3005,6 +4543,7 @@ async def display_fragment_for_interaction(context: CallbackContext, inline_mess
         # --- НАЧАЛО ИСПРАВЛЕННОГО БЛОКА ---
     
         poll_data_to_use = context.bot_data.get(inline_message_id)
+        is_new_poll = False
     
         # Шаг 1: Проверяем, актуальны ли данные в оперативной памяти (RAM)
         is_ram_data_valid = (
@@ -3020,10 +4559,11 @@ async def display_fragment_for_interaction(context: CallbackContext, inline_mess
             poll_data_to_use = None # Сбрасываем неактуальные данные
     
             # Шаг 2: Если в RAM данных нет, пытаемся загрузить из Firebase
-            if story_state_from_firebase and "poll_details" in story_state_from_firebase:
+            if (story_state_from_firebase and "poll_details" in story_state_from_firebase
+                    and story_state_from_firebase.get("current_fragment_id") == fragment_id):
                 poll_details_fb = story_state_from_firebase["poll_details"]
                 votes = deserialize_votes_from_db(poll_details_fb.get("votes"))
-                voted_users_list = poll_details_fb.get("voted_users", [])
+                voted_users_list = [uid for voters in votes.values() for uid in voters]
     
                 poll_data_to_use = {
                     "type": "poll",
@@ -3041,6 +4581,7 @@ async def display_fragment_for_interaction(context: CallbackContext, inline_mess
             # Шаг 3: Если нигде данных нет, создаем новое голосование
             if not poll_data_to_use:
                 logger.info(f"{log_prefix} Данные не найдены. Создается новое голосование.")
+                is_new_poll = True
                 poll_data_to_use = {
                     "type": "poll", "target_user_id": target_user_id_str, "story_id": story_id,
                     "current_fragment_id": fragment_id, "choices_data": [],
@@ -3104,21 +4645,23 @@ async def display_fragment_for_interaction(context: CallbackContext, inline_mess
         
         reply_markup = InlineKeyboardMarkup(keyboard)
 
-        # Сохранение актуального состояния голосования в Firebase
-        firebase_save_data = {
-            "story_id": poll_data_to_use["story_id"],
-            "target_user_id": poll_data_to_use["target_user_id"],
-            "current_fragment_id": poll_data_to_use["current_fragment_id"],
-            "required_votes_to_win": poll_data_to_use["required_votes_to_win"],
-            "user_attributes": user_attributes, # Используем атрибуты, определенные ранее в функции
-            "poll_details": {
-                "choices_data": poll_data_to_use["choices_data"],
-                "votes": {str(k): list(v) for k, v in poll_data_to_use["votes"].items()},
-                "voted_users": list(poll_data_to_use["voted_users"]),
-            },
-        }
-        logger.info(f"{firebase_save_data} ===== Сохранение состояния (с данными голосования) в Firebase.")
-        await save_story_state_to_firebase(inline_message_id, firebase_save_data)
+        # Новое голосование сохраняется целиком один раз. Дальше голоса пишет только
+        # record_poll_vote транзакциями, и перезапись poll_details из памяти затёрла бы
+        # голоса, принятые другим процессом
+        if is_new_poll:
+            firebase_save_data = {
+                "story_id": poll_data_to_use["story_id"],
+                "target_user_id": poll_data_to_use["target_user_id"],
+                "current_fragment_id": poll_data_to_use["current_fragment_id"],
+                "required_votes_to_win": poll_data_to_use["required_votes_to_win"],
+                "user_attributes": user_attributes, # Используем атрибуты, определенные ранее в функции
+                "poll_details": {
+                    "choices_data": poll_data_to_use["choices_data"],
+                    "votes": serialize_votes_for_db(poll_data_to_use["votes"], fragment_id),
+                },
+            }
+            logger.info(f"{firebase_save_data} ===== Сохранение состояния (с данными голосования) в Firebase.")
+            await save_story_state_to_firebase(inline_message_id, firebase_save_data)
     
     else: # Нет вариантов выбора (финальный фрагмент или переход)
         caption += "\n\n(История завершена)"
@@ -3152,7 +4695,9 @@ async def display_fragment_for_interaction(context: CallbackContext, inline_mess
     # Если текст не поменялся, а поменялась только клавиатура → обновляем только reply_markup
     if not caption_or_media_changed:
         try:
-            await context.bot.edit_message_reply_markup(
+            # Через планировщик: при частых голосах уйдёт только последнее состояние счётчиков
+            await scheduled_edit(
+                context.bot, "edit_message_reply_markup",
                 inline_message_id=inline_message_id,
                 reply_markup=reply_markup
             )
@@ -3176,12 +4721,12 @@ async def display_fragment_for_interaction(context: CallbackContext, inline_mess
             elif media_type == "audio": input_media = InputMediaAudio(media=file_id, caption=caption, parse_mode='HTML')
             
             if input_media:
-                await context.bot.edit_message_media(inline_message_id=inline_message_id, media=input_media, reply_markup=reply_markup)
+                await scheduled_edit(context.bot, "edit_message_media", inline_message_id=inline_message_id, media=input_media, reply_markup=reply_markup)
                 msg_cache[inline_message_id] = caption
                 msg_cache[f"{inline_message_id}_media"] = media_id
                 return                
         
-        await context.bot.edit_message_text(inline_message_id=inline_message_id, text=caption, reply_markup=reply_markup, parse_mode='HTML')
+        await scheduled_edit(context.bot, "edit_message_text", inline_message_id=inline_message_id, text=caption, reply_markup=reply_markup, parse_mode='HTML')
         msg_cache[inline_message_id] = caption
         msg_cache[f"{inline_message_id}_media"] = media_id
     except Exception as e:
@@ -3388,7 +4933,8 @@ async def end_poll_and_proceed(context: CallbackContext, inline_message_id: str,
 
             delay_seconds = 10
             winner_message_text += f"\n\n<i>Продолжение через {delay_seconds} секунд...</i>"
-            await context.bot.edit_message_text(
+            await scheduled_edit(
+                context.bot, "edit_message_text",
                 inline_message_id=inline_message_id,
                 text=winner_message_text,
                 reply_markup=None,
@@ -3406,7 +4952,7 @@ async def end_poll_and_proceed(context: CallbackContext, inline_message_id: str,
     logger.info(f"[{inline_message_id}] Голосование успешно завершено, переход к следующему фрагменту")
 
     if not story_state:
-        story_state = load_story_state_from_firebase(inline_message_id)
+        story_state = await db_call(load_story_state_from_firebase, inline_message_id)
         logger.info(f"[{inline_message_id}] Загружено состояние из Firebase")
 
     if story_state:
@@ -3419,7 +4965,8 @@ async def end_poll_and_proceed(context: CallbackContext, inline_message_id: str,
         if required_votes_to_win > 1 or winning_effects:
             delay_seconds = 5
             winner_message_text += f"\n\n<i>Продолжение через {delay_seconds} секунд...</i>"
-            await context.bot.edit_message_text(
+            await scheduled_edit(
+                context.bot, "edit_message_text",
                 inline_message_id=inline_message_id,
                 text=winner_message_text,
                 reply_markup=None,
@@ -3436,208 +4983,144 @@ async def end_poll_and_proceed(context: CallbackContext, inline_message_id: str,
         logger.info(f"[{inline_message_id}] История завершена — нет следующего фрагмента")
         final_text = winner_message_text + "\n\nИстория завершена."
         try:
-            await context.bot.edit_message_text(
+            await scheduled_edit(
+                context.bot, "edit_message_text",
                 inline_message_id=inline_message_id,
                 text=final_text,
                 reply_markup=None
             )
-            db.reference(f'story_settings/{inline_message_id}').delete()
+            await db_call(db.reference(f'story_settings/{inline_message_id}').delete)
             logger.info(f"[{inline_message_id}] Очистка настроек истории завершена")
         except Exception as e:
             logger.info(f"[{inline_message_id}] ❌ Ошибка при завершении истории: {e}")
-        
-        # --- NEW: Очистка лока после полного завершения истории ---
-        if inline_message_id in STORY_LOCKS:
-            del STORY_LOCKS[inline_message_id]
+
 
 
 
 
 async def handle_poll_vote(update: Update, context: CallbackContext):
+    """
+    Принимает голос в групповом голосовании.
+    Голос записывается транзакцией record_poll_vote, и победитель определяется по её
+    результату, поэтому подсчёт корректен и при нескольких процессах бота.
+    """
     query = update.callback_query
     if not query or not query.data or not query.inline_message_id:
         return
 
-    # --- NEW: Получаем ID сообщения заранее для блокировки ---
-    # Нам нужно вытащить inline_message_id, чтобы взять правильный замок
-    current_inline_msg_id = query.inline_message_id
-    
-    # Получаем лок для ЭТОГО КОНКРЕТНОГО сообщения
-    lock = STORY_LOCKS[current_inline_msg_id]
-
-    # --- NEW: Входим в режим блокировки ---
-    # Пока один пользователь голосует, остальные ждут на этой строчке
-    async with lock:
-        try:
-            parts = query.data.rsplit("_", 1)
-            if len(parts) != 2:
-                await query.answer("Ошибка формата.", show_alert=True)
-                logger.info("Прервано: некорректный формат callback_data.")
-                return
-
-            callback_prefix_and_msg_id = parts[0]
-            choice_idx_str = parts[1]
-
-            vote_parts = callback_prefix_and_msg_id.split("_", 1)
-            if len(vote_parts) != 2 or vote_parts[0] != "vote":
-                await query.answer("Ошибка формата callback (prefix).", show_alert=True)
-                logger.info("Прервано: неверный префикс callback_data.")
-                return
-
-            inline_msg_id_from_cb = vote_parts[1]
-            if inline_msg_id_from_cb != query.inline_message_id:
-                await query.answer("Ошибка идентификатора.", show_alert=True)
-                logger.info(f"Прервано: inline_message_id не совпадает. Из callback: {inline_msg_id_from_cb}, из запроса: {query.inline_message_id}")
-                return
-
-            choice_idx = int(choice_idx_str)
-            user_id = query.from_user.id
-
-            poll_data = context.bot_data.get(query.inline_message_id)
-
-            # --- ВАЖНО: Внутри блока lock мы работаем как обычно, 
-            # но теперь мы уверены, что никто другой не меняет context.bot_data параллельно ---
-
-            if not poll_data or poll_data.get("type") != "poll":
-                logger.info(f"Данные голосования для {query.inline_message_id} не найдены в памяти. Загружаем из Firebase.")
-                story_state_from_firebase = load_story_state_from_firebase(query.inline_message_id)
-
-                if not story_state_from_firebase or "poll_details" not in story_state_from_firebase:
-                    await query.answer("Голосование не найдено, завершено или неактуально.", show_alert=True)
-                    logger.info(f"Firebase: голосование {query.inline_message_id} не найдено или завершено.")
-                    return
-
-                current_fragment_id_fb = story_state_from_firebase.get("current_fragment_id")
-                poll_details_fb = story_state_from_firebase["poll_details"]
-
-                votes_raw = poll_details_fb.get("votes")
-                votes_dict = deserialize_votes_from_db(votes_raw)
+    try:
+        parts = query.data.rsplit("_", 1)
+        if len(parts) != 2:
+            await query.answer("Ошибка формата.", show_alert=True)
+            logger.info("Прервано: некорректный формат callback_data.")
+            return
 
-                all_voted_in_votes = set(uid for vote_list in votes_dict.values() for uid in vote_list)
-                voted_users_list = poll_details_fb.get("voted_users", [])
-                cleaned_voted_users = [uid for uid in voted_users_list if uid in all_voted_in_votes]
+        callback_prefix_and_msg_id = parts[0]
+        choice_idx_str = parts[1]
 
-                rehydrated_poll_data = {
-                    "type": "poll",
-                    "target_user_id": story_state_from_firebase["target_user_id"],
-                    "story_id": story_state_from_firebase["story_id"],
-                    "current_fragment_id": current_fragment_id_fb,
-                    "choices_data": poll_details_fb.get("choices_data", []),
-                    "votes": votes_dict,
-                    "voted_users": set(cleaned_voted_users),
-                    "required_votes_to_win": story_state_from_firebase["required_votes_to_win"],
-                    "user_attributes": story_state_from_firebase.get("user_attributes", {}),
-                }
+        vote_parts = callback_prefix_and_msg_id.split("_", 1)
+        if len(vote_parts) != 2 or vote_parts[0] != "vote":
+            await query.answer("Ошибка формата callback (prefix).", show_alert=True)
+            logger.info("Прервано: неверный префикс callback_data.")
+            return
 
-                # Дополнительная проверка на случай рассинхрона
-                if poll_data and current_fragment_id_fb != poll_data.get("current_fragment_id"):
-                    await query.answer("Голосование не найдено, завершено или неактуально.", show_alert=True)
-                    logger.info("Прервано: fragment_id из Firebase не совпадает с текущим.")
-                    return
+        inline_msg_id_from_cb = vote_parts[1]
+        if inline_msg_id_from_cb != query.inline_message_id:
+            await query.answer("Ошибка идентификатора.", show_alert=True)
+            logger.info(f"Прервано: inline_message_id не совпадает. Из callback: {inline_msg_id_from_cb}, из запроса: {query.inline_message_id}")
+            return
 
-                context.bot_data[query.inline_message_id] = rehydrated_poll_data
-                poll_data = rehydrated_poll_data
-                logger.info(f"Голосование восстановлено из Firebase: {query.inline_message_id}")
+        choice_idx = int(choice_idx_str)
+        user_id = query.from_user.id
 
-            # Синхронизация данных
-            votes_dict = poll_data.get("votes", {})
-            voted_users_set = poll_data.get("voted_users", set())
-            all_voted_in_votes = set(uid for vote_list in votes_dict.values() for uid in vote_list)
-            cleaned_voted_users = voted_users_set.intersection(all_voted_in_votes)
-            poll_data["voted_users"] = cleaned_voted_users
+        poll_data = context.bot_data.get(query.inline_message_id)
 
-            if not poll_data or poll_data.get("type") != "poll":
-                await query.answer("Голосование не найдено или завершено.", show_alert=True)
-                logger.info("Прервано: poll_data отсутствует или некорректно.")
-                return
+        if not poll_data or poll_data.get("type") != "poll":
+            logger.info(f"Данные голосования для {query.inline_message_id} не найдены в памяти. Загружаем из Firebase.")
+            story_state_from_firebase = await db_call(load_story_state_from_firebase, query.inline_message_id)
 
-            # Проверка голоса - теперь она 100% надежна благодаря lock
-            if user_id in poll_data["voted_users"]:
-                await query.answer("Вы уже голосовали.", show_alert=True)
-                logger.info(f"Пользователь {user_id} уже голосовал.")
+            if not story_state_from_firebase or "poll_details" not in story_state_from_firebase:
+                await query.answer("Голосование не найдено, завершено или неактуально.", show_alert=True)
+                logger.info(f"Firebase: голосование {query.inline_message_id} не найдено или завершено.")
                 return
 
-            if choice_idx < 0 or choice_idx >= len(poll_data["choices_data"]):
-                await query.answer("Некорректный вариант выбора.", show_alert=True)
-                logger.info(f"Некорректный индекс выбора: {choice_idx}")
-                return
+            poll_details_fb = story_state_from_firebase["poll_details"]
+            votes_dict = deserialize_votes_from_db(poll_details_fb.get("votes"))
 
-            # Нормализация структуры голосов
-            votes = poll_data.get("votes")
-            if not isinstance(votes, dict):
-                if isinstance(votes, list):
-                    votes = {
-                        idx: set(user_ids if isinstance(user_ids, list) else [user_ids])
-                        for idx, user_ids in enumerate(votes)
-                    }
-                else:
-                    votes = {}
-            else:
-                votes = {
-                    idx: set(user_ids if isinstance(user_ids, (list, set)) else [user_ids])
-                    for idx, user_ids in votes.items()
-                }
+            poll_data = {
+                "type": "poll",
+                "target_user_id": story_state_from_firebase["target_user_id"],
+                "story_id": story_state_from_firebase["story_id"],
+                "current_fragment_id": story_state_from_firebase.get("current_fragment_id"),
+                "choices_data": poll_details_fb.get("choices_data", []),
+                "votes": votes_dict,
+                "voted_users": {uid for voters in votes_dict.values() for uid in voters},
+                "required_votes_to_win": story_state_from_firebase["required_votes_to_win"],
+                "user_attributes": story_state_from_firebase.get("user_attributes", {}),
+            }
+            context.bot_data[query.inline_message_id] = poll_data
+            logger.info(f"Голосование восстановлено из Firebase: {query.inline_message_id}")
 
-            poll_data["votes"] = votes
-            poll_data["votes"].setdefault(choice_idx, set()).add(user_id)
+        if choice_idx < 0 or choice_idx >= len(poll_data["choices_data"]):
+            await query.answer("Некорректный вариант выбора.", show_alert=True)
+            logger.info(f"Некорректный индекс выбора: {choice_idx}")
+            return
 
-            if not isinstance(poll_data.get("voted_users"), set):
-                poll_data["voted_users"] = set(poll_data.get("voted_users", []))
-            poll_data["voted_users"].add(user_id)
+        required_votes_to_win = poll_data["required_votes_to_win"]
+        status, votes = await db_call(
+            record_poll_vote,
+            query.inline_message_id,
+            poll_data["current_fragment_id"],
+            user_id,
+            choice_idx,
+            required_votes_to_win,
+        )
 
-            # Сохранение в Firebase
-            firebase_save_data = {
-                "story_id": poll_data["story_id"],
-                "target_user_id": poll_data["target_user_id"],
-                "current_fragment_id": poll_data["current_fragment_id"],
-                "required_votes_to_win": poll_data["required_votes_to_win"],
-                "poll_details": {
-                    "choices_data": poll_data["choices_data"],
-                    "votes": poll_data["votes"],
-                    "voted_users": poll_data["voted_users"]
-                },
-                "user_attributes": poll_data["user_attributes"],
-            }
+        if status == "already_voted":
+            await query.answer("Вы уже голосовали.", show_alert=True)
+            logger.info(f"Пользователь {user_id} уже голосовал.")
+            return
+        if status in ("closed", "stale"):
+            await query.answer("Голосование не найдено, завершено или неактуально.", show_alert=True)
+            logger.info(f"Голос {user_id} отклонён ({status}): {query.inline_message_id}")
+            return
 
-            await save_story_state_to_firebase(query.inline_message_id, firebase_save_data)
-            logger.info(f"Голос принят: {query.inline_message_id}, выбор {choice_idx}, пользователь {user_id}")
+        # Счётчики в памяти берутся из результата транзакции — в нём учтены и чужие процессы
+        poll_data["votes"] = votes
+        poll_data["voted_users"] = {uid for voters in votes.values() for uid in voters}
+        logger.info(f"Голос принят: {query.inline_message_id}, выбор {choice_idx}, пользователь {user_id}")
 
-            required_votes_to_win = poll_data["required_votes_to_win"]
-            num_votes_for_current_choice = len(poll_data["votes"][choice_idx])
+        # Проверка победы: "won" получает ровно один голос, доведший вариант до порога
+        if status == "won":
+            if required_votes_to_win > 1:
+                await query.answer(f"Голос принят! Вариант набрал {required_votes_to_win} голосов!", show_alert=False)
+            else:
+                await query.answer()
 
-            # Проверка победы
-            if num_votes_for_current_choice >= required_votes_to_win:
-                if required_votes_to_win > 1:
-                    await query.answer(f"Голос принят! Вариант набрал {required_votes_to_win} голосов!", show_alert=False)
-                else:
-                    await query.answer()
-                
-                logger.info(f"Голосование завершено: {query.inline_message_id}, выбор {choice_idx}")
-                # Вызываем переход. Так как мы внутри "async with lock", 
-                # никто не сможет кликнуть еще раз, пока не завершится переход.
-                await end_poll_and_proceed(context, query.inline_message_id, choice_idx, poll_data)
-                return
+            logger.info(f"Голосование завершено: {query.inline_message_id}, выбор {choice_idx}")
+            await end_poll_and_proceed(context, query.inline_message_id, choice_idx, poll_data)
+            return
 
-            await query.answer("Ваш голос принят!")
-            # Обновляем отображение (клавиатуру с цифрами)
-            await display_fragment_for_interaction(
-                context,
-                inline_message_id=query.inline_message_id,
-                target_user_id_str=poll_data["target_user_id"],
-                story_id=poll_data["story_id"],
-                fragment_id=poll_data["current_fragment_id"]
-            )
+        await query.answer("Ваш голос принят!")
+        # Обновляем отображение (клавиатуру с цифрами)
+        await display_fragment_for_interaction(
+            context,
+            inline_message_id=query.inline_message_id,
+            target_user_id_str=poll_data["target_user_id"],
+            story_id=poll_data["story_id"],
+            fragment_id=poll_data["current_fragment_id"]
+        )
 
-        except ValueError:
-            await query.answer("Неверный выбор (ошибка значения).", show_alert=True)
-            logger.info(f"Ошибка преобразования choice_idx: {query.data}")
-        except Exception as e:
-            logger.info(f"Ошибка в handle_poll_vote: {e}")
-            if query and hasattr(query, 'answer') and not query.answered:
-                try:
-                    await query.answer("Ошибка при голосовании.")
-                except Exception:
-                    pass
+    except ValueError:
+        await query.answer("Неверный выбор (ошибка значения).", show_alert=True)
+        logger.info(f"Ошибка преобразования choice_idx: {query.data}")
+    except Exception as e:
+        logger.info(f"Ошибка в handle_poll_vote: {e}")
+        if query and hasattr(query, 'answer') and not query.answered:
+            try:
+                await query.answer("Ошибка при голосовании.")
+            except Exception:
+                pass
 
 def is_possible_story_id(text: str) -> bool:
     return bool(re.fullmatch(r'[0-9a-f]{10}', text.lower()))
@@ -3647,9 +5130,10 @@ async def inlinequery(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     results = []
     user_id = str(update.inline_query.from_user.id)
     stories_to_show = {}
+    story_owners = {}  # story_id -> owner_id для историй, найденных по ID
     
     def format_story_text(story_id: str, story_data: dict) -> str:
-        title = story_data.get("title", "Без названия")
+        title = story_data.get("title") or "Без названия"
         neural = story_data.get("neural", False)
         author = story_data.get("author", "")
         clean_author = html.escape(author)
@@ -3662,33 +5146,23 @@ async def inlinequery(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         return "\n".join(lines)
 
     if not query_text:
-        # Показываем все истории текущего пользователя
-        # --- ИСПРАВЛЕНИЕ: используем load_all_user_stories, который уже фильтрует ---
-        stories_to_show = load_all_user_stories(user_id)
+        # Показываем все истории текущего пользователя (по story_meta, без фрагментов)
+        stories_to_show = await db_call(load_story_meta_list, user_id)
     else:
         query_text_lower = query_text.lower()
         is_id_search = is_possible_story_id(query_text_lower)
 
         if is_id_search:
-            # Поиск по всем историям всех пользователей только по ID
-            all_users_data = db.reference('users_story').get() or {}
-            for uid, user_stories_dict in all_users_data.items():
-                if not isinstance(user_stories_dict, dict):
-                    continue
-                
-                if query_text_lower in user_stories_dict:
-                    found_story = user_stories_dict[query_text_lower]
-                    # Проверяем, что это словарь, а не ключ
-                    if isinstance(found_story, dict):
-                        stories_to_show[query_text_lower] = found_story
-                        break  # Нашли — достаточно
+            # Поиск по ID через stories_index; обход всех пользователей (heal) для inline-запроса слишком дорог
+            found_owner, found_story = await db_call(load_story_with_owner, query_text_lower, heal=False)
+            if found_story:
+                stories_to_show[query_text_lower] = found_story
+                story_owners[query_text_lower] = found_owner
         else:
             # Поиск по заголовкам только среди историй текущего пользователя
-            # Используем загрузку с фильтрацией
-            user_stories = load_all_user_stories(user_id)
+            user_stories = await db_call(load_story_meta_list, user_id)
             for story_id_key, story_content in user_stories.items():
-                # story_content уже точно dict благодаря load_all_user_stories
-                title = story_content.get("title", "").lower()
+                title = (story_content.get("title") or "").lower()
                 if query_text_lower in title:
                     stories_to_show[story_id_key] = story_content
 
@@ -3698,13 +5172,7 @@ async def inlinequery(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             continue
 
         # Определяем владельца (нужно только если поиск был по ID)
-        owner_user_id_for_story = user_id
-        if is_possible_story_id(query_text):
-            all_users_data = db.reference('users_story').get() or {}
-            for uid, user_stories_dict in all_users_data.items():
-                if isinstance(user_stories_dict, dict) and story_id in user_stories_dict:
-                    owner_user_id_for_story = uid
-                    break
+        owner_user_id_for_story = story_owners.get(story_id, user_id)
 
         buttons = InlineKeyboardMarkup([
             [InlineKeyboardButton("▶️ Настроить и играть здесь", callback_data=f"inlineplay_{owner_user_id_for_story}_{story_id}_main_1")],
@@ -3712,7 +5180,7 @@ async def inlinequery(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         ])
         results.append(InlineQueryResultArticle(
             id=str(uuid4()),
-            title=f"История: {story_data.get('title', 'Без названия')}",
+            title=f"История: {story_data.get('title') or 'Без названия'}",
             description=f"Автор: {story_data.get('author', 'Неизвестен')}",
             input_message_content=InputTextMessageContent(format_story_text(story_id, story_data), parse_mode="HTML"),
             reply_markup=buttons
@@ -3784,7 +5252,7 @@ async def receive_coop_user_id(update: Update, context: ContextTypes.DEFAULT_TYP
     keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад к списку историй", callback_data="view_stories")]])
 
     if new_user_id:
-        story_data = load_user_story(user_id_str, story_id)
+        story_data = await db_call(load_user_story, user_id_str, story_id)
         if not story_data:
             await update.message.reply_text(
                 "❌ Не удалось загрузить историю. Возможно, она была удалена.",
@@ -3795,7 +5263,8 @@ async def receive_coop_user_id(update: Update, context: ContextTypes.DEFAULT_TYP
         coop_list = story_data.setdefault("coop_edit", [])
         if new_user_id not in coop_list:
             coop_list.append(new_user_id)
-            save_story_data(user_id_str, story_id, story_data)
+            # coop_edit и coop_index/{new_user_id} пишутся одним update
+            await db_call(save_story_patch, user_id_str, story_id, {"coop_edit": coop_list})
             await update.message.reply_text(
                 f"✅ Пользователь с ID <code>{new_user_id}</code> добавлен для совместного редактирования.",
                 reply_markup=keyboard,
@@ -3887,12 +5356,12 @@ async def receive_coop_user_id_to_remove(update: Update, context: ContextTypes.D
     keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад к списку историй", callback_data="view_stories")]])
 
     if remove_user_id:
-        story_data = load_user_story(user_id_str, story_id)
+        story_data = await db_call(load_user_story, user_id_str, story_id)
 
         coop_list = story_data.setdefault("coop_edit", [])
         if remove_user_id in coop_list:
             coop_list.remove(remove_user_id)
-            save_story_data(user_id_str, story_id, story_data)
+            await db_call(save_story_patch, user_id_str, story_id, {"coop_edit": coop_list})
             await update.message.reply_text(
                 f"✅ Пользователь с ID <code>{remove_user_id}</code> удалён из совместного редактирования.",
                 reply_markup=keyboard,
@@ -3949,7 +5418,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id_str = str(update.effective_user.id)
     
     # --- Проверка глобального ключа ---
-    ensure_global_user_secret(user_id_str)
+    await db_call(ensure_global_user_secret, user_id_str)
     # ---------------------------------------------
 
     message_text = update.message.text.strip() if update.message and update.message.text else ""
@@ -3961,9 +5430,6 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     # Групповой чат: реагировать только на foxstart или ID истории
     if chat_type != "private":
-        all_data = load_data()
-        users_story = all_data.get("users_story", {})
-
         # Проверка: текст == foxstart
         if message_text.lower().startswith("foxstart"):
             keyboard = [
@@ -3978,36 +5444,35 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             return
 
         # Проверка: это ID истории?
-        for uid, stories in users_story.items():
-            if message_text in stories:
-                story_data = stories[message_text]
-                title = story_data.get("title", "Без названия")
-                neural = story_data.get("neural", False)
-                author = story_data.get("author", "неизвестен")
-                
-                # Проверка на WebGame для превью в группе
-                is_webgame = story_data.get("webgame_ready", False)
+        _, story_data = await db_call(load_story_with_owner, message_text, heal=is_indexable_story_key(message_text))
+        if story_data:
+            title = story_data.get("title", "Без названия")
+            neural = story_data.get("neural", False)
+            author = story_data.get("author", "неизвестен")
+            
+            # Проверка на WebGame для превью в группе
+            is_webgame = story_data.get("webgame_ready", False)
 
-                info = f"📖 История: «{title}»\n✍️ Автор: {author}"
-                if neural:
-                    info += " (нейроистория)"
-                if is_webgame:
-                    info += " (WebGame 🎮)"
+            info = f"📖 История: «{title}»\n✍️ Автор: {author}"
+            if neural:
+                info += " (нейроистория)"
+            if is_webgame:
+                info += " (WebGame 🎮)"
 
-                # Если это WebGame, логика кнопки может отличаться, но пока оставляем стандартный запуск, 
-                # который перехватится ниже, если нажмут start
-                suffix = f"{user_id_str}_{message_text}_main_1"
-                callback_data = f"nstartstory_{suffix}"
+            # Если это WebGame, логика кнопки может отличаться, но пока оставляем стандартный запуск, 
+            # который перехватится ниже, если нажмут start
+            suffix = f"{user_id_str}_{message_text}_main_1"
+            callback_data = f"nstartstory_{suffix}"
 
-                keyboard = InlineKeyboardMarkup([
-                    [InlineKeyboardButton("▶️ Открыть", callback_data=callback_data)]
-                ])
-                await update.effective_message.reply_text(
-                    f"🎮 Обнаружена история.\n\n{info}\n\nНажмите кнопку ниже...",
-                    reply_markup=keyboard,
-                    parse_mode=ParseMode.HTML
-                )
-                return
+            keyboard = InlineKeyboardMarkup([
+                [InlineKeyboardButton("▶️ Открыть", callback_data=callback_data)]
+            ])
+            await update.effective_message.reply_text(
+                f"🎮 Обнаружена история.\n\n{info}\n\nНажмите кнопку ниже...",
+                reply_markup=keyboard,
+                parse_mode=ParseMode.HTML
+            )
+            return
         return  # Ни foxstart, ни ID — игнорируем
     else:
         # Приватный чат — любые сообщения могут быть ID истории
@@ -4019,17 +5484,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         story_id_to_start = context.args[0]
         logger.info(f"Пользователь {user_id_str} пытается запустить историю {story_id_to_start} через /start.")
 
-        all_data = load_data()
-        users_story = all_data.get("users_story", {})
-
-        story_data = None
-        story_owner_id = None
-
-        for uid, stories in users_story.items():
-            if story_id_to_start in stories:
-                story_data = stories[story_id_to_start]
-                story_owner_id = uid
-                break
+        story_owner_id, story_data = await db_call(
+            load_story_with_owner, story_id_to_start, heal=is_indexable_story_key(story_id_to_start)
+        )
 
         if story_data:
             # ▼▼▼ НОВАЯ ЛОГИКА ДЛЯ WEBGAME ▼▼▼
@@ -4065,7 +5522,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                         "current_effects": {}
                     }
                     
-                    save_user_story_progress(story_id_to_start, int(user_id_str), initial_progress)
+                    await db_call(save_user_story_progress, story_id_to_start, int(user_id_str), initial_progress)
+                    if story_data.get("public"):
+                        await db_call(record_public_play, story_id_to_start)
                     logger.info(f"Пользователь {user_id_str} запускает историю {story_id_to_start}...")
 
                     placeholder_message = await update.effective_message.reply_text("⏳ Загрузка истории...")
@@ -4073,8 +5532,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                     first_fragment_data = story_data["fragments"].get(first_fragment_id, {})
                     fragment_text_content = first_fragment_data.get("text", "")
 
-                    base_text_for_display = re.split(r"(\[\[[-+]\d+\]\]|\(\([-+]\d+\)\))", fragment_text_content, 1)[0].strip()
-                    edit_steps = parse_timed_edits(fragment_text_content)
+                    edit_plan = timed_edit_plan(fragment_text_content)
+                    base_text_for_display = edit_plan.base_text
+                    edit_steps = edit_plan.steps
 
                     await render_fragment(
                         context=context,
@@ -4099,16 +5559,16 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
             # Если приватный чат — покажем меню
             if chat_type == "private":
-                from firebase_admin import db 
+                from storage import db 
                 
-                ensure_global_user_secret(user_id_str) 
+                await db_call(ensure_global_user_secret, user_id_str) 
                 
                 secret_ref = db.reference(f'users_story/{user_id_str}/secret_key')
-                secret_key = secret_ref.get()
+                secret_key = await db_call(secret_ref.get)
                 
                 if not secret_key:
                     secret_key = generate_secret_key()
-                    secret_ref.set(secret_key)
+                    await db_call(secret_ref.set, secret_key)
 
                 webapp_url = f"https://novel-qg4c.onrender.com/{user_id_str}?secret={secret_key}"
                
@@ -4158,7 +5618,7 @@ async def restart(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id_str = str(user_id) # Сразу приведем к строке
     
     # --- 1. Проверка/Создание ключа ---
-    ensure_global_user_secret(user_id_str)
+    await db_call(ensure_global_user_secret, user_id_str)
     # ----------------------------------
 
     logger.info(f"Пользователь {user_id} вызвал restart (через команду или fallback). Отмена активных задач и очистка user_data.")
@@ -4175,16 +5635,16 @@ async def restart(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data.clear()
 
     # --- 2. Получение ключа для ссылки ---
-    from firebase_admin import db
+    from storage import db
     
     # Получаем ключ
     secret_ref = db.reference(f'users_story/{user_id_str}/secret_key')
-    secret_key = secret_ref.get()
+    secret_key = await db_call(secret_ref.get)
     
     # Фоллбэк: если ключа нет (чего быть не должно из-за ensure_global_user_secret), создаем
     if not secret_key:
         secret_key = generate_secret_key()
-        secret_ref.set(secret_key)
+        await db_call(secret_ref.set, secret_key)
 
     # Добавляем параметр secret в ссылку
     webapp_url = f"https://novel-qg4c.onrender.com/{user_id_str}?secret={secret_key}"
@@ -4306,7 +5766,7 @@ async def handle_delete_fragment_execute(update: Update, context: ContextTypes.D
         # Это нормально, если владелец истории определяется по user_id_str, связанному с story_data.
 
 
-        story_data = load_user_story(user_id_str, story_id)
+        story_data = await db_call(load_user_story, user_id_str, story_id)
         user_id = int(user_id_str)
         owner_id_str = get_owner_id_or_raise(user_id, story_id, story_data)
 
@@ -4370,7 +5830,7 @@ async def handle_delete_fragment_execute(update: Update, context: ContextTypes.D
         if 'current_story' in context.user_data and context.user_data.get('story_id') == story_id:
             context.user_data['current_story'] = story_data
 
-        save_story_data(owner_id_str, story_id, story_data)
+        await db_call(save_story_data, owner_id_str, story_id, story_data)
 
         # --- Генерация и отправка обновленной карты ---
         total_fragments_after_delete = len(all_fragments)
@@ -4559,7 +6019,7 @@ async def handle_delete_fragment_confirm(update: Update, context: ContextTypes.D
         logger.info(f"Parsed story_id: {story_id}, fragment_id: {target_fragment_id}, user_id: {requesting_user_id_str}")
 
 
-        story_data = load_user_story(requesting_user_id_str, story_id)        
+        story_data = await db_call(load_user_story, requesting_user_id_str, story_id)        
         # Определим владельца истории с учётом прав доступа
         user_id = int(requesting_user_id_str)
         owner_id_str = get_owner_id_or_raise(user_id, story_id, story_data)
@@ -5331,140 +6791,156 @@ def build_neuro_fragment_keyboard(user_id_str: str, story_id: str, fragment_ids:
 #==========================================================================
 #СНОВНАЯ ЛОГИКА
 def parse_timed_edits(text):
-    steps = []
-    
-    # Регулярка ищет:
-    # 1. Маркеры времени: [[+1]], ((-1)), [[-5]] и т.д.
-    # 2. HTML теги: <tag>, </tag>
-    token_pattern = re.compile(r"((?:\[\[|\(\()([+-])(\d+)(?:\]\]|\)\)))|(</?(\w+)[^>]*>)")
-    
-    current_text = ""
-    tag_stack = []
-    last_idx = 0
-    
-    for match in token_pattern.finditer(text):
-        # Добавляем обычный текст, который был до найденного токена
-        current_text += text[last_idx:match.start()]
-        last_idx = match.end()
-        
-        # --- Если нашли маркер времени [[...]] ---
-        if match.group(1):
-            mode = match.group(2) # + или -
-            delay = min(int(match.group(3)), 60)
-            
-            # 1. Создаем "снимок" того, что должно быть на экране ВО ВРЕМЯ паузы.
-            # Для валидности HTML закрываем все открытые теги
-            closing_suffix = "".join([f"</{tag}>" for tag in reversed(tag_stack)])
-            step_full_text = current_text + closing_suffix
-            
-            steps.append({
-                "delay": delay,
-                "full_text": step_full_text
-            })
-            
-            # 2. Применяем эффект для СЛЕДУЮЩЕГО куска текста
-            if mode == '-':
-                # Если минус - полностью стираем историю текста и стек тегов
-                current_text = ""
-                tag_stack = []
-            
-            # Если mode == '+', то current_text и tag_stack остаются как есть,
-            # и следующий текст просто добавится к ним.
+    """Кадры пошагового показа текста (см. story_template.compile_timed_edits), из кэша планов."""
+    return timed_edit_plan(text).steps
 
-        # --- Если нашли HTML тег ---
-        elif match.group(4):
-            tag_full = match.group(4)
-            tag_name = match.group(5).lower()
-            
-            is_closing = tag_full.startswith("</")
-            is_void = tag_name in ['br', 'hr', 'img'] 
-            
-            if is_void:
-                current_text += tag_full
-            else:
-                if not is_closing:
-                    # Открывающий тег: добавляем в текст и в стек
-                    current_text += tag_full
-                    tag_stack.append(tag_name)
-                else:
-                    # Закрывающий тег:
-                    # ВАЖНО: Добавляем его, только если он соответствует открытому тегу в стеке.
-                    # Это защищает от ошибок при использовании [[-N]], когда стек очищается, 
-                    # но в исходной строке дальше идет </b>.
-                    if tag_stack and tag_stack[-1] == tag_name:
-                        current_text += tag_full
-                        tag_stack.pop()
-                    else:
-                        # Если тег закрывающий, но стек пуст (или тег не совпадает),
-                        # мы его ПРОПУСКАЕМ, чтобы не отправлять в Telegram невалидный HTML (например "Текст</b>")
-                        pass
 
-    # --- Финальная сборка ---
-    
-    # 1. Добавляем остаток текста после последнего маркера
-    if last_idx < len(text):
-        current_text += text[last_idx:]
-        
-    # 2. Закрываем теги, если какие-то остались открытыми
-    closing_suffix = "".join([f"</{tag}>" for tag in reversed(tag_stack)])
-    final_full_text = current_text + closing_suffix
-
-    # 3. Добавляем финальный шаг (отображение результата)
-    # delay=0 означает, что он применится сразу после окончания предыдущей паузы
-    steps.append({
-        "delay": 0, 
-        "full_text": final_full_text
-    })
-    
-    return steps
 
 
+def auto_timer_key(user_id, story_id: str, chat_id: int) -> tuple:
+    """Ключ таймера авто-перехода в fragment_timers: один на игрока, историю и чат."""
+    return (chat_id, f"auto_{user_id}_{story_id}")
+
+
+def edit_timer_key(user_id, story_id: str, chat_id: int) -> tuple:
+    """Ключ пошагового показа текущего фрагмента: новый фрагмент заменяет показ предыдущего."""
+    return (chat_id, f"edit_{user_id}_{story_id}")
+
+
+# Таймеры прохождения (авто-переходы и пошаговый показ) дублируются в pending_timers/{chat}_{слот}
+# с абсолютным временем срабатывания, чтобы после рестарта их можно было поднять заново
+PENDING_TIMERS_PATH = "pending_timers"
+TIMER_RESTORE_RATE = 20  # Просроченных за время простоя таймеров запускается не больше N в секунду
+
+
+def timer_node(key: tuple) -> str:
+    chat_id, slot = key
+    return f"{chat_id}_{slot}"
+
 
+def persist_timer(key: tuple, record: dict) -> None:
+    db.reference(f"{PENDING_TIMERS_PATH}/{timer_node(key)}").set(record)
 
-async def run_timed_edits(
+
+def drop_persisted_timer(key: tuple) -> None:
+    db.reference(f"{PENDING_TIMERS_PATH}/{timer_node(key)}").delete()
+
+
+# Последняя поставленная запись pending_timers для каждого ключа таймера
+_timer_writes: dict = {}
+
+
+def queue_timer_write(key: tuple, func, *args) -> asyncio.Task:
+    """
+    Запускает запись копии таймера (persist_timer / drop_persisted_timer) в фоне.
+    Записи одного ключа выполняются строго в порядке вызова: удаление, поставленное
+    после сохранения, не обгонит его, даже если короткий таймер сработал раньше,
+    чем база ответила на сохранение.
+    """
+    previous = _timer_writes.get(key)
+
+    async def write():
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await db_call(func, key, *args)
+        except Exception as e:
+            logger.error(f"Не удалось записать таймер {key} в {PENDING_TIMERS_PATH}: {e}")
+        finally:
+            if _timer_writes.get(key) is task:
+                del _timer_writes[key]
+
+    task = asyncio.create_task(write())
+    _timer_writes[key] = task
+    return task
+
+
+async def cancel_fragment_timer(key: tuple) -> bool:
+    """Отменяет таймер в fragment_timers и, если он был, удаляет его сохранённую копию."""
+    if not fragment_timers.cancel(key):
+        return False
+    queue_timer_write(key, drop_persisted_timer)
+    return True
+
+
+async def schedule_timed_edits(
+    bot: Bot,
+    chat_id: int,
+    message_id: int,
+    steps: Sequence[Mapping[str, Any]],
+    is_caption: bool,
+    reply_markup_to_preserve: Optional[InlineKeyboardMarkup],
+    timer_key,
+    clean_markers: bool = False,
+    persist: bool = False,
+) -> None:
+    """
+    Ставит пошаговое редактирование сообщения на колесо таймеров (fragment_timers).
+    Каждая пауза — отдельный таймер под ключом timer_key, а не спящая задача;
+    fragment_timers.cancel(timer_key) останавливает показ.
+    clean_markers — убирать из кадров служебные ##-save-## / ##-checkpoint-##.
+    persist — сохранить показ в pending_timers, чтобы он продолжился после рестарта.
+    """
+    if not steps:
+        return
+    if persist:
+        started = time.time()
+        record = {
+            "kind": "edit",
+            "slot": timer_key[1],
+            "due": started + steps[0].get("delay", 0),
+            "started": started,
+            "chat_id": chat_id,
+            "message_id": message_id,
+            "steps": [dict(step) for step in steps],
+            "is_caption": bool(is_caption),
+            "clean_markers": clean_markers,
+            "reply_markup": reply_markup_to_preserve.to_dict() if reply_markup_to_preserve else None,
+        }
+        # Сохранение ставится в очередь ключа до таймера: удаление копии по окончании показа будет после него
+        queue_timer_write(timer_key, persist_timer, record)
+    fragment_timers.schedule(
+        timer_key, steps[0].get("delay", 0), run_timed_edit_steps,
+        bot, chat_id, message_id, steps, 0, None, is_caption, reply_markup_to_preserve,
+        timer_key, clean_markers, persist,
+    )
+
+
+async def run_timed_edit_steps(
     bot: Bot,
     chat_id: int,
     message_id: int,
-    original_text: str, # Больше не используется для склеивания, но может пригодиться для логов
-    steps: List[Dict],
+    steps: Sequence[Mapping[str, Any]],
+    index: int,
+    last_sent_text: Optional[str],
     is_caption: bool,
     reply_markup_to_preserve: Optional[InlineKeyboardMarkup],
-    task_key_to_manage: str,
+    timer_key,
+    clean_markers: bool,
+    persisted: bool = False,
 ):
     """
-    Выполняет пошаговое редактирование сообщения.
+    Показывает кадр steps[index] (его пауза уже истекла) и следующие кадры без паузы,
+    а на следующую паузу ставит себя же таймером под тем же ключом.
+    Кадр — «текст до паузы»; сообщение уже отправлено с base_text, поэтому сначала ждём, потом обновляем.
+    Когда показ закончился (или сообщение больше нельзя редактировать), сохранённая копия удаляется.
     """
-    # logger.debug(f"Starting run_timed_edits_full for msg {message_id}")
+    while index < len(steps):
+        text_to_send = steps[index].get("full_text", "")
+        if clean_markers:
+            for tag in ("##-save-##", "##-checkpoint-##"):
+                text_to_send = text_to_send.replace(tag, "")
 
-    try:
-        last_sent_text = None
-
-        for i, step in enumerate(steps):
-            delay = step.get("delay", 0)
-            text_to_send = step.get("full_text", "")
-
-            # Защита от отправки пустого текста (Telegram не разрешает)
-            if not text_to_send.strip():
-                text_to_send = " " # Невидимый пробел или просто пробел
-
-            # Ждем указанное время перед тем, как показать ЭТОТ кадр (или следующий?
-            # По логике: "Показать А, подождать N, Показать Б".
-            # Парсер сформировал step так: "Текст ДО паузы", delay=N.
-            # Значит, мы сначала должны убедиться, что "Текст ДО паузы" виден, потом ждать.
-            # Но обычно сообщение уже отправлено с начальным текстом (base_text).
-            # Поэтому мы сначала ждем (чтобы зритель успел прочитать предыдущее), а потом обновляем на НОВОЕ состояние?
-            # ВНИМАНИЕ: Логика [[+N]] обычно значит "появилось это, ждем N, появляется следующее".
-            
-            if delay > 0:
-                await asyncio.sleep(delay)
-            
-            # Если текст не изменился с прошлого шага (например, шаг дублирует начальное состояние), пропускаем запрос к API
-            if text_to_send == last_sent_text:
-                continue
+        # Защита от отправки пустого текста (Telegram не разрешает)
+        if not text_to_send.strip():
+            text_to_send = " "
 
+        # Если текст не изменился с прошлого шага, запрос к API не нужен
+        if text_to_send != last_sent_text:
             try:
                 if is_caption:
-                    await bot.edit_message_caption(
+                    await scheduled_edit(
+                        bot, "edit_message_caption",
                         chat_id=chat_id,
                         message_id=message_id,
                         caption=text_to_send,
@@ -5472,7 +6948,8 @@ async def run_timed_edits(
                         reply_markup=reply_markup_to_preserve,
                     )
                 else:
-                    await bot.edit_message_text(
+                    await scheduled_edit(
+                        bot, "edit_message_text",
                         chat_id=chat_id,
                         message_id=message_id,
                         text=text_to_send,
@@ -5480,27 +6957,25 @@ async def run_timed_edits(
                         reply_markup=reply_markup_to_preserve,
                     )
                 last_sent_text = text_to_send
-
             except BadRequest as e:
-                if "message is not modified" in str(e).lower():
-                    # Это нормально, если текст совпал с тем, что уже есть
-                    last_sent_text = text_to_send
-                    continue
-                if "message to edit not found" in str(e).lower():
-                    # Сообщение удалили, останавливаемся
+                if "message is not modified" not in str(e).lower():
+                    # Сообщение удалили или его уже нельзя редактировать — показ прекращается
                     break
-                # logger.error(f"BadRequest in timed edits: {e}")
-                break
-            except Exception as e:
-                # logger.error(f"Error in timed edits step {i}: {e}")
+                last_sent_text = text_to_send
+            except Exception:
                 break
 
-    except asyncio.CancelledError:
-        pass # Задача была отменена штатно
-        # logger.info(f"Task {task_key_to_manage} cancelled.")
-    except Exception as e:
-        pass
-        # logger.error(f"Unexpected error in run_timed_edits_full: {e}", exc_info=True)
+        index += 1
+        if index < len(steps) and steps[index].get("delay", 0) > 0:
+            fragment_timers.schedule(
+                timer_key, steps[index]["delay"], run_timed_edit_steps,
+                bot, chat_id, message_id, steps, index, last_sent_text,
+                is_caption, reply_markup_to_preserve, timer_key, clean_markers, persisted,
+            )
+            return
+
+    if persisted:
+        queue_timer_write(timer_key, drop_persisted_timer)
 
 
 
@@ -5525,7 +7000,7 @@ async def toggle_story_public_status(update: Update, context: ContextTypes.DEFAU
             )
             return None
 
-        story_data = load_user_story(user_id_from_callback, story_id_from_callback)
+        story_data = await db_call(load_user_story, user_id_from_callback, story_id_from_callback)
 
         if not story_data:
             await context.bot.send_message(chat_id=update.effective_chat.id, text="Ошибка: История не найдена.")
@@ -5541,7 +7016,11 @@ async def toggle_story_public_status(update: Update, context: ContextTypes.DEFAU
             if user.first_name and user.last_name:
                 user_name = f"{user.first_name} {user.last_name}"
             story_data["user_name"] = user_name
-            save_story_data(user_id_from_callback, story_id_from_callback, story_data)
+            # public_catalog обновляется в том же update, что и сама история
+            await db_call(
+                save_story_patch, user_id_from_callback, story_id_from_callback,
+                {"public": True, "user_name": user_name}
+            )
             logger.info(f"История {story_id_from_callback} (user: {user_id_from_callback}) сделана публичной. Автор: {user_name}.")
             await query.answer("✅ История сделана публичной! Теперь её видно в списке общих историй", show_alert=True)
             made_public_now = True
@@ -5549,7 +7028,7 @@ async def toggle_story_public_status(update: Update, context: ContextTypes.DEFAU
 
         elif action_prefix_part == MAKE_PRIVATE_PREFIX and story_data.get("public", False):
             story_data["public"] = False
-            save_story_data(user_id_from_callback, story_id_from_callback, story_data)
+            await db_call(save_story_patch, user_id_from_callback, story_id_from_callback, {"public": False})
             logger.info(f"История {story_id_from_callback} (user: {user_id_from_callback}) убрана из публичных.")
             await query.answer("ℹ️ История убрана из публичных.", show_alert=True)
             action_taken = True
@@ -5605,7 +7084,7 @@ async def download_story_handler(update: Update, context: ContextTypes.DEFAULT_T
 
         # Загружаем историю напрямую по owner_id (user_id_from_callback)
 
-        story_data = load_user_story(user_id_from_callback, story_id_from_callback)
+        story_data = await db_call(load_user_story, user_id_from_callback, story_id_from_callback)
 
 
         if not story_data:
@@ -5665,7 +7144,7 @@ async def toggle_neuro_mode(update: Update, context: ContextTypes.DEFAULT_TYPE)
             await query.answer("Вы не можете изменить режим этой истории. Обратитесь к владельцу истории.", show_alert=True)
             return None
 
-        story_data = load_user_story(user_id_from_callback, story_id_from_callback)
+        story_data = await db_call(load_user_story, user_id_from_callback, story_id_from_callback)
 
         if not story_data:
             await query.answer("Ошибка: История не найдена.", show_alert=True)
@@ -5684,7 +7163,7 @@ async def toggle_neuro_mode(update: Update, context: ContextTypes.DEFAULT_TYPE)
             await query.answer("Режим уже установлен.", show_alert=True)
 
         if changed:
-            save_story_data(user_id_from_callback, story_id_from_callback, story_data)
+            await db_call(save_story_data, user_id_from_callback, story_id_from_callback, story_data)
         else:
             await context.bot.send_message(chat_id=update.effective_chat.id, text="Режим уже находится в нужном состоянии.")
 
@@ -5966,7 +7445,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             logger.info(f"user_id_str {user_id_str}.")   
             logger.info(f"story_id {story_id}.")  
             logger.info(f"fragment_id {fragment_id}.")                               
-            story_data = load_user_story(user_id_str, story_id)
+            story_data = await db_call(load_user_story, user_id_str, story_id)
             logger.info(f"story_data {story_data}.")
         else:
             logger.warning("Неверный формат callback data.")       
@@ -6043,22 +7522,15 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             msg = await query.message.reply_text(base_text, reply_markup=close_button, parse_mode=ParseMode.HTML)
             
             if steps:
-                task_key = f"edit_msg_{msg.chat_id}_{msg.message_id}"
-                # Регистрируем задачу в глобальном словаре (если нужно для отмены)
-                # global active_edit_tasks; active_edit_tasks[task_key] = ... (это делается через asyncio.create_task)
-                
-                task = asyncio.create_task(run_timed_edits(
+                await schedule_timed_edits(
                     bot=context.bot,
                     chat_id=msg.chat_id,
                     message_id=msg.message_id,
-                    original_text=text, # Для логов
                     steps=steps,
                     is_caption=False,
                     reply_markup_to_preserve=close_button,
-                    task_key_to_manage=task_key
-                ))
-                
-                # Сохраняем ссылку на задачу, чтобы run_timed_edits_full мог её удалить из словаря по завершении
+                    timer_key=(msg.chat_id, msg.message_id),
+                )
 
             return
 
@@ -6107,18 +7579,15 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             if steps:
                 # Редактируем caption только у первого сообщения группы
                 target_msg = media_messages[0]
-                task_key = f"edit_msg_{target_msg.chat_id}_{target_msg.message_id}"
-                
-                task = asyncio.create_task(run_timed_edits(
+                await schedule_timed_edits(
                     bot=context.bot,
                     chat_id=target_msg.chat_id,
                     message_id=target_msg.message_id,
-                    original_text=text,
                     steps=steps,
                     is_caption=True,
                     reply_markup_to_preserve=None, # В медиагруппе кнопки не прикрепить к самому медиа
-                    task_key_to_manage=task_key
-                ))
+                    timer_key=(target_msg.chat_id, target_msg.message_id),
+                )
 
 
     elif data.startswith('mapreq_'):
@@ -6134,7 +7603,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         user_id_str = str(update.effective_user.id)
 
         # Загружаем только одну историю пользователя
-        story_data = load_user_story(user_id_str, story_id)
+        story_data = await db_call(load_user_story, user_id_str, story_id)
 
         # Если пользователь не владелец, пытаемся найти владельца
 
@@ -6202,7 +7671,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 
         # Загружаем только нужную историю
-        story_data = load_user_story(user_id_str, story_id)
+        story_data = await db_call(load_user_story, user_id_str, story_id)
 
         # Если не нашли — ищем среди всех пользователей
 
@@ -6244,7 +7713,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             _, _, user_id_str, story_id = data.split('_', 3)
             logger.info(f"Initial edit_story_ callback. User: {user_id_str}, Story: {story_id}")
 
-            story_data = load_user_story(user_id_str, story_id)
+            story_data = await db_call(load_user_story, user_id_str, story_id)
 
             user_id = int(user_id_str)
             owner_id_str = get_owner_id_or_raise(user_id, story_id, story_data)
@@ -6384,7 +7853,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             current_page = int(page)
 
             # Пробуем сначала загрузить историю по user_id_str
-            story_data = load_user_story(user_id_str, story_id)
+            story_data = await db_call(load_user_story, user_id_str, story_id)
             
 
             if not story_data:
@@ -6417,7 +7886,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             _, user_id_str, story_id, page = data.split('_')
             current_page = int(page)
 
-            story_data = load_user_story(user_id_str, story_id)
+            story_data = await db_call(load_user_story, user_id_str, story_id)
             if not story_data:
                 await query.edit_message_text("История не найдена.")
                 return
@@ -6449,7 +7918,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             context.user_data['neuro_fragment_id'] = fragment_id
 
             user_id_str = str(update.effective_user.id)
-            story_data = load_user_story(user_id_str, story_id)
+            story_data = await db_call(load_user_story, user_id_str, story_id)
             if not story_data:
                 await query.edit_message_text("История не найдена.")
                 return None
@@ -6504,7 +7973,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 await query.answer("Ошибка: неверный номер страницы.", show_alert=True)
                 return
 
-            story_data = load_user_story(user_id_str, story_id)
+            story_data = await db_call(load_user_story, user_id_str, story_id)
 
             user_id = int(user_id_str)
             owner_id = get_owner_id_or_raise(user_id, story_id, story_data)
@@ -6614,7 +8083,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
             logging.info(f"user_id_str: {user_id_str}, story_id: {story_id}, current_page: {current_page}")
 
-            story_data = load_user_story(user_id_str, story_id)
+            story_data = await db_call(load_user_story, user_id_str, story_id)
             if not story_data:
                 await query.message.reply_text("История не найдена.")
                 return None
@@ -6884,7 +8353,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
             logger.info(f"Выбор ветки: user_id={user_id_str}, story_id={story_id}, branch_name={branch_name}")
             
-            story_data = load_user_story(user_id_str, story_id)
+            story_data = await db_call(load_user_story, user_id_str, story_id)
 
             if not story_data:
                 await query.edit_message_text("История не найдена.")
@@ -7010,7 +8479,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             story_id, branch_name = payload.split('_', 1)
             user_id_str = str(update.effective_user.id)
 
-            story_data = load_user_story(user_id_str, story_id)
+            story_data = await db_call(load_user_story, user_id_str, story_id)
             if not story_data:
                 await query.answer("История не найдена.", show_alert=True)
                 return None
@@ -7057,7 +8526,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             _, user_id_str, story_id, branch_name, page_str = data.split('_', 4)
             current_page = int(page_str)
 
-            story_data = load_user_story(user_id_str, story_id)
+            story_data = await db_call(load_user_story, user_id_str, story_id)
             if not story_data:
                 await query.edit_message_text("История не найдена.")
                 return None
@@ -7206,17 +8675,20 @@ async def handle_neuralstart_story_callback(update: Update, context: ContextType
 
 
 
-    story_data = load_user_story(user_id, story_id)
+    story_data = await db_call(load_user_story, user_id, story_id)
 
     if not story_data:
         # Пробуем загрузить через fallback-доступ
         logging.info(f"Попытка fallback-загрузки истории {story_id} для пользователя {user_id}")
-        story_data = load_story_by_id_fallback(story_id)
+        story_data = await db_call(load_story_by_id_fallback, story_id)
 
     if not story_data:
         await query.message.reply_text("⚠️ История не найдена.")
         return
 
+    if story_data.get("public") and fragment_id == "main_1":
+        await db_call(record_public_play, story_id)
+
 
 
 
@@ -7299,7 +8771,7 @@ async def neural_story(update: Update, context: ContextTypes.DEFAULT_TYPE, clean
             generated_story["owner_id"] = str(user_id)
             generated_story["story_id"] = story_id
             generated_story["secret_key"] = secret_key  # ← ДОБАВЛЕНО
-            save_story_data(user_id_str, story_id, generated_story)
+            await db_call(save_story_data, user_id_str, story_id, generated_story)
 
             context.user_data['current_story'] = generated_story
             context.user_data['current_fragment_id'] = "1" # Обычно начальный фрагмент
@@ -7383,7 +8855,7 @@ async def neural_full_story(update: Update, context: ContextTypes.DEFAULT_TYPE,
             generated_story["story_id"] = story_id
             generated_story["secret_key"] = secret_key
 
-            save_story_data(user_id_str, story_id, generated_story)
+            await db_call(save_story_data, user_id_str, story_id, generated_story)
 
             context.user_data['current_story'] = generated_story
             context.user_data['current_fragment_id'] = "1" # Обычно начальный фрагмент
@@ -7437,7 +8909,7 @@ async def ask_title_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_id_str = str(user.id)
     
     # --- ДОБАВЛЕНО: Проверка глобального ключа при создании новой истории ---
-    ensure_global_user_secret(user_id_str)
+    await db_call(ensure_global_user_secret, user_id_str)
     title = update.message.text.strip()    
     # # Вариант 2: HTML (самый надежный)
     escaped_title = html.escape(title)
@@ -7465,7 +8937,7 @@ async def ask_title_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     context.user_data['next_choice_index'] = 1
 
     # Сохраняем начальную версию истории
-    save_current_story_from_context(context)
+    await save_story_in_editor(update, context)
 
     keyboard = InlineKeyboardMarkup([
         [InlineKeyboardButton("🌃В Главное Меню🌃", callback_data='restart_callback')]
@@ -7503,7 +8975,7 @@ async def confirm_replace_handler(update: Update, context: ContextTypes.DEFAULT_
             # Обновляем фрагмент
             story_data = context.user_data["current_story"]
             story_data["fragments"][fragment_id] = pending
-            save_current_story_from_context(context)
+            await save_story_in_editor(update, context)
 
             await show_fragment_actions(update, context, fragment_id)
             context.user_data.pop("pending_fragment", None)
@@ -7587,7 +9059,7 @@ async def add_content_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
             }
 
             logger.info(f"Добавлен медиаконтент для фрагмента {fragment_id} истории {context.user_data['story_id']}")
-            save_current_story_from_context(context)
+            await save_story_in_editor(update, context)
 
             if is_editing:
                 await message.reply_text("Фрагмент успешно отредактирован.")
@@ -7671,7 +9143,7 @@ async def add_content_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     }
 
     logger.info(f"Добавлен/обновлен контент для фрагмента {fragment_id} истории {context.user_data['story_id']}")
-    save_current_story_from_context(context)
+    await save_story_in_editor(update, context)
 
     await show_fragment_actions(update, context, fragment_id)
     return ADD_CONTENT
@@ -8069,7 +9541,7 @@ async def handle_new_choice_text(update: Update, context: ContextTypes.DEFAULT_T
     # --- Конец измененной логики ---
     logger.info(f"Текст кнопки во фрагменте '{fragment_id}' (индекс {choice_index_to_edit}) изменен с '{old_text}' на '{new_text}'.")
 
-    save_current_story_from_context(context) # Сохраняем изменения
+    await save_story_in_editor(update, context) # Сохраняем изменения
 
     # Очищаем временные данные из контекста
     context.user_data.pop('editing_choice_fragment_id', None)
@@ -8242,7 +9714,7 @@ async def confirm_delete_choice(update: Update, context: ContextTypes.DEFAULT_TY
         return
 
     fragment["choices"] = new_choices
-    save_current_story_from_context(context)
+    await save_story_in_editor(update, context)
 
     # Проверка на недостижимые фрагменты
     reachable = find_reachable_fragments(fragments, "main_1")
@@ -8303,7 +9775,7 @@ async def show_fragment_actions(update: Update, context: ContextTypes.DEFAULT_TY
 
     # Загрузка всех данных
     # Загружаем историю с учётом coop_edit-доступа
-    story_data = load_user_story(user_id_str, story_id)
+    story_data, story_version = await db_call(load_user_story_versioned, user_id_str, story_id)
 
     if not story_data:
         await update.effective_message.reply_text("У вас нет доступа к просмотру этой истории.")
@@ -8311,6 +9783,7 @@ async def show_fragment_actions(update: Update, context: ContextTypes.DEFAULT_TY
 
     # Сохраняем историю и user_id владельца (если нужно — можно определить его отдельно)
     context.user_data['current_story'] = copy.deepcopy(story_data)
+    remember_story_version(context, story_id, story_version, story_data)
 
     current_fragment = story_data.get("fragments", {}).get(fragment_id)
     if not current_fragment:
@@ -8664,7 +10137,7 @@ async def select_link_target_handler(update: Update, context: ContextTypes.DEFAU
 
 
 
-    story_data = load_user_story(user_id_str, story_id)
+    story_data, story_version = await db_call(load_user_story_versioned, user_id_str, story_id)
 
     if not story_data:
         await update.effective_message.reply_text("У вас нет доступа к просмотру этой истории.")
@@ -8684,6 +10157,7 @@ async def select_link_target_handler(update: Update, context: ContextTypes.DEFAU
     # Убираем использование all_data['users_story'][owner][story_id]
     # Просто сохраняем уже полученный story_data
     context.user_data['current_story'] = story_data
+    remember_story_version(context, story_id, story_version, story_data)
 
     # Обработка выбора фрагмента
     if data.startswith(callback_prefix):
@@ -8732,7 +10206,7 @@ async def select_link_target_handler(update: Update, context: ContextTypes.DEFAU
 
         context.user_data['current_story'] = story_data
         logger.info(f"Добавлена ссылка из '{current_fragment_id}' на '{target_fragment_id}' с текстом '{cleaned_text}' и эффектами {effects}.")
-        save_current_story_from_context(context)
+        await save_story_in_editor(update, context)
         # -----------------------------------------
 
         # Показываем обновленное меню действий
@@ -8792,7 +10266,7 @@ async def ask_link_text_handler(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text("Не удалось определить ID истории.")
         return ConversationHandler.END
 
-    story_data = load_user_story(user_id_str, story_id)
+    story_data, story_version = await db_call(load_user_story_versioned, user_id_str, story_id)
 
     if not story_data:
         await update.message.reply_text("У вас нет доступа к этой истории или она не найдена.")
@@ -8800,6 +10274,7 @@ async def ask_link_text_handler(update: Update, context: ContextTypes.DEFAULT_TY
 
     # Обновляем данные в контексте
     context.user_data['current_story'] = copy.deepcopy(story_data)
+    remember_story_version(context, story_id, story_version, story_data)
     current_fragment_id = context.user_data.get('current_fragment_id')
 
     # Получаем все ID фрагментов, кроме текущего
@@ -9002,7 +10477,7 @@ async def add_content_callback_handler(update: Update, context: ContextTypes.DEF
                 await query.edit_message_text("Вы не можете редактировать эту историю.")
                 return None
 
-            story_data = load_user_story(user_id_str, story_id)
+            story_data = await db_call(load_user_story, user_id_str, story_id)
 
             if not story_data:
                 await query.edit_message_text("История не найдена.")
@@ -9370,7 +10845,7 @@ async def ask_continue_text_handler(update: Update, context: ContextTypes.DEFAUL
     context.user_data['current_fragment_id'] = new_active_fragment_id
     
     # context.user_data.pop('pending_action', None) # Эта логика была специфична для числовых ID и выбора индекса
-    save_current_story_from_context(context) # Убедитесь, что эта функция сохраняет изменения
+    await save_story_in_editor(update, context) # Убедитесь, что эта функция сохраняет изменения
 
     # Получаем текст описания эффектов для отображения пользователю
     extra_descriptions = describe_effects_from_button_text(button_text)
@@ -9474,7 +10949,7 @@ async def ask_branch_text_handler(update: Update, context: ContextTypes.DEFAULT_
 
 
     logger.info(f"Создана ветка: '{current_fragment_id}' --({button_text})--> '{branch_fragment_id}'")
-    save_current_story_from_context(context)
+    await save_story_in_editor(update, context)
 
     # Очистка временных данных
     context.user_data.pop('target_branch_name', None)
@@ -9907,7 +11382,7 @@ async def reorder_choice_execute(update: Update, context: ContextTypes.DEFAULT_T
 
     # Обновляем данные истории — просто сохраняем новый список dict
     context.user_data['current_story']['fragments'][fragment_id]['choices'] = choices_list
-    save_current_story_from_context(context)
+    await save_story_in_editor(update, context)
     logger.info(f"Порядок choices для фрагмента {fragment_id} обновлен.")
 
     # Очищаем временные данные
@@ -10484,32 +11959,28 @@ def generate_branch_map(story_id: str, story_data: dict, branch_name: str, highl
 
 
 async def view_public_stories_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    all_data = load_data()
-    all_stories = all_data.get("users_story", {})
+    # callback_data: public_stories или public_stories_{sort}_{page}
+    query_data = update.callback_query.data if update.callback_query else ""
+    sort, page = "recent", 1
+    match = re.fullmatch(r"public_stories_(\w+?)_(\d+)", query_data)
+    if match and match.group(1) in PUBLIC_CATALOG_SORTS:
+        sort, page = match.group(1), max(1, int(match.group(2)))
 
-    public_stories = []
-    # --- ИСПРАВЛЕНИЕ: Фильтрация на уровне пользователей и историй ---
-    for user_id, user_stories in all_stories.items():
-        if not isinstance(user_stories, dict):
-            continue
-            
-        for story_id, story_data in user_stories.items():
-            # Пропускаем secret_key и прочий мусор
-            if not isinstance(story_data, dict):
-                continue
+    # Одна ограниченная выборка из public_catalog, отсортированная на сервере
+    entries, has_next = await db_call(load_public_catalog_page, sort, page)
 
-            if story_data.get("public") and "user_name" in story_data:
-                title = story_data.get("title", f"История {story_id[:8]}")
-                short_title = title[:25] + ("…" if len(title) > 25 else "")
-                author = story_data["user_name"]
-                public_stories.append((
-                    story_id,
-                    user_id,
-                    short_title,
-                    author
-                ))
+    public_stories = []
+    for story_id, entry in entries:
+        title = entry.get("title") or f"История {story_id[:8]}"
+        short_title = title[:25] + ("…" if len(title) > 25 else "")
+        public_stories.append((
+            story_id,
+            entry["owner_id"],
+            short_title,
+            entry.get("author", "")
+        ))
 
-    if not public_stories:
+    if not public_stories and page == 1:
         await update.callback_query.edit_message_text(
             "Публичных историй пока нет.",
             reply_markup=InlineKeyboardMarkup([
@@ -10530,10 +12001,24 @@ async def view_public_stories_list(update: Update, context: ContextTypes.DEFAULT
             story_button
         ])
 
+    sort_labels = {"recent": "🕒 Новые", "title": "🔤 По названию", "popular": "🔥 Популярные"}
+    keyboard.insert(0, [
+        InlineKeyboardButton(("✅ " if key == sort else "") + label, callback_data=f"public_stories_{key}_1")
+        for key, label in sort_labels.items()
+    ])
+
+    pagination_buttons = []
+    if page > 1:
+        pagination_buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"public_stories_{sort}_{page - 1}"))
+    if has_next:
+        pagination_buttons.append(InlineKeyboardButton("Вперёд ➡️", callback_data=f"public_stories_{sort}_{page + 1}"))
+    if pagination_buttons:
+        keyboard.append(pagination_buttons)
+
     # Добавляем кнопку "Главное меню"
     keyboard.append([InlineKeyboardButton("Главное меню", callback_data="restart_callback")])
 
-    message_text = "Публичные истории:"
+    message_text = f"Публичные истории (стр. {page}):"
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     try:
@@ -10556,7 +12041,7 @@ STORIES_PER_PAGE = 10  # Количество историй на одной с
 
 async def view_stories_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id_str = str(update.effective_user.id)
-    user_stories_dict = load_all_user_stories(user_id_str)  # заменили ручной доступ
+    user_stories_dict = await db_call(load_story_meta_list, user_id_str)  # только story_meta, без фрагментов
 
     query_data = update.callback_query.data if update.callback_query else ""
     is_neural_mode = "neural_stories_page_" in query_data or query_data == "view_neural_stories"
@@ -10568,7 +12053,7 @@ async def view_stories_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if story_data.get("neural")
         ]
     elif is_coop_mode:
-        coop_stories_dict = load_all_coop_stories_with_user(user_id_str)
+        coop_stories_dict = await db_call(load_all_coop_stories_with_user, user_id_str)
         story_items = list(coop_stories_dict.items())
 
     else:
@@ -10640,7 +12125,7 @@ async def view_stories_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     keyboard = []
     for story_id, story_data in current_items:
-        title = story_data.get("title", f"История {story_id[:8]}...")
+        title = story_data.get("title") or f"История {story_id[:8]}..."
         short_title = title[:25] + ("…" if len(title) > 25 else ":")
         play_callback = f"nstartstory_{user_id_str}_{story_id}_main_1"
 
@@ -10730,7 +12215,7 @@ async def delete_all_neural_stories_firebase(update: Update, context: ContextTyp
 
     user_id = str(update.effective_user.id)
     user_stories_ref = db.reference(f'users_story/{user_id}')
-    all_stories = user_stories_ref.get()
+    all_stories = await db_call(user_stories_ref.get)
 
     if not all_stories:
         await update.callback_query.answer("У вас нет историй для удаления.", show_alert=True)
@@ -10743,7 +12228,8 @@ async def delete_all_neural_stories_firebase(update: Update, context: ContextTyp
             continue
             
         if story_data.get("neural"):
-            user_stories_ref.child(story_id).delete()
+            await db_call(user_stories_ref.child(story_id).delete)
+            await db_call(drop_story_index, story_id, user_id)
             deleted_any = True
             logger.info(f"Удалена нейроистория {story_id} пользователя {user_id}")
 
@@ -10770,7 +12256,7 @@ async def confirm_delete_story(update: Update, context: ContextTypes.DEFAULT_TYP
     logger.info(f"user_id_str {user_id_str}.") 
     context.user_data['delete_candidate'] = (user_id_str, story_id)
 
-    story_data = load_user_story(user_id_str, story_id)
+    story_data = await db_call(load_user_story, user_id_str, story_id)
     story_title = story_data.get("title", "Без названия")
 
     keyboard = InlineKeyboardMarkup([
@@ -10913,18 +12399,57 @@ def save_user_story_progress(story_id: str, user_id: int, progress_data: dict) -
     except Exception as e:
         logger.error(f"Ошибка Firebase при сохранении прогресса пользователя story {story_id}, user {user_id}: {e}")
 
-def clear_user_story_complete_progress(story_id: str, user_id: int) -> None:
-    """Полностью стирает данные прохождения истории (fragment_id, current_effects) для пользователя."""
-    try:
-        
-        if not firebase_admin._DEFAULT_APP_NAME:
-            logger.error("Firebase приложение не инициализировано. Невозможно очистить прогресс пользователя.")
+class ProgressTransaction:
+    """
+    Изменения прогресса пользователя за одно нажатие кнопки.
+    Эффекты выбора и новый fragment_id накапливаются в памяти и уходят в базу
+    одной записью в commit(), вместо отдельного set() на каждый эффект.
+    """
+
+    def __init__(self, story_id: str, user_id: int, progress: dict | None = None, reset: bool = False):
+        self.story_id = story_id
+        self.user_id = user_id
+        # reset=True: прогресс начинается заново (main_1), узел перезаписывается целиком
+        self.reset = reset
+        if progress is None:
+            progress = {} if reset else load_user_story_progress(story_id, user_id)
+        self.progress = progress
+        self.progress.setdefault("current_effects", {})
+        self._dirty = reset
+
+    @property
+    def effects(self) -> dict:
+        return self.progress["current_effects"]
+
+    def set_effects(self, effects: dict) -> None:
+        self.progress["current_effects"] = dict(effects)
+        self._dirty = True
+
+    def set_fragment(self, fragment_id: str) -> None:
+        self.progress["fragment_id"] = fragment_id
+        self._dirty = True
+
+    def commit(self) -> None:
+        """Записывает накопленные изменения одним запросом (ничего не делает, если изменений нет)."""
+        if not self._dirty:
             return
-        ref = db.reference(get_user_progress_ref_path(story_id, user_id))
-        ref.delete()
-        logger.info(f"Полностью очищен прогресс для истории {story_id}, пользователя {user_id}.")
-    except Exception as e:
-        logger.error(f"Ошибка Firebase при полной очистке прогресса пользователя story {story_id}, user {user_id}: {e}")
+        try:
+            if not firebase_admin._DEFAULT_APP_NAME:
+                logger.error("Firebase приложение не инициализировано. Невозможно сохранить прогресс пользователя.")
+                return
+            ref = db.reference(get_user_progress_ref_path(self.story_id, self.user_id))
+            if self.reset:
+                ref.set(self.progress)
+            else:
+                ref.update({
+                    "current_effects": self.progress.get("current_effects") or None,
+                    "fragment_id": self.progress.get("fragment_id"),
+                })
+            self._dirty = False
+            self.reset = False
+        except Exception as e:
+            logger.error(f"Ошибка Firebase при сохранении прогресса пользователя story {self.story_id}, user {self.user_id}: {e}")
+
 
 # --- Новые вспомогательные функции для обработки эффектов ---
 
@@ -11044,18 +12569,16 @@ def _parse_effect_value(value_str: str) -> Tuple[str, Optional[str], Optional[Un
             return "invalid", None, None
 
 async def process_choice_effects_on_click(
-    story_id: str,
-    user_id: int,
+    progress: ProgressTransaction,
     effects_list: List[Dict[str, Any]],
     query: 'Update.callback_query' # Используем строку, чтобы избежать прямого импорта
 ) -> Tuple[bool, str, bool]:
     """
     Обрабатывает эффекты при нажатии кнопки выбора.
+    Результаты накапливаются в progress; записывает их вызывающий код через progress.commit().
     Возвращает: (продолжить_переход, текст_уведомления_об_успехе, сигнал_скрыть_кнопку_при_ошибке)
     """
-    user_progress = load_user_story_progress(story_id, user_id)
-    current_effects_data = user_progress.get("current_effects", {})
-    temp_effects_data = dict(current_effects_data)
+    temp_effects_data = dict(progress.effects)
 
     success_alert_parts = []
 
@@ -11116,20 +12639,18 @@ async def process_choice_effects_on_click(
 
             if not check_passed:
                 if hide_effect:
+                    progress.set_effects(temp_effects_data)
                     return False, "", True
                 else:
                     reason = f"Требование: {original_stat_name} {op_char}{final_numeric_val} (тек: {val_for_check})"
                     temp_effects_data[stat_name] = final_numeric_val
-                    user_progress["current_effects"] = temp_effects_data
-                    save_user_story_progress(story_id, user_id, user_progress)                     
+                    progress.set_effects(temp_effects_data)
                     if len(reason) > MAX_ALERT_LENGTH: reason = reason[:MAX_ALERT_LENGTH-3]+"..."
                     await query.answer(text=reason, show_alert=True)
                     return False, "", False
         
         elif final_action_type == "set":
             temp_effects_data[stat_name] = final_numeric_val
-            user_progress["current_effects"] = temp_effects_data
-            save_user_story_progress(story_id, user_id, user_progress)            
             if not hide_effect:
                 success_alert_parts.append(f"▫️Ваш атрибут {original_stat_name} установлен на: {final_numeric_val}")
         
@@ -11143,17 +12664,14 @@ async def process_choice_effects_on_click(
                     base_for_modification = 0
             
             new_val = (base_for_modification + final_numeric_val) if op_char == '+' else (base_for_modification - final_numeric_val)
-            user_progress["current_effects"] = temp_effects_data
-            save_user_story_progress(story_id, user_id, user_progress)          
             temp_effects_data[stat_name] = new_val
             
             if not hide_effect:
                 action_word = "увеличен" if op_char == '+' else "уменьшен"
                 success_alert_parts.append(f"▫️Ваш атрибут {original_stat_name} {action_word} на {abs(final_numeric_val)}")
 
-    # Сохраняем все накопленные изменения в конце
-    user_progress["current_effects"] = temp_effects_data
-    save_user_story_progress(story_id, user_id, user_progress)
+    # Все изменения за нажатие попадают в базу одной записью (progress.commit())
+    progress.set_effects(temp_effects_data)
 
     alert_text = ""
     if success_alert_parts:
@@ -11163,17 +12681,51 @@ async def process_choice_effects_on_click(
     
     return True, alert_text, False
 
+# Сколько раз render_fragment читал прогресс игрока ради проверок кнопок
+RENDER_READ_STATS = {"renders": 0, "reads": 0, "max_reads": 0}
+
+
+class RenderContext:
+    """
+    Снимок прогресса игрока на один вызов render_fragment.
+    Прогресс читается из базы не больше одного раза и только если у какого-то
+    выбора есть эффекты; все проверки видимости считаются по этому снимку.
+    Если вызывающий уже держит актуальный прогресс (show_story_fragment после
+    применения эффектов), он передаётся в конструктор и чтений нет вовсе.
+    """
+
+    def __init__(self, story_id: str, user_id, progress: Optional[Dict[str, Any]] = None):
+        self.story_id = story_id
+        self.user_id = user_id
+        self._progress = progress
+        self.reads = 0
+
+    async def current_effects(self) -> Dict[str, Any]:
+        if self._progress is None:
+            self._progress = await db_call(load_user_story_progress, self.story_id, self.user_id) or {}
+            self.reads += 1
+        return self._progress.get("current_effects", {}) or {}
+
+    async def evaluate_choice(self, effects_list: List[Dict[str, Any]]) -> Tuple[bool, str]:
+        if not effects_list:
+            return True, ""
+        return evaluate_choice_for_display(effects_list, await self.current_effects())
+
+    def record(self) -> None:
+        RENDER_READ_STATS["renders"] += 1
+        RENDER_READ_STATS["reads"] += self.reads
+        RENDER_READ_STATS["max_reads"] = max(RENDER_READ_STATS["max_reads"], self.reads)
+
+
 def evaluate_choice_for_display(
-    story_id: str,
-    user_id: int,
-    effects_list: List[Dict[str, Any]]
+    effects_list: List[Dict[str, Any]],
+    current_effects_data: Dict[str, Any]
 ) -> Tuple[bool, str]:
     """
-    Оценивает эффекты выбора для отображения кнопки (видимость и текст требований).
+    Оценивает эффекты выбора для отображения кнопки (видимость и текст требований)
+    по уже загруженным атрибутам игрока, без обращений к базе.
     Возвращает: (видна_ли_кнопка, текст_требований_для_кнопки)
     """
-    user_progress = load_user_story_progress(story_id, user_id)
-    current_effects_data = user_progress.get("current_effects", {})
     requirement_parts = [] # Части для текста требований (например, "интеллект > 5")
 
     for effect in effects_list:
@@ -11215,6 +12767,10 @@ def evaluate_choice_for_display(
 
 
 
+EFFECT_VALUE_MISSING = "значение не обнаружено в текущей игре"
+EFFECT_TEXT_EMPTY = "Нет текста для отображения в текущем прохождении из-за несоответствия атрибутам."
+
+
 def apply_effect_values(base_text, effects_dict):
     """
     Подставляет значения атрибутов и обрабатывает логические блоки вида
@@ -11223,105 +12779,51 @@ def apply_effect_values(base_text, effects_dict):
     Простые подстановки выполняются ТОЛЬКО через {{{сила}}}.
     Нечувствительно к регистру ({{{СИЛА}}} == сила).
     Поддерживает HTML-экранированные символы (&gt;, &lt;).
+    Текст компилируется в токены один раз (story_template, кэш по хэшу содержимого),
+    рендер — один проход по токенам со значениями из effects_dict.
     """
     logger.info(f"base_text: {base_text}")
     logger.info(f"effects_dict: {effects_dict}")
 
-    text = base_text
-
     # --- 0. Нормализация атрибутов ---
     normalized_effects = {
         str(k).strip().lower(): v
         for k, v in effects_dict.items()
     }
 
-    # --- 1. HTML-декодирование внутри {{...}} и {{{...}}} ---
-    def html_unescape_inside_braces(match):
-        inner = match.group(1) if match.group(1) is not None else match.group(2)
-
-        inner = (inner
-            .replace("&gt;", ">")
-            .replace("&lt;", "<")
-            .replace("&amp;", "&")
-        )
-
-        if match.group(1) is not None:
-            return "{{{" + inner + "}}}"
-        else:
-            return "{{" + inner + "}}"
-
-    text = re.sub(
-        r"\{\{\{(.*?)\}\}\}|\{\{(.*?)\}\}",
-        html_unescape_inside_braces,
-        text,
-        flags=re.DOTALL
-    )
-
-    # --- 2. Логические блоки {{атрибут:>2}}...{{атрибут}} ---
-    logic_pattern = re.compile(
-        r"\{\{\s*([а-яА-ЯёЁa-zA-Z_]+)\s*:\s*([<>=])\s*(\d+)"
-        r"(?:\s*-\s*(\d+))?\s*\}\}(.*?)\{\{\s*\1\s*\}\}",
-        re.DOTALL | re.IGNORECASE
-    )
-
-    def logic_replacer(match):
-        attr_raw = match.group(1)
-        attr = attr_raw.strip().lower()
-        op = match.group(2)
-        num1 = int(match.group(3))
-        num2 = match.group(4)
-        inner_text = match.group(5)
-
-        value = normalized_effects.get(attr)
-        if value is None:
-            logger.debug(f"Нет значения для '{attr_raw}' — блок удалён.")
-            return ""
-
-        check_num = (
-            random.randint(min(num1, int(num2)), max(num1, int(num2)))
-            if num2 else num1
-        )
-
-        if op == ">":
-            result = value > check_num
-        elif op == "<":
-            result = value < check_num
-        elif op == "=":
-            result = value == check_num
-        else:
-            result = False
-
-        logger.debug(f"Проверка {attr} ({value} {op} {check_num}) -> {result}")
-        return inner_text if result else ""
-
-    text = re.sub(logic_pattern, logic_replacer, text)
-
-    # --- 3. Простые подстановки {{{атрибут}}} ---
-    def triple_value_replacer(match):
-        attr_raw = match.group(1)
-        attr = attr_raw.strip().lower()
-
-        value = normalized_effects.get(attr)
-        if value is None:
-            logger.debug(f"Нет значения для '{{{{{{{attr_raw}}}}}}}'")
-            return "значение не обнаружено в текущей игре"
-
-        return str(value)
-
-    text = re.sub(
-        r"\{\{\{\s*([а-яА-ЯёЁa-zA-Z_]+)\s*\}\}\}",
-        triple_value_replacer,
-        text
+    tokens = template_cache.get(base_text, "basic")
+    text = render_template(
+        tokens,
+        normalized_effects.get,
+        lambda attr_raw: EFFECT_VALUE_MISSING,
     )
 
-    # --- 4. Если результат пуст ---
+    # --- 1. Если результат пуст ---
     if not text.strip():
-        return "Нет текста для отображения в текущем прохождении из-за несоответствия атрибутам."
+        return EFFECT_TEXT_EMPTY
 
     logger.info(f"text: {text}")
     return text
 
 
+def timed_edit_plan_with_values(base_text, effects_dict):
+    """
+    План пошагового показа текста фрагмента с подстановкой атрибутов (как apply_effect_values).
+    Разбор кэшируется по исходному тексту, значения подставляются в каждый кадр при показе;
+    броски диапазонов одни на весь показ.
+    """
+    normalized_effects = {
+        str(k).strip().lower(): v
+        for k, v in effects_dict.items()
+    }
+    return render_timed_edits(
+        base_text or "",
+        normalized_effects.get,
+        lambda attr_raw: EFFECT_VALUE_MISSING,
+        EFFECT_TEXT_EMPTY,
+    )
+
+
 # --- Логика создания истории (ConversationHandler) ---
 
 async def show_story_fragment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -11367,26 +12869,20 @@ async def show_story_fragment(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     # --- Отмена активных задач для этой истории и чата ---
     # Отмена таймера авто-перехода
-    auto_timer_key = f"{user_id}_{story_id_from_data}_{chat_id}"
-    if auto_timer_key in active_timers:
-        logger.info(f"User action: Cancelling auto-timer {auto_timer_key}")
-        active_timers[auto_timer_key].cancel()
-        # Удаление из active_timers произойдет в finally блока auto_transition_task
-
-    # Отмена задачи редактирования текста/caption
-    edit_task_key = f"edit_{user_id}_{story_id_from_data}_{chat_id}" # Используем ключ без message_id для отмены "общей" задачи редактирования для этого фрагмента
-    if edit_task_key in active_edit_tasks:
-        logger.info(f"User action: Cancelling timed_edit task {edit_task_key}")
-        active_edit_tasks[edit_task_key].cancel()
-        # Удаление из active_edit_tasks произойдет в finally блока run_timed_edits
+    if await cancel_fragment_timer(auto_timer_key(user_id, story_id_from_data, chat_id)):
+        logger.info(f"User action: Cancelling auto-timer {user_id}_{story_id_from_data}_{chat_id}")
+
+    # Отмена пошагового показа текста/caption (ключ без message_id — "общий" для текущего фрагмента)
+    if await cancel_fragment_timer(edit_timer_key(user_id, story_id_from_data, chat_id)):
+        logger.info(f"User action: Cancelling timed edits {user_id}_{story_id_from_data}_{chat_id}")
 
     context.user_data.pop(f"auto_path_{user_id}_{story_id_from_data}_{chat_id}", None)
 
 
     # --- Загрузка определения истории ---
-    story_data_found = load_story_by_id(story_id_from_data)
+    _, story_data_found = await db_call(load_story_for_play, story_id_from_data, [target_fragment_id_cleaned])
     if not story_data_found:
-        story_data_found = load_story_by_id_fallback(story_id_from_data)
+        story_data_found = await db_call(load_story_by_id_fallback, story_id_from_data)
     
     if not story_data_found:
         logging.info(f"История {story_id_from_data} не найдена даже через fallback.")
@@ -11402,7 +12898,8 @@ async def show_story_fragment(update: Update, context: ContextTypes.DEFAULT_TYPE
     alert_after_effects_processed_text = "" # Сообщение для query.answer после успешной обработки
 
     if target_fragment_id_cleaned == "main_1":
-        clear_user_story_complete_progress(story_id_from_data, actual_user_id)
+        # Прогресс перезаписывается целиком при commit() — это и есть очистка
+        progress = ProgressTransaction(story_id_from_data, actual_user_id, reset=True)
         logger.info(f"Пользователь {actual_user_id} начал/перезапустил историю {story_id_from_data} с main_1. Прогресс очищен.")
         # Для main_1 нет эффектов от *выбора*, т.к. это действие сброса.
         # Уведомление query.answer() не требуется для самого сброса, если только нет спец. сообщения.
@@ -11413,10 +12910,12 @@ async def show_story_fragment(update: Update, context: ContextTypes.DEFAULT_TYPE
         if target_fragment_id_cleaned == "main_912e":
             target_fragment_id_cleaned = "main_1"      
             original_target_fragment_id = "main_1"  
-        user_progress_before_click = load_user_story_progress(story_id_from_data, actual_user_id)
-        source_fragment_id = user_progress_before_click.get("fragment_id")
+        # Прогресс читается один раз за нажатие; все изменения записываются в progress.commit()
+        progress = await db_call(ProgressTransaction, story_id_from_data, actual_user_id)
+        source_fragment_id = progress.progress.get("fragment_id")
 
         if source_fragment_id:
+            await db_call(ensure_play_fragments, story_data_found, [source_fragment_id])
             source_fragment_data = story_data_found.get("fragments", {}).get(source_fragment_id)
             logger.info(f"source_fragment_data: {source_fragment_data}")
             
@@ -11454,12 +12953,12 @@ async def show_story_fragment(update: Update, context: ContextTypes.DEFAULT_TYPE
                 
                 if effects_to_apply_for_choice:
                     proceed, alert_text_success, hide_button_signal = await process_choice_effects_on_click(
-                        story_id_from_data,
-                        actual_user_id,
+                        progress,
                         effects_to_apply_for_choice,
                         query
                     )
                     if not proceed:
+                        await db_call(progress.commit)
                         return
                     alert_after_effects_processed_text = alert_text_success
                 else:
@@ -11481,13 +12980,13 @@ async def show_story_fragment(update: Update, context: ContextTypes.DEFAULT_TYPE
     elif target_fragment_id_cleaned != "main_1" and not source_fragment_id : # если не main_1, но и не смогли обработать эффекты
         pass # query.answer() был вызван ранее, или не требуется
 
-    # Обновляем fragment_id пользователя в Firebase на target_fragment_id
+    # Обновляем fragment_id пользователя на target_fragment_id и записываем
+    # эффекты вместе с ним — одна запись на всё нажатие.
     # Это происходит ПОСЛЕ успешной обработки эффектов, или если это main_1.
-    # Для main_1 это восстанавливает fragment_id после clear_user_story_complete_progress.
-    current_progress_after_effects = load_user_story_progress(story_id_from_data, actual_user_id) # Перезагружаем свежие данные
-    logger.info(f"current_progress_after_effects {current_progress_after_effects}")    
-    current_progress_after_effects["fragment_id"] = target_fragment_id_cleaned
-    save_user_story_progress(story_id_from_data, actual_user_id, current_progress_after_effects)
+    progress.set_fragment(target_fragment_id_cleaned)
+    await db_call(progress.commit)
+    current_progress_after_effects = progress.progress
+    logger.info(f"current_progress_after_effects {current_progress_after_effects}")
     logger.info(f"Пользователь {target_fragment_id_cleaned} теперь на фрагменте {target_fragment_id_cleaned} в истории {story_id_from_data}.")
 
 
@@ -11498,6 +12997,7 @@ async def show_story_fragment(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 
     # --- Загрузка и подготовка контента для *целевого* фрагмента ---
+    await db_call(ensure_play_fragments, story_data_found, [target_fragment_id_cleaned])
     fragments_dict = story_data_found.setdefault("fragments", {})
     target_fragment_data = fragments_dict.get(target_fragment_id_cleaned)
 
@@ -11505,7 +13005,7 @@ async def show_story_fragment(update: Update, context: ContextTypes.DEFAULT_TYPE
         if story_data_found.get("neuro_fragments", False): # Обработка нейро-фрагментов
             logger.info(f"Создание пустого нейро-фрагмента '{target_fragment_id_cleaned}' для истории {story_id_from_data}")
             fragments_dict[target_fragment_id_cleaned] = {"text": "", "media": [], "choices": []}
-            save_story_data(str(story_owner_id), story_id_from_data, story_data_found) # Сохраняем обновленную структуру истории
+            await db_call(save_story_data, str(story_owner_id), story_id_from_data, story_data_found) # Сохраняем обновленную структуру истории
             target_fragment_data = fragments_dict[target_fragment_id_cleaned]
         else:
             logger.error(f"Целевой фрагмент '{target_fragment_id_cleaned}' не найден и не является нейро-фрагментом.")
@@ -11518,15 +13018,14 @@ async def show_story_fragment(update: Update, context: ContextTypes.DEFAULT_TYPE
     # base_text_for_display и edit_steps как в вашем коде
     current_effects = current_progress_after_effects.get("current_effects", {})
 
-    # 1. СНАЧАЛА заменяем все {{тэги}} на значения во всем тексте целиком.
-    # Это позволяет использовать даже динамические таймеры (например: [[+{{delay}}]])
-    text_with_values = apply_effect_values(fragment_text_content, current_effects)
+    # Таймеры разбираются по исходному тексту фрагмента (кэш по его хэшу, общий для всех игроков),
+    # а значения {{...}} подставляются в каждый кадр. Динамические таймеры (например: [[+{{{delay}}}]])
+    # разбираются уже после подстановки (см. story_template.render_timed_edits)
+    edit_plan = timed_edit_plan_with_values(fragment_text_content, current_effects)
+    edit_steps = edit_plan.steps
 
-    # 2. Теперь парсим таймеры из текста, где уже стоят числа/текст вместо {{...}}
-    edit_steps = parse_timed_edits(text_with_values)
-
-    # 3. Базовый текст для первого сообщения берем из обработанного текста (до первого таймера)
-    base_text_for_display = re.split(r"(\[\[[-+]\d+\]\]|\(\([-+]\d+\)\))", text_with_values, 1)[0].strip()
+    # Базовый текст для первого сообщения (до первого таймера), уже со значениями
+    base_text_for_display = edit_plan.base_text
 
     await render_fragment(
         context=context,
@@ -11539,7 +13038,8 @@ async def show_story_fragment(update: Update, context: ContextTypes.DEFAULT_TYPE
         chat_id=message.chat.id,
         current_auto_path=[], 
         base_text_for_display=base_text_for_display,
-        edit_steps_for_text=edit_steps
+        edit_steps_for_text=edit_steps,
+        progress_snapshot=current_progress_after_effects
     )
 
 
@@ -11583,9 +13083,8 @@ async def clean_html_for_telegram_final(html_text: str) -> str:
     return str(soup)
 
 
-# Глобальный словарь для хранения активных таймеров (если хочешь поддерживать несколько одновременно)
-active_timers: Dict[str, asyncio.Task] = {}
-active_edit_tasks: Dict[str, asyncio.Task] = {}
+# Таймеры авто-переходов и пошагового показа живут в fragment_timers (timer_wheel.py),
+# ключи — auto_timer_key / edit_timer_key
 
 async def render_fragment(
     context: ContextTypes.DEFAULT_TYPE,
@@ -11598,7 +13097,8 @@ async def render_fragment(
     chat_id: int,
     current_auto_path: List[str],
     base_text_for_display: str,
-    edit_steps_for_text: List[Dict]
+    edit_steps_for_text: Sequence[Mapping[str, Any]],
+    progress_snapshot: Optional[Dict[str, Any]] = None
 ):
     logger.info(
         "render_fragment called with:\n"
@@ -11612,9 +13112,10 @@ async def render_fragment(
     # Если base_text_for_display пуст, пытаемся его получить из фрагмента (может быть полезно при прямом вызове render_fragment)
     if not base_text_for_display and fragment:
          raw_text = fragment.get("text", "")
-         base_text_for_display = re.split(r"(\[\[[-+]\d+\]\]|\(\([-+]\d+\)\))", raw_text, 1)[0].strip()
+         edit_plan = timed_edit_plan(raw_text)
+         base_text_for_display = edit_plan.base_text
          if not edit_steps_for_text and raw_text: # Пересчитываем edit_steps, если текст изменился
-             edit_steps_for_text = parse_timed_edits(raw_text)
+             edit_steps_for_text = edit_plan.steps
 
     if not fragment or (not fragment.get("text") and not fragment.get("media")):
         if neuro_mode:
@@ -11669,8 +13170,8 @@ async def render_fragment(
                             story_data.setdefault("fragments", {})[fragment_id] = generated_fragment
                     
                     # Сохраняем данные и пытаемся их перезагрузить для актуальности
-                    save_story_data(str(owner_id), story_id, story_data)
-                    new_story_data_local = load_user_story(owner_id, story_id) # load_data должна вернуть актуальные данные
+                    await db_call(save_story_data, str(owner_id), story_id, story_data)
+                    _, new_story_data_local = await db_call(load_story_for_play, story_id, [fragment_id])
 
 
                     if not new_story_data_local:
@@ -11685,8 +13186,9 @@ async def render_fragment(
                     # Предполагаем, что fragment_id это ключ к основному сгенерированному тексту
                     current_generated_frag_data = new_story_data_local.get("fragments", {}).get(fragment_id, {})
                     generated_fragment_text_local = current_generated_frag_data.get("text", "")
-                    base_text_for_display = re.split(r"(\[\[[-+]\d+\]\]|\(\([-+]\d+\)\))", generated_fragment_text_local, 1)[0].strip()
-                    edit_steps = parse_timed_edits(generated_fragment_text_local)
+                    edit_plan = timed_edit_plan(generated_fragment_text_local)
+                    base_text_for_display = edit_plan.base_text
+                    edit_steps = edit_plan.steps
                     try: # Удаляем сообщение "генерируется"
                         await generation_status_message.delete()
                     except Exception: pass
@@ -11775,7 +13277,7 @@ async def render_fragment(
             
             # Запускаем фоновую задачу по переносу данных в базу
             async def background_chapter_transition():
-                perform_next_chapter_transition(user_id, story_id, next_chapter_id)
+                await db_call(perform_next_chapter_transition, user_id, story_id, next_chapter_id)
             
             asyncio.create_task(background_chapter_transition())
     # 2. Очищаем текст внутри шагов анимации (edit_steps), иначе теги вернутся при обновлении
@@ -11790,6 +13292,7 @@ async def render_fragment(
 
 
     target_counter = defaultdict(int)
+    render_ctx = RenderContext(story_id, user_id, progress_snapshot)
 
     for i, choice in enumerate(choices_data):
         text = choice.get("text")
@@ -11807,11 +13310,7 @@ async def render_fragment(
             pass
 
         # Оцениваем видимость кнопки
-        is_button_visible, requirement_text = evaluate_choice_for_display(
-            story_id,
-            user_id,
-            effects
-        )
+        is_button_visible, requirement_text = await render_ctx.evaluate_choice(effects)
         if not is_button_visible:
             continue
 
@@ -11835,7 +13334,8 @@ async def render_fragment(
         button_callback_data = f"play_{user_id}_{story_id}_{target_with_index}"
         inline_buttons.append([InlineKeyboardButton(button_display_text, callback_data=button_callback_data)])
         visible_button_count += 1
-    
+    render_ctx.record()
+
     if is_manual_save_allowed:
         # Добавляем отдельной строкой внизу
         save_callback = f"manual_save_{owner_id}_{story_id}"
@@ -11932,7 +13432,7 @@ async def render_fragment(
     # Важно: Этот ключ должен быть уникальным для текущего активного сообщения с редактированием.
     # Если show_story_fragment отменяет по "общему" ключу, а render_fragment создает по "общему" ключу,
     # то новый render_fragment отменит старую задачу редактирования перед запуском новой.
-    edit_task_key = f"edit_{user_id}_{story_id}_{chat_id}"
+    edit_task_key = edit_timer_key(user_id, story_id, chat_id)
     logger.info(f"final_base_text_for_display------------------------------------------ {final_base_text_for_display}") 
     try:
         if media_content:
@@ -12097,11 +13597,7 @@ async def render_fragment(
 
         if message_to_apply_timed_edits and edit_steps_for_text and len(edit_steps_for_text) > 1:
             
-            # Отменяем предыдущую задачу...
-            if edit_task_key in active_edit_tasks:
-                logger.info(f"render_fragment: Cancelling existing timed_edit task {edit_task_key} before starting new one.")
-                active_edit_tasks[edit_task_key].cancel()
-                # Ожидать завершения не будем, новая задача просто перезапишет или finally старой отработает
+            # Предыдущий показ под тем же ключом fragment_timers.schedule отменит сам
 
             is_caption_edit = (message_to_apply_timed_edits.caption is not None) or \
                               (message_to_apply_timed_edits.photo or \
@@ -12109,23 +13605,19 @@ async def render_fragment(
                                message_to_apply_timed_edits.animation or \
                                message_to_apply_timed_edits.audio) # Если есть медиа, то это caption
 
-            # base_text_for_display уже является текстом без тегов [[...]]
-            # run_timed_edits должен использовать его как основу
-            text_for_timed_run = final_base_text_for_display
             logger.info(f"final_base_text_for_display {final_base_text_for_display}")
 
             logger.info(f"Scheduling timed_edits for msg {message_to_apply_timed_edits.message_id} with key {edit_task_key}. is_caption={is_caption_edit}")
-            active_edit_tasks[edit_task_key] = asyncio.create_task(
-                run_timed_edits_full( # Используем новую функцию
-                    bot=context.bot,
-                    chat_id=chat_id,
-                    message_id=message_to_apply_timed_edits.message_id,
-                    original_text=text_for_timed_run,
-                    steps=edit_steps_for_text,
-                    is_caption=is_caption_edit,
-                    reply_markup_to_preserve=reply_markup,
-                    task_key_to_manage=edit_task_key
-                )
+            await schedule_timed_edits(
+                bot=context.bot,
+                chat_id=chat_id,
+                message_id=message_to_apply_timed_edits.message_id,
+                steps=edit_steps_for_text,
+                is_caption=is_caption_edit,
+                reply_markup_to_preserve=reply_markup,
+                timer_key=edit_task_key,
+                clean_markers=True,
+                persist=True,
             )
     except Exception as e:
         logger.error(f"Error rendering fragment {fragment_id} for user {user_id}: {e}", exc_info=True)
@@ -12150,16 +13642,14 @@ async def render_fragment(
         
         # Запускаем сохранение в фоне, чтобы не тормозить рендер
         async def background_checkpoint():
-            perform_save(user_id, story_id, "checkpoint", str(owner_id), current_story_title)
+            await db_call(perform_save, user_id, story_id, "checkpoint", str(owner_id), current_story_title)
             
         asyncio.create_task(background_checkpoint())
 
 
     # --- 5. Планирование авто-перехода ---
-    auto_timer_key = f"{user_id}_{story_id}_{chat_id}" # Ключ для таймера авто-перехода
-    if auto_timer_key in active_timers: # Отменяем предыдущий таймер авто-перехода (если есть)
-        active_timers[auto_timer_key].cancel()
-        # Удаление произойдет в finally старой задачи
+    auto_key = auto_timer_key(user_id, story_id, chat_id)
+    await cancel_fragment_timer(auto_key) # Отменяем предыдущий таймер авто-перехода (если есть)
 
     if is_auto_transition_planned and auto_transition_target_fragment_id:
         next_auto_path = current_auto_path + [fragment_id]
@@ -12182,21 +13672,37 @@ async def render_fragment(
             message_id_for_timer_to_use = final_message_ids_sent[0]
 
 
-        active_timers[auto_timer_key] = asyncio.create_task(
-            auto_transition_task(
-                context=context,
-                user_id=user_id,
-                owner_id=owner_id,
-                story_id=story_id,
-                target_fragment_id=auto_transition_target_fragment_id,
-                delay_seconds=auto_transition_timer_delay,
-                story_data=story_data, # Передаем полные данные истории
-                chat_id=chat_id,
-                # message_id_to_update_by_timer должен быть ID сообщения, которое будет заменено/отредактировано на "..."
-                # Это может быть то же сообщение, что и для timed_edits
-                message_id_to_update_by_timer=message_id_for_timer_to_use,
-                path_taken_for_auto_transition=next_auto_path
-            )
+        # Копия с абсолютным временем: после рестарта restore_fragment_timers поставит таймер заново.
+        # Пишется в фоне, но в очереди ключа раньше, чем удаление копии при срабатывании таймера
+        queue_timer_write(auto_key, persist_timer, {
+            "kind": "auto",
+            "slot": auto_key[1],
+            "due": time.time() + auto_transition_timer_delay,
+            "delay": auto_transition_timer_delay,
+            "user_id": user_id,
+            "owner_id": owner_id,
+            "story_id": story_id,
+            "target_fragment_id": auto_transition_target_fragment_id,
+            "chat_id": chat_id,
+            "message_id": message_id_for_timer_to_use,
+            "path": next_auto_path,
+        })
+        fragment_timers.schedule(
+            auto_key,
+            auto_transition_timer_delay,
+            auto_transition_task,
+            context=context,
+            user_id=user_id,
+            owner_id=owner_id,
+            story_id=story_id,
+            target_fragment_id=auto_transition_target_fragment_id,
+            delay_seconds=auto_transition_timer_delay,
+            story_data=story_data, # Передаем полные данные истории
+            chat_id=chat_id,
+            # message_id_to_update_by_timer должен быть ID сообщения, которое будет заменено/отредактировано на "..."
+            # Это может быть то же сообщение, что и для timed_edits
+            message_id_to_update_by_timer=message_id_for_timer_to_use,
+            path_taken_for_auto_transition=next_auto_path
         )
     else: # Авто-переход не запланирован
         if not is_auto_transition_planned: # Если это из-за цикла или отсутствия таймера
@@ -12215,28 +13721,28 @@ async def auto_transition_task(
     message_id_to_update_by_timer: Optional[int],
     path_taken_for_auto_transition: List[str]
 ):
-    auto_timer_key = f"{user_id}_{story_id}_{chat_id}" # Ключ для текущей задачи авто-перехода
-    logger.debug(f"Auto-transition task {auto_timer_key} started for {target_fragment_id}, delay {delay_seconds}s.")
+    """
+    Колбэк таймера авто-перехода: fragment_timers вызывает его через delay_seconds
+    после показа фрагмента (ключ auto_timer_key). delay_seconds остаётся для логов.
+    """
+    auto_timer_label = f"{user_id}_{story_id}_{chat_id}"
 
     try:
-        await asyncio.sleep(delay_seconds)
-        # После сна задача могла быть отменена
-        logger.info(f"Auto-Timer fired for {auto_timer_key}. Transitioning to {target_fragment_id}.")
-
-        # --- Отмена активной задачи редактирования для текущего (старого) фрагмента ---
-        # Ключ задачи редактирования, которая могла быть активна для предыдущего фрагмента
-        edit_task_key_to_cancel = f"edit_{user_id}_{story_id}_{chat_id}"
-        if edit_task_key_to_cancel in active_edit_tasks:
-            logger.info(f"Auto-Timer: Cancelling timed_edit task {edit_task_key_to_cancel} before auto-transition.")
-            active_edit_tasks[edit_task_key_to_cancel].cancel()
-            # Удаление из active_edit_tasks произойдет в finally блока run_timed_edits
+        logger.info(f"Auto-Timer fired for {auto_timer_label} after {delay_seconds}s. Transitioning to {target_fragment_id}.")
+        # Сохранённая копия больше не нужна; render_fragment ниже может записать следующий таймер под тем же ключом
+        queue_timer_write(auto_timer_key(user_id, story_id, chat_id), drop_persisted_timer)
+
+        # --- Отмена пошагового показа для текущего (старого) фрагмента ---
+        if await cancel_fragment_timer(edit_timer_key(user_id, story_id, chat_id)):
+            logger.info(f"Auto-Timer: Cancelling timed edits {auto_timer_label} before auto-transition.")
 
         message_for_next_render: Optional[Message] = None
         if message_id_to_update_by_timer:
             try:
                 # Редактируем сообщение на временный текст "..."
                 # Это также "захватывает" объект Message для передачи в render_fragment
-                temp_message = await context.bot.edit_message_text( # или edit_message_caption если это было медиа
+                temp_message = await scheduled_edit( # или edit_message_caption если это было медиа
+                    context.bot, "edit_message_text",
                     chat_id=chat_id,
                     message_id=message_id_to_update_by_timer,
                     text="...",
@@ -12269,6 +13775,7 @@ async def auto_transition_task(
                 return # Прерываем авто-переход
 
         # Получаем данные для нового фрагмента (текст для парсинга timed_edits)
+        await db_call(ensure_play_fragments, story_data, [target_fragment_id])
         target_fragment_data = story_data.get("fragments", {}).get(target_fragment_id)
         if not target_fragment_data:
             logger.error(f"Auto-Timer: Target fragment {target_fragment_id} not found in story_data for story {story_id}.")
@@ -12281,8 +13788,9 @@ async def auto_transition_task(
             return
 
         target_fragment_text_content = target_fragment_data.get("text", "")
-        base_text_for_next_fragment = re.split(r"(\[\[[-+]\d+\]\]|\(\([-+]\d+\)\))", target_fragment_text_content, 1)[0].strip()
-        edit_steps_for_next_fragment = parse_timed_edits(target_fragment_text_content)
+        next_fragment_plan = timed_edit_plan(target_fragment_text_content)
+        base_text_for_next_fragment = next_fragment_plan.base_text
+        edit_steps_for_next_fragment = next_fragment_plan.steps
 
         await render_fragment(
             context=context,
@@ -12298,122 +13806,103 @@ async def auto_transition_task(
             edit_steps_for_text=edit_steps_for_next_fragment
         )
     except asyncio.CancelledError:
-        logger.info(f"Auto-transition task {auto_timer_key} to {target_fragment_id} was cancelled.")
+        logger.info(f"Auto-transition task {auto_timer_label} to {target_fragment_id} was cancelled.")
     except Exception as e:
-        logger.error(f"Error in auto_transition_task ({auto_timer_key} to {target_fragment_id}): {e}", exc_info=True)
+        logger.error(f"Error in auto_transition_task ({auto_timer_label} to {target_fragment_id}): {e}", exc_info=True)
         try:
             await context.bot.send_message(chat_id, "Произошла ошибка во время автоматического перехода.")
         except Exception: # Если даже это не удалось
             pass
-    finally:
-        current_task = asyncio.current_task()
-        if auto_timer_key in active_timers and active_timers[auto_timer_key] is current_task:
-            del active_timers[auto_timer_key]
-            logger.debug(f"Auto-transition task {auto_timer_key} removed from active_timers.")
-        # Другие случаи (перезаписан, не найден) аналогичны run_timed_edits.
 
 
+def _restored_context(application: Application, chat_id: int, user_id) -> CallbackContext:
+    """Контекст, как у хендлера этого пользователя в этом чате (user_data общие с живыми апдейтами)."""
+    return CallbackContext(application, chat_id=chat_id, user_id=int(user_id))
 
-async def run_timed_edits_full(
-    bot: Bot,
-    chat_id: int,
-    message_id: int,
-    original_text: str, # Больше не используется для склеивания, но может пригодиться для логов
-    steps: List[Dict],
-    is_caption: bool,
-    reply_markup_to_preserve: Optional[InlineKeyboardMarkup],
-    task_key_to_manage: str,
-):
-    """
-    Выполняет пошаговое редактирование сообщения.
-    """
-    # logger.debug(f"Starting run_timed_edits_full for msg {message_id}")
-
-    try:
-        last_sent_text = None
-
-        for i, step in enumerate(steps):
-            delay = step.get("delay", 0)
-            text_to_send = step.get("full_text", "")
 
-            # Чистим от служебных маркеров
-            for tag in ("##-save-##", "##-checkpoint-##"):
-                text_to_send = text_to_send.replace(tag, "")
+async def fire_restored_auto_transition(application: Application, record: dict):
+    """Срабатывание поднятого после рестарта авто-перехода: история загружается только сейчас."""
+    story_id = record["story_id"]
+    target_fragment_id = record["target_fragment_id"]
+    _, story_data = await db_call(load_story_for_play, story_id, [target_fragment_id])
+    if not story_data:
+        logger.warning(f"Восстановленный авто-переход: история {story_id} не найдена, таймер отброшен.")
+        queue_timer_write(auto_timer_key(record["user_id"], story_id, record["chat_id"]), drop_persisted_timer)
+        return
+    await auto_transition_task(
+        context=_restored_context(application, record["chat_id"], record["user_id"]),
+        user_id=record["user_id"],
+        story_id=story_id,
+        owner_id=record.get("owner_id"),
+        target_fragment_id=target_fragment_id,
+        delay_seconds=record.get("delay", 0),
+        story_data=story_data,
+        chat_id=record["chat_id"],
+        message_id_to_update_by_timer=record.get("message_id"),
+        path_taken_for_auto_transition=record.get("path") or [],
+    )
 
-            logger.info(f"text_to_send {text_to_send}")
-            logger.info(f"text_to_send {text_to_send}")
-            # Защита от отправки пустого текста (Telegram не разрешает)
-            if not text_to_send.strip():
-                text_to_send = " " # Невидимый пробел или просто пробел
-
-            # Ждем указанное время перед тем, как показать ЭТОТ кадр (или следующий?
-            # По логике: "Показать А, подождать N, Показать Б".
-            # Парсер сформировал step так: "Текст ДО паузы", delay=N.
-            # Значит, мы сначала должны убедиться, что "Текст ДО паузы" виден, потом ждать.
-            # Но обычно сообщение уже отправлено с начальным текстом (base_text).
-            # Поэтому мы сначала ждем (чтобы зритель успел прочитать предыдущее), а потом обновляем на НОВОЕ состояние?
-            # ВНИМАНИЕ: Логика [[+N]] обычно значит "появилось это, ждем N, появляется следующее".
-            
-            if delay > 0:
-                await asyncio.sleep(delay)
-            
-            # Если текст не изменился с прошлого шага (например, шаг дублирует начальное состояние), пропускаем запрос к API
-            if text_to_send == last_sent_text:
-                continue
 
-            try:
-                if is_caption:
-                    await bot.edit_message_caption(
-                        chat_id=chat_id,
-                        message_id=message_id,
-                        caption=text_to_send,
-                        parse_mode=ParseMode.HTML,
-                        reply_markup=reply_markup_to_preserve,
-                    )
-                else:
-                    await bot.edit_message_text(
-                        chat_id=chat_id,
-                        message_id=message_id,
-                        text=text_to_send,
-                        parse_mode=ParseMode.HTML,
-                        reply_markup=reply_markup_to_preserve,
-                    )
-                last_sent_text = text_to_send
+def _restore_timed_edits(application: Application, key: tuple, record: dict, now: float, overdue_delay: float) -> None:
+    """
+    Продолжает пошаговый показ. Кадры, чьё время прошло за простой, не проигрываются
+    по одному: сразу показывается последний из них, дальше — по обычному расписанию.
+    """
+    steps = record.get("steps") or []
+    if not steps:
+        return
+    index, delay = resume_timed_edits(steps, record.get("started", now), now)
+    if delay is None:
+        delay = overdue_delay
+
+    markup = record.get("reply_markup")
+    fragment_timers.schedule(
+        key, delay, run_timed_edit_steps,
+        application.bot, record["chat_id"], record["message_id"], steps, index, None,
+        record.get("is_caption", False),
+        InlineKeyboardMarkup.de_json(markup, application.bot) if markup else None,
+        key, record.get("clean_markers", True), True,
+    )
 
-            except BadRequest as e:
-                if "message is not modified" in str(e).lower():
-                    # Это нормально, если текст совпал с тем, что уже есть
-                    last_sent_text = text_to_send
-                    continue
-                if "message to edit not found" in str(e).lower():
-                    # Сообщение удалили, останавливаемся
-                    break
-                # logger.error(f"BadRequest in timed edits: {e}")
-                break
-            except Exception as e:
-                # logger.error(f"Error in timed edits step {i}: {e}")
-                break
 
-    except asyncio.CancelledError:
-        pass # Задача была отменена штатно
-        # logger.info(f"Task {task_key_to_manage} cancelled.")
+async def restore_fragment_timers(application: Application) -> None:
+    """
+    post_init: поднимает таймеры из pending_timers после рестарта. Таймеры с будущим сроком
+    ставятся на своё время; просроченные срабатывают сразу, но не больше TIMER_RESTORE_RATE
+    в секунду, в порядке срока, чтобы рестарт не выстрелил всеми разом.
+    """
+    try:
+        records = await db_call(db.reference(PENDING_TIMERS_PATH).get) or {}
     except Exception as e:
-        pass
-        # logger.error(f"Unexpected error in run_timed_edits_full: {e}", exc_info=True)
-    finally:
-        # Очистка из глобального словаря
-        global active_edit_tasks
-        current_async_task = asyncio.current_task()
-        if task_key_to_manage in active_edit_tasks and active_edit_tasks[task_key_to_manage] is current_async_task:
-            del active_edit_tasks[task_key_to_manage]
-
-
-
-
-
-
-
+        logger.error(f"Не удалось загрузить сохранённые таймеры: {e}")
+        return
+    if not isinstance(records, dict):
+        return
 
+    now = time.time()
+    restored = overdue = 0
+    for node, record in sorted(records.items(), key=lambda item: item[1].get("due", 0) if isinstance(item[1], dict) else 0):
+        if not isinstance(record, dict) or "chat_id" not in record or "slot" not in record:
+            continue
+        key = (record["chat_id"], record["slot"])
+        overdue_delay = overdue / TIMER_RESTORE_RATE
+        try:
+            if record.get("kind") == "auto":
+                delay = record.get("due", now) - now
+                if delay <= 0:
+                    delay = overdue_delay
+                    overdue += 1
+                fragment_timers.schedule(key, delay, fire_restored_auto_transition, application, record)
+            elif record.get("kind") == "edit":
+                if record.get("due", now) <= now:
+                    overdue += 1
+                _restore_timed_edits(application, key, record, now, overdue_delay)
+            else:
+                continue
+            restored += 1
+        except Exception as e:
+            logger.error(f"Не удалось восстановить таймер {node}: {e}")
+    logger.info(f"Восстановлено таймеров: {restored} (просрочено за время простоя: {overdue})")
 
 
 
@@ -12432,7 +13921,7 @@ async def finish_story_creation(update: Update, context: ContextTypes.DEFAULT_TY
     story_title = story_data.get('title', 'Без названия') if story_data else 'Без названия'
 
     # Финальное сохранение перед очисткой
-    save_current_story_from_context(context)
+    await save_story_in_editor(update, context)
 
     logger.info(f"Завершение создания истории '{story_title}' (ID: {story_id}) пользователем {user_id_str}.")
 
@@ -12604,7 +14093,7 @@ async def generate_gemini_response(query, full_story, current_fragment):
 
 async def generate_gemini_fragment(user_id, story_id, fragment_id):
 
-    story = load_user_story(user_id, story_id)
+    story = await db_call(load_user_story, user_id, story_id)
 
     if not story:
         return "История не найдена."
@@ -12917,7 +14406,7 @@ def main() -> None:
     """Запуск бота."""
 
 
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = Application.builder().token(BOT_TOKEN).post_init(restore_fragment_timers).build()
 
     # Определяем состояния (убедитесь, что все константы импортированы/определены)
     # ASK_TITLE, ADD_CONTENT, ASK_CONTINUE_TEXT, ASK_BRANCH_TEXT, EDIT_STORY_MAP, ASK_LINK_TEXT, SELECT_LINK_TARGET = range(7) # Пример
@@ -13120,7 +14609,7 @@ def main() -> None:
     application.add_handler(CallbackQueryHandler(training_menu, pattern=r"^training_menu$"))    
     #application.add_handler(CallbackQueryHandler(toggle_story_public_status, pattern=f"^{MAKE_PUBLIC_PREFIX}|{MAKE_PRIVATE_PREFIX}"))
     #application.add_handler(CallbackQueryHandler(download_story_handler, pattern=f"^{DOWNLOAD_STORY_PREFIX}"))
-    application.add_handler(CallbackQueryHandler(view_public_stories_list, pattern='^public_stories$'))
+    application.add_handler(CallbackQueryHandler(view_public_stories_list, pattern=r'^public_stories(_\w+_\d+)?$'))
     application.add_handler(CallbackQueryHandler(confirm_delete_all_neural, pattern="^confirm_delete_all_neural$"))
     application.add_handler(CallbackQueryHandler(delete_all_neural_stories_firebase, pattern="^delete_all_neural_confirmed$"))                
     # Добавить сюда обработчик для кнопок вида 'play_{user_id}_start' для запуска просмотра
@@ -13138,15 +14627,28 @@ def main() -> None:
     application.add_handler(CallbackQueryHandler(load_menu_callback, pattern='^menu_'))
 
     
-    application.add_handler(CommandHandler("transfer", transfer_to_index))
+    application.add_handler(CommandHandler(["reindex", "transfer"], backfill_stories_index))
+    application.add_handler(CommandHandler("migrate", migrate_command))
+    application.add_handler(CommandHandler("compress", compress_story_command))
+    application.add_handler(CommandHandler("cachestats", cache_stats_command))
+    application.add_handler(CommandHandler("dbstats", db_stats_command))
+    application.add_handler(CommandHandler("editstats", edit_stats_command))
+    application.add_handler(CommandHandler("timerstats", timer_stats_command))
+    application.add_handler(CommandHandler("rebuildmeta", rebuild_story_meta))
     application.add_handler(CommandHandler("transapp", transfer_story_command))    
     application.add_handler(CallbackQueryHandler(handle_neuralstart_story_callback, pattern=r"^nstartstory_[\w\d]+_[\w\d]+$"))
     application.add_handler(CommandHandler("restart", restart)) 
     application.add_handler(CommandHandler("delete", delete_inline_stories))
+    if application.job_queue:
+        application.job_queue.run_repeating(
+            story_settings_sweep_job, interval=STORY_SETTINGS_SWEEP_INTERVAL, first=60, name="story_settings_sweep"
+        )
+    else:
+        logger.warning("JobQueue недоступна (нужен python-telegram-bot[job-queue]): плановая очистка story_settings отключена.")
     # ⬇️ Важно: обработчик любого текста вне диалога, вызывает start
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, start))
 
-    init_firebase()
+    init_storage()
     keep_alive()#запускаем flask-сервер в отдельном потоке. Подробнее ниже...
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
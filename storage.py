@@ -0,0 +1,438 @@
+"""
+Слой хранения: единая точка получения ссылок на базу.
+
+Код бота и Flask-API обращается к базе через db.reference(path) из этого
+модуля. По умолчанию это Firebase Realtime Database; для локальной работы и
+нагрузочных прогонов без сети бэкенд переключается переменной окружения
+STORAGE_BACKEND:
+
+    firebase — Firebase RTDB (ключ и URL берутся из FIREBASE_KEY_PATH / FIREBASE_DATABASE_URL)
+    sqlite   — локальный файл STORAGE_SQLITE_PATH
+    memory   — SQLite в памяти процесса, данные пропадают при перезапуске
+
+Локальные бэкенды повторяют поведение RTDB, на которое опирается код:
+get(shallow=True), multi-location update(), удаление узла записью None или
+пустого значения, серверные значения {".sv": ...}, transaction(), push(),
+order_by_child()/order_by_key() с limit_to_first/last, start_at, end_at, equal_to.
+
+Как story_cache и db_gateway, это отдельный модуль: novel.py запускается как
+__main__, а background.py импортирует novel повторно, и обе копии должны
+видеть одно и то же хранилище.
+"""
+
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "firebase").lower()
+FIREBASE_KEY_PATH = os.environ.get("FIREBASE_KEY_PATH", "/etc/secrets/firebase-key.json")
+FIREBASE_DATABASE_URL = os.environ.get(
+    "FIREBASE_DATABASE_URL", "https://otlzhka-default-rtdb.europe-west1.firebasedatabase.app/"
+)
+STORAGE_SQLITE_PATH = os.environ.get("STORAGE_SQLITE_PATH", "novel_storage.sqlite3")
+
+
+def _split_path(path: str) -> list:
+    return [segment for segment in (path or "").split("/") if segment]
+
+
+def _join_path(segments) -> str:
+    return "/".join(segments)
+
+
+class LocalStore:
+    """
+    Дерево RTDB, разложенное по листьям: одна строка SQLite на каждое
+    скалярное значение, ключ строки — полный путь ("users_story/1/abc/title").
+    Такое представление само даёт семантику RTDB: пустых узлов не бывает,
+    запись в путь заменяет всё поддерево, а соседние ветки не трогает.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        if path != ":memory:":
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS nodes (path TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    # --- Чтение ---
+
+    def _subtree_rows(self, key: str) -> list:
+        if not key:
+            return self._conn.execute("SELECT path, value FROM nodes").fetchall()
+        # '/' и '0' соседние символы, поэтому [key + '/', key + '0') — ровно потомки key
+        return self._conn.execute(
+            "SELECT path, value FROM nodes WHERE path = ? OR (path >= ? AND path < ?)",
+            (key, key + "/", key + "0"),
+        ).fetchall()
+
+    def get(self, segments: list, shallow: bool = False):
+        key = _join_path(segments)
+        with self._lock:
+            rows = self._subtree_rows(key)
+        if not rows:
+            return None
+
+        prefix_len = len(key) + 1 if key else 0
+        if shallow:
+            result = {}
+            for path, value in rows:
+                if path == key:
+                    return json.loads(value)
+                rest = path[prefix_len:]
+                child, _, tail = rest.partition("/")
+                result[child] = True if tail else json.loads(value)
+            return result
+
+        tree = {}
+        for path, value in rows:
+            if path == key:
+                return json.loads(value)
+            node = tree
+            parts = path[prefix_len:].split("/")
+            for part in parts[:-1]:
+                node = node.setdefault(part, {})
+            node[parts[-1]] = json.loads(value)
+        return _restore_arrays(tree)
+
+    # --- Запись ---
+
+    def apply(self, writes: dict) -> None:
+        """
+        Атомарно применяет {путь: значение}; None или пустой узел удаляет путь.
+        Серверные значения {".sv": ...} разрешаются относительно текущих данных.
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for key, value in writes.items():
+                    segments = _split_path(key)
+                    value = self._resolve_server_values(segments, value)
+                    self._write(segments, value)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _write(self, segments: list, value) -> None:
+        key = _join_path(segments)
+        if key:
+            self._conn.execute(
+                "DELETE FROM nodes WHERE path = ? OR (path >= ? AND path < ?)", (key, key + "/", key + "0")
+            )
+        else:
+            self._conn.execute("DELETE FROM nodes")
+        # Лист-предок больше не может быть листом, раз под ним появились дети
+        if value is not None:
+            ancestors = [_join_path(segments[:i]) for i in range(1, len(segments))]
+            if ancestors:
+                self._conn.executemany("DELETE FROM nodes WHERE path = ?", [(a,) for a in ancestors])
+        leaves = list(_flatten(key, value))
+        if leaves:
+            self._conn.executemany(
+                "INSERT INTO nodes (path, value) VALUES (?, ?)",
+                [(path, json.dumps(leaf, ensure_ascii=False)) for path, leaf in leaves],
+            )
+
+    def _resolve_server_values(self, segments: list, value):
+        if isinstance(value, dict):
+            if ".sv" in value:
+                return self._server_value(segments, value[".sv"])
+            return {k: self._resolve_server_values(segments + [k], v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self._resolve_server_values(segments + [str(i)], v) for i, v in enumerate(value)]
+        return value
+
+    def _server_value(self, segments: list, spec):
+        if spec == "timestamp":
+            return int(time.time() * 1000)
+        if isinstance(spec, dict) and "increment" in spec:
+            current = self.get(segments)
+            delta = spec["increment"]
+            if isinstance(current, (int, float)) and not isinstance(current, bool):
+                return current + delta
+            return delta
+        raise ValueError(f"Неизвестное серверное значение: {spec!r}")
+
+    def transaction(self, segments: list, update_fn):
+        with self._lock:
+            new_value = update_fn(self.get(segments))
+            self.apply({_join_path(segments): new_value})
+            return new_value
+
+
+def _flatten(path: str, value):
+    if isinstance(value, dict):
+        for k, v in value.items():
+            yield from _flatten(f"{path}/{k}" if path else str(k), v)
+    elif isinstance(value, (list, tuple)):
+        for i, v in enumerate(value):
+            yield from _flatten(f"{path}/{i}" if path else str(i), v)
+    elif value is not None:
+        yield path, value
+
+
+def _restore_arrays(node):
+    """Как RTDB: объект с ключами 0..n (заполненными больше чем наполовину) отдаётся списком."""
+    if not isinstance(node, dict):
+        return node
+    for k in node:
+        node[k] = _restore_arrays(node[k])
+    if node and all(k.isdigit() and (k == "0" or not k.startswith("0")) for k in node):
+        max_index = max(int(k) for k in node)
+        if max_index < 2 * len(node):
+            result = [None] * (max_index + 1)
+            for k, v in node.items():
+                result[int(k)] = v
+            return result
+    return node
+
+
+_PUSH_CHARS = "-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
+
+
+def _push_key() -> str:
+    """Ключ в формате push-id Firebase: 8 символов времени + 12 случайных, сортируется по времени."""
+    now = int(time.time() * 1000)
+    time_chars = []
+    for _ in range(8):
+        time_chars.append(_PUSH_CHARS[now % 64])
+        now //= 64
+    return "".join(reversed(time_chars)) + "".join(random.choice(_PUSH_CHARS) for _ in range(12))
+
+
+def _order_value(value):
+    """Порядок значений RTDB: null < false < true < числа < строки < объекты."""
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (1, int(value))
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, str):
+        return (3, value)
+    return (4, 0)
+
+
+def _order_key(key: str):
+    """Ключи-числа идут раньше строковых и сравниваются как числа."""
+    return (0, int(key), "") if key.lstrip("-").isdigit() else (1, 0, key)
+
+
+class LocalReference:
+    """Ссылка на узел локального хранилища с тем же интерфейсом, что у firebase_admin.db.Reference."""
+
+    def __init__(self, store: LocalStore, segments: list):
+        self._store = store
+        self._segments = segments
+
+    @property
+    def key(self):
+        return self._segments[-1] if self._segments else None
+
+    @property
+    def path(self) -> str:
+        return "/" + _join_path(self._segments)
+
+    @property
+    def parent(self):
+        if not self._segments:
+            return None
+        return LocalReference(self._store, self._segments[:-1])
+
+    def child(self, path: str) -> "LocalReference":
+        return LocalReference(self._store, self._segments + _split_path(path))
+
+    def get(self, shallow: bool = False):
+        return self._store.get(self._segments, shallow=shallow)
+
+    def set(self, value) -> None:
+        if value is None:
+            raise ValueError("Value must not be None.")
+        self._store.apply({_join_path(self._segments): value})
+
+    def update(self, value: dict) -> None:
+        if not value or not isinstance(value, dict):
+            raise ValueError("Value argument must be a non-empty dictionary.")
+        base = _join_path(self._segments)
+        self._store.apply({f"{base}/{k}" if base else k: v for k, v in value.items()})
+
+    def delete(self) -> None:
+        self._store.apply({_join_path(self._segments): None})
+
+    def push(self, value="") -> "LocalReference":
+        ref = self.child(_push_key())
+        ref.set(value)
+        return ref
+
+    def transaction(self, transaction_update):
+        return self._store.transaction(self._segments, transaction_update)
+
+    def order_by_child(self, path: str) -> "LocalQuery":
+        return LocalQuery(self, order_by=_split_path(path))
+
+    def order_by_key(self) -> "LocalQuery":
+        return LocalQuery(self, order_by=None)
+
+
+class LocalQuery:
+    """Запрос к детям узла: сортировка, фильтр по диапазону и лимит выполняются в процессе."""
+
+    def __init__(self, ref: LocalReference, order_by):
+        self._ref = ref
+        self._order_by = order_by
+        self._limit_first = None
+        self._limit_last = None
+        self._start = None
+        self._end = None
+
+    def limit_to_first(self, limit: int) -> "LocalQuery":
+        self._limit_first = limit
+        return self
+
+    def limit_to_last(self, limit: int) -> "LocalQuery":
+        self._limit_last = limit
+        return self
+
+    def start_at(self, start) -> "LocalQuery":
+        self._start = start
+        return self
+
+    def end_at(self, end) -> "LocalQuery":
+        self._end = end
+        return self
+
+    def equal_to(self, value) -> "LocalQuery":
+        self._start = self._end = value
+        return self
+
+    def _position(self, item):
+        """Позиция записи в порядке сортировки без учёта ключа — с ней сравниваются start_at/end_at."""
+        key, value = item
+        if self._order_by is None:
+            return _order_key(key)
+        for segment in self._order_by:
+            value = value.get(segment) if isinstance(value, dict) else None
+        return _order_value(value)
+
+    def _bound(self, value):
+        return _order_key(str(value)) if self._order_by is None else _order_value(value)
+
+    def get(self):
+        data = self._ref.get()
+        if isinstance(data, list):
+            data = {str(i): v for i, v in enumerate(data) if v is not None}
+        if not isinstance(data, dict):
+            return OrderedDict()
+
+        items = sorted(data.items(), key=lambda item: (self._position(item), _order_key(item[0])))
+        if self._start is not None:
+            items = [item for item in items if self._position(item) >= self._bound(self._start)]
+        if self._end is not None:
+            items = [item for item in items if self._position(item) <= self._bound(self._end)]
+        if self._limit_first is not None:
+            items = items[:self._limit_first]
+        if self._limit_last is not None:
+            items = items[-self._limit_last:] if self._limit_last else []
+        return OrderedDict(items)
+
+
+def init_firebase():
+    """
+    Инициализирует приложение Firebase, если оно еще не было инициализировано.
+    Путь к ключу и URL базы задаются FIREBASE_KEY_PATH и FIREBASE_DATABASE_URL.
+    """
+    import firebase_admin
+    from firebase_admin import credentials
+
+    try:
+        firebase_admin.get_app()
+    except ValueError:
+        cred = credentials.Certificate(FIREBASE_KEY_PATH)
+        firebase_admin.initialize_app(cred, {"databaseURL": FIREBASE_DATABASE_URL})
+
+
+class _Database:
+    """
+    Заменяет модуль firebase_admin.db: db.reference(path) отдаёт ссылку
+    выбранного бэкенда. Локальное хранилище открывается при первом обращении.
+    """
+
+    def __init__(self, backend: str):
+        if backend not in ("firebase", "sqlite", "memory"):
+            raise RuntimeError(f"Неизвестный STORAGE_BACKEND: {backend!r} (ожидается firebase, sqlite или memory)")
+        self.backend = backend
+        self._store = None
+        self._lock = threading.Lock()
+
+    def _local_store(self) -> LocalStore:
+        with self._lock:
+            if self._store is None:
+                path = ":memory:" if self.backend == "memory" else STORAGE_SQLITE_PATH
+                self._store = LocalStore(path)
+                logger.info(f"Локальное хранилище ({self.backend}) открыто: {path}")
+            return self._store
+
+    def reference(self, path: str = "/"):
+        if self.backend == "firebase":
+            from firebase_admin import db as firebase_db
+            return firebase_db.reference(path)
+        return LocalReference(self._local_store(), _split_path(path))
+
+
+db = _Database(STORAGE_BACKEND)
+
+
+def init_storage() -> None:
+    """Готовит выбранный бэкенд к работе; вызывается один раз при запуске бота."""
+    if db.backend == "firebase":
+        init_firebase()
+    else:
+        db._local_store()
+
+
+def shallow_keys(path: str) -> list:
+    """Ключи детей узла без загрузки их содержимого (get(shallow=True))."""
+    data = db.reference(path).get(shallow=True)
+    if isinstance(data, dict):
+        return list(data.keys())
+    if isinstance(data, list):
+        return [str(i) for i, value in enumerate(data) if value is not None]
+    return []
+
+
+def query_children(
+    path: str,
+    order_by: str = None,
+    start_at=None,
+    end_at=None,
+    equal_to=None,
+    limit_to_first: int = None,
+    limit_to_last: int = None,
+) -> OrderedDict:
+    """
+    Дети узла, отсортированные по полю order_by (order_by_child) или по ключу,
+    если order_by не задан. Фильтры и лимит применяет база, поэтому приходят
+    только нужные записи. Для order_by_child в правилах Firebase нужен .indexOn.
+    """
+    ref = db.reference(path)
+    query = ref.order_by_child(order_by) if order_by else ref.order_by_key()
+    if equal_to is not None:
+        query = query.equal_to(equal_to)
+    if start_at is not None:
+        query = query.start_at(start_at)
+    if end_at is not None:
+        query = query.end_at(end_at)
+    if limit_to_first is not None:
+        query = query.limit_to_first(limit_to_first)
+    if limit_to_last is not None:
+        query = query.limit_to_last(limit_to_last)
+    return query.get() or OrderedDict()
@@ -0,0 +1,103 @@
+"""
+Режимы хранения фрагментов истории (поле storage_mode).
+
+Обычная история хранит фрагменты деревом users_story/{owner}/{story}/fragments,
+и каждое чтение передаёт его целиком, в JSON-виде со всеми ключами.
+
+"compressed": фрагменты сгруппированы по веткам — общему префиксу имени
+(main_1, main_2 → "main"; GoLeft_6 → "GoLeft") — и каждая ветка лежит в
+fragment_blocks/{ветка} одной строкой base64(zlib(JSON)). Правка фрагмента
+переписывает только его блок.
+
+"sharded": в users_story/{owner}/{story} остаётся только заголовок, а каждый
+фрагмент лежит отдельно в story_fragments/{story}/{fragment_id}, так что
+прохождение читает лишь нужные фрагменты.
+
+Модуль не зависит от novel.py: им пользуются и бот, и migrations.py.
+"""
+
+import base64
+import json
+import re
+import zlib
+
+from storage import db
+
+COMPRESSED_MODE = "compressed"
+SHARDED_MODE = "sharded"
+BLOCKS_FIELD = "fragment_blocks"
+FRAGMENTS_ROOT = "story_fragments"  # story_fragments/{story_id}/{fragment_id} в режиме sharded
+COMPRESSION_LEVEL = 6
+
+# Ключи RTDB не допускают этих символов; имена фрагментов их и так не содержат
+_BRANCH_SUFFIX = re.compile(r"_\d+$")
+
+
+def fragment_branch(fragment_id: str) -> str:
+    """Ветка фрагмента — имя без числового суффикса."""
+    branch = _BRANCH_SUFFIX.sub("", str(fragment_id))
+    return branch or str(fragment_id)
+
+
+def encode_block(fragments: dict) -> str:
+    raw = json.dumps(fragments, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return base64.b64encode(zlib.compress(raw, COMPRESSION_LEVEL)).decode("ascii")
+
+
+def decode_block(block) -> dict:
+    if not isinstance(block, str) or not block:
+        return {}
+    return json.loads(zlib.decompress(base64.b64decode(block)).decode("utf-8"))
+
+
+def is_packed(story) -> bool:
+    return isinstance(story, dict) and story.get("storage_mode") == COMPRESSED_MODE
+
+
+def pack_fragments(fragments: dict) -> dict:
+    """{fragment_id: fragment} → {ветка: блок}."""
+    branches = {}
+    for fragment_id, fragment in (fragments or {}).items():
+        branches.setdefault(fragment_branch(fragment_id), {})[fragment_id] = fragment
+    return {branch: encode_block(items) for branch, items in branches.items()}
+
+
+def unpack_fragments(blocks) -> dict:
+    fragments = {}
+    for block in (blocks or {}).values():
+        fragments.update(decode_block(block))
+    return fragments
+
+
+def pack_story(story: dict) -> dict:
+    """Копия истории в сжатом виде (fragments → fragment_blocks)."""
+    packed = {key: value for key, value in story.items() if key not in ("fragments", BLOCKS_FIELD)}
+    packed[BLOCKS_FIELD] = pack_fragments(story.get("fragments") or {})
+    packed["storage_mode"] = COMPRESSED_MODE
+    return packed
+
+
+def unpack_story(story):
+    """
+    Возвращает историю в обычном виде: блоки раскодированы в fragments.
+    storage_mode остаётся в истории, чтобы было видно, как она хранится.
+    Несжатые истории (и не-словари) возвращаются как есть.
+    """
+    if not is_packed(story):
+        return story
+    unpacked = {key: value for key, value in story.items() if key != BLOCKS_FIELD}
+    unpacked["fragments"] = unpack_fragments(story.get(BLOCKS_FIELD))
+    return unpacked
+
+
+def read_story(owner_id: str, story_id: str):
+    """
+    Читает users_story/{owner_id}/{story_id} в обычном виде при любом режиме хранения:
+    блоки раскодируются, фрагменты шардированной истории дочитываются из story_fragments.
+    """
+    story = db.reference(f"users_story/{owner_id}/{story_id}").get()
+    if isinstance(story, dict) and story.get("storage_mode") == SHARDED_MODE:
+        story = dict(story)
+        story["fragments"] = db.reference(f"{FRAGMENTS_ROOT}/{story_id}").get() or {}
+        return story
+    return unpack_story(story)
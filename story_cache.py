@@ -0,0 +1,192 @@
+"""
+Общий кэш историй в памяти процесса.
+
+Вынесен в отдельный модуль, потому что novel.py запускается как __main__,
+а background.py импортирует novel повторно: модульные переменные novel.py
+существуют в двух копиях, а этот модуль — в одной, и бот, и Flask видят
+один и тот же кэш.
+
+Истории хранятся сериализованными в JSON (bytes): так размер записи известен
+точно, а каждое чтение возвращает независимую копию, которую вызывающий код
+может свободно изменять.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+STORY_CACHE_MAX_BYTES = int(os.environ.get("STORY_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+STORY_CACHE_TTL = float(os.environ.get("STORY_CACHE_TTL", 300))
+
+
+class StoryCache:
+    """
+    LRU-кэш историй, ограниченный суммарным размером в байтах, с TTL.
+    Ключ — story_id, значение — (owner_id, version, expires_at, payload).
+    Запись валидна, пока не истёк TTL и её version совпадает с версией в базе.
+    """
+
+    def __init__(self, max_bytes: int = STORY_CACHE_MAX_BYTES, ttl: float = STORY_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    def get(self, story_id: str, version=None):
+        """
+        Возвращает (owner_id, story) или None.
+        Если передан version и он отличается от закэшированного, запись сбрасывается.
+        """
+        with self._lock:
+            entry = self._entries.get(story_id)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            owner_id, cached_version, expires_at, payload = entry
+            if expires_at < time.monotonic() or (version is not None and version != cached_version):
+                self._drop(story_id)
+                self.stale += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(story_id)
+            self.hits += 1
+
+        return owner_id, json.loads(payload)
+
+    def put(self, story_id: str, owner_id: str, story: dict, version=None) -> None:
+        """Кладёт историю в кэш, вытесняя самые старые записи при превышении лимита."""
+        try:
+            payload = json.dumps(story, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        except (TypeError, ValueError) as e:
+            logger.warning(f"История {story_id} не кэширована: не сериализуется ({e})")
+            return
+
+        if len(payload) > self.max_bytes:
+            return
+
+        with self._lock:
+            self._drop(story_id)
+            self._entries[story_id] = (str(owner_id), version, time.monotonic() + self.ttl, payload)
+            self._size += len(payload)
+            while self._size > self.max_bytes and self._entries:
+                oldest_id = next(iter(self._entries))
+                self._drop(oldest_id)
+                self.evictions += 1
+
+    def apply_patch(self, story_id: str, changes: dict, new_version) -> bool:
+        """
+        Применяет частичную запись {"fragments/main_1/text": value, ...} к закэшированной копии.
+        Срабатывает, только если в кэше лежит предыдущая версия (new_version - 1), то есть
+        между чтением и записью историю никто не менял. Иначе запись сбрасывается.
+        None в значении означает удаление узла (как в update() RTDB).
+        """
+        with self._lock:
+            entry = self._entries.get(story_id)
+            if entry is None:
+                return False
+            owner_id, cached_version, _, payload = entry
+            if not isinstance(new_version, int) or cached_version != new_version - 1:
+                self._drop(story_id)
+                return False
+
+        story = json.loads(payload)
+        try:
+            for path, value in changes.items():
+                set_by_path(story, path.split("/"), value)
+        except (KeyError, IndexError, TypeError, ValueError):
+            self.invalidate(story_id)
+            return False
+
+        with self._lock:
+            current = self._entries.get(story_id)
+            if current is None or current[1] != cached_version:
+                return False
+        self.put(story_id, owner_id, story, new_version)
+        return True
+
+    def invalidate(self, story_id: str) -> None:
+        with self._lock:
+            self._drop(story_id)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _drop(self, story_id: str) -> None:
+        entry = self._entries.pop(story_id, None)
+        if entry is not None:
+            self._size -= len(entry[3])
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+def set_by_path(node, keys: list, value) -> None:
+    """Записывает value по пути keys внутри вложенных dict/list; None удаляет узел."""
+    # Пустые объекты и массивы RTDB не хранит — как и null, они удаляют узел
+    if isinstance(value, (dict, list)) and not value:
+        value = None
+    for key in keys[:-1]:
+        if isinstance(node, list):
+            node = node[int(key)]
+            continue
+        child = node.get(key)
+        if child is None:
+            if value is None:
+                return
+            child = node[key] = {}
+        node = child
+
+    last = keys[-1]
+    if isinstance(node, list):
+        index = int(last)
+        if value is None:
+            # RTDB не сдвигает элементы при удалении — на это место попадёт null
+            node[index] = None
+        elif index == len(node):
+            node.append(value)
+        else:
+            node[index] = value
+    elif value is None:
+        node.pop(last, None)
+    else:
+        node[last] = value
+
+
+def get_by_path(node, keys: list):
+    """Значение по пути keys внутри вложенных dict/list (None, если узла нет)."""
+    for key in keys:
+        if isinstance(node, list) and key.isdigit() and int(key) < len(node):
+            node = node[int(key)]
+        elif isinstance(node, dict):
+            node = node.get(key)
+        else:
+            return None
+    return node
+
+
+story_cache = StoryCache()
@@ -0,0 +1,405 @@
+"""
+Компилируемые шаблоны подстановки атрибутов в текст фрагмента.
+
+Раньше каждый рендер прогонял текст фрагмента через несколько re.sub подряд
+(раскодирование &gt;/&lt; в скобках, логические блоки {{сила:>2}}...{{сила}},
+подстановки {{{сила}}}). Теперь текст один раз разбирается в список токенов:
+    str                                    — литерал;
+    (ATTR, имя_как_в_тексте, ключ)         — {{{атрибут}}};
+    (COND, ключ, оп, число, число2, тело)  — логический блок, тело — такие же токены.
+Скомпилированные шаблоны кэшируются по хэшу содержимого, поэтому новая версия
+фрагмента просто получает новую запись, а рендер — один линейный проход по токенам.
+
+Так же компилируется и разметка пошагового показа ([[+N]], ((-N))): текст один
+раз разбирается в неизменяемый TimedEditPlan, который переиспользуют все показы.
+Если в тексте есть подстановки, кадры разбираются по исходному тексту фрагмента
+(TimedTemplate — кадры из токенов шаблона), а значения игрока подставляются в
+каждый кадр при показе, поэтому кэш не зависит от значений и бросков.
+
+Модуль чистый (без Telegram и базы), его использует novel.py и benchmarks/.
+"""
+
+import hashlib
+import random
+import re
+from collections import OrderedDict
+from dataclasses import dataclass
+from html import unescape as html_unescape
+from types import MappingProxyType
+from typing import Optional, Tuple
+
+ATTR = "attr"
+COND = "cond"
+
+TEMPLATE_CACHE_SIZE = 2048  # Скомпилированных шаблонов в памяти процесса
+
+ATTR_PATTERN = r"[а-яА-ЯёЁa-zA-Z_]+"
+_BRACES = re.compile(r"\{\{\{(.*?)\}\}\}|\{\{(.*?)\}\}", re.DOTALL)
+_LOGIC = re.compile(
+    rf"\{{\{{\s*({ATTR_PATTERN})\s*:\s*([<>=])\s*(\d+)"
+    rf"(?:\s*-\s*(\d+))?\s*\}}\}}(.*?)\{{\{{\s*\1\s*\}}\}}",
+    re.DOTALL | re.IGNORECASE,
+)
+_TRIPLE = re.compile(rf"\{{\{{\{{\s*({ATTR_PATTERN})\s*\}}\}}\}}")
+
+
+def _basic_unescape(inner: str) -> str:
+    return inner.replace("&gt;", ">").replace("&lt;", "<").replace("&amp;", "&")
+
+
+# Как раскодировать HTML-сущности внутри скобок: apply_effect_values понимает
+# только &gt; &lt; &amp;, advanced_replace_attributes — любые (html.unescape)
+UNESCAPERS = {"basic": _basic_unescape, "html": html_unescape}
+
+
+class TemplateCache:
+    """
+    LRU-кэш скомпилированного текста: ключ — аргументы компилятора и хэш текста.
+    compiler(text, *args) — по умолчанию compile_template.
+    """
+
+    def __init__(self, max_entries: int = TEMPLATE_CACHE_SIZE, compiler=None):
+        self.max_entries = max_entries
+        self.compiler = compiler or compile_template
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, text: str, *args):
+        key = (args, hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest())
+        tokens = self._entries.get(key)
+        if tokens is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return tokens
+        self.misses += 1
+        tokens = self.compiler(text, *args)
+        self._entries[key] = tokens
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return tokens
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+def _compile_substitutions(text: str, tokens: list) -> None:
+    position = 0
+    for match in _TRIPLE.finditer(text):
+        if match.start() > position:
+            tokens.append(text[position:match.start()])
+        attr_raw = match.group(1)
+        tokens.append((ATTR, attr_raw, attr_raw.strip().lower()))
+        position = match.end()
+    if position < len(text):
+        tokens.append(text[position:])
+
+
+def compile_template(text: str, unescape: str = "basic") -> list:
+    """
+    Разбирает текст в токены в том же порядке, в каком работали регулярки:
+    раскодирование внутри скобок → логические блоки → подстановки {{{...}}}.
+    """
+    if "{{" not in text:
+        return [text] if text else []
+
+    decode = UNESCAPERS[unescape]
+
+    def unescape_inside(match):
+        if match.group(1) is not None:
+            return "{{{" + decode(match.group(1)) + "}}}"
+        return "{{" + decode(match.group(2)) + "}}"
+
+    text = _BRACES.sub(unescape_inside, text)
+
+    tokens = []
+    position = 0
+    for match in _LOGIC.finditer(text):
+        _compile_substitutions(text[position:match.start()], tokens)
+        body = []
+        _compile_substitutions(match.group(5), body)
+        num2 = match.group(4)
+        tokens.append((
+            COND,
+            match.group(1).strip().lower(),
+            match.group(2),
+            int(match.group(3)),
+            int(num2) if num2 is not None else None,
+            body,
+        ))
+        position = match.end()
+    _compile_substitutions(text[position:], tokens)
+    return tokens
+
+
+def render_template(tokens: list, lookup, missing, rolls: dict = None) -> str:
+    """
+    Один проход по токенам. lookup(ключ) — значение атрибута или None;
+    missing(имя_как_в_тексте) — текст вместо {{{атрибута}}}, которого нет.
+    Диапазон в условии ({{удача:>3-8}}) разыгрывается заново при каждом рендере;
+    с rolls (общий dict) итог условия запоминается, и повторный рендер того же
+    токена (следующий кадр пошагового показа) даёт тот же результат.
+    """
+    parts = []
+    for token in tokens:
+        if token.__class__ is str:
+            parts.append(token)
+        elif token[0] == ATTR:
+            value = lookup(token[2])
+            parts.append(str(value) if value is not None else missing(token[1]))
+        else:
+            _, key, op, num1, num2, body = token
+            value = lookup(key)
+            if value is None:
+                continue
+            if rolls is not None and id(token) in rolls:
+                passed = rolls[id(token)]
+            else:
+                check_num = random.randint(min(num1, num2), max(num1, num2)) if num2 is not None else num1
+                if op == ">":
+                    passed = value > check_num
+                elif op == "<":
+                    passed = value < check_num
+                else:
+                    passed = value == check_num
+                if rolls is not None:
+                    rolls[id(token)] = passed
+            if passed:
+                parts.append(render_template(body, lookup, missing, rolls))
+    return "".join(parts)
+
+
+template_cache = TemplateCache()
+
+
+# --- Пошаговый показ: [[+N]] дописывает текст после паузы, [[-N]] (или ((-N))) заменяет его ---
+
+TIMED_MARKER = re.compile(r"(\[\[[-+]\d+\]\]|\(\([-+]\d+\)\))")
+_TIMED_TOKEN = re.compile(r"((?:\[\[|\(\()([+-])(\d+)(?:\]\]|\)\)))|(</?(\w+)[^>]*>)")
+_VOID_TAGS = ("br", "hr", "img")
+MAX_STEP_DELAY = 60
+
+
+@dataclass(frozen=True)
+class TimedEditPlan:
+    """
+    Результат разбора текста фрагмента с таймерами.
+    base_text — то, что показывается сразу (текст до первого маркера);
+    steps — кадры {"delay": N, "full_text": ...} (только для чтения), последний — итоговый текст.
+    """
+
+    base_text: str
+    steps: Tuple[MappingProxyType, ...]
+
+    @property
+    def has_edits(self) -> bool:
+        return len(self.steps) > 1
+
+
+def _step(delay: int, full_text: str) -> MappingProxyType:
+    return MappingProxyType({"delay": delay, "full_text": full_text})
+
+
+def compile_timed_edits(text: str) -> TimedEditPlan:
+    """
+    Разбирает маркеры времени в кадры. Каждый кадр — снимок текста на время паузы,
+    с закрытыми открытыми HTML-тегами; непарные закрывающие теги отбрасываются,
+    чтобы Telegram не получил невалидный HTML после [[-N]].
+    """
+    base_text = TIMED_MARKER.split(text, 1)[0].strip()
+    steps = []
+    current_text = ""
+    tag_stack = []
+    last_idx = 0
+
+    for match in _TIMED_TOKEN.finditer(text):
+        current_text += text[last_idx:match.start()]
+        last_idx = match.end()
+
+        if match.group(1):
+            closing_suffix = "".join(f"</{tag}>" for tag in reversed(tag_stack))
+            steps.append(_step(min(int(match.group(3)), MAX_STEP_DELAY), current_text + closing_suffix))
+            if match.group(2) == "-":
+                current_text = ""
+                tag_stack = []
+            continue
+
+        tag_full = match.group(4)
+        tag_name = match.group(5).lower()
+        if tag_name in _VOID_TAGS:
+            current_text += tag_full
+        elif not tag_full.startswith("</"):
+            current_text += tag_full
+            tag_stack.append(tag_name)
+        elif tag_stack and tag_stack[-1] == tag_name:
+            current_text += tag_full
+            tag_stack.pop()
+
+    current_text += text[last_idx:]
+    closing_suffix = "".join(f"</{tag}>" for tag in reversed(tag_stack))
+    # delay=0: итоговый кадр показывается сразу после последней паузы
+    steps.append(_step(0, current_text + closing_suffix))
+    return TimedEditPlan(base_text=base_text, steps=tuple(steps))
+
+
+timed_edit_cache = TemplateCache(compiler=compile_timed_edits)
+
+
+def timed_edit_plan(text: str) -> TimedEditPlan:
+    """План показа для текста фрагмента; повторные показы того же текста не парсят его заново."""
+    return timed_edit_cache.get(text or "")
+
+
+def resume_timed_edits(steps, started: float, now: float) -> Tuple[int, Optional[float]]:
+    """
+    С какого кадра продолжить показ, начатый в started, если сейчас now: (индекс, пауза).
+    Кадры, чьё время уже прошло, не проигрываются по одному: возвращается последний
+    из них и пауза None (показать сразу); если не наступил ни один — первый кадр
+    и остаток его паузы.
+    """
+    due = started
+    index, delay = 0, None
+    for position, step in enumerate(steps):
+        due += step.get("delay", 0)
+        if due > now:
+            if position == 0:
+                delay = due - now
+            break
+        index = position
+    return index, delay
+
+
+# --- Пошаговый показ текста с подстановками: кадры из токенов шаблона ---
+
+# Маркер, который появится только после подстановки: [[+{{{пауза}}}]]
+_MARKER_PREFIX_END = re.compile(r"(?:\[\[|\(\()[-+]\d*$")
+_MARKER_START = re.compile(r"(?:\[\[|\(\()[-+]")
+# HTML-тег, разорванный подстановкой: <a href="{{{ссылка}}}">
+_TAG_START_END = re.compile(r"<\/?\w[^>]*$")
+
+
+@dataclass(frozen=True)
+class TimedTemplate:
+    """
+    Разметка пошагового показа, разобранная по исходному тексту с подстановками.
+    tokens — весь шаблон; base — токены до первого маркера; frames — (пауза, токены кадра),
+    токены общие с tokens, поэтому броски условий в кадрах согласованы (см. render_template).
+    dynamic — маркеры зависят от значений (пауза из {{{атрибута}}}, маркер внутри
+    логического блока): такой текст разбирается только после подстановки.
+    """
+
+    tokens: tuple
+    base: tuple
+    frames: tuple
+    dynamic: bool = False
+
+
+def _balanced_tags(parts: list) -> bool:
+    """Теги внутри условия открываются и закрываются в нём же (тогда условие не влияет на теги кадров)."""
+    stack = []
+    for part in parts:
+        if part.__class__ is not str:
+            continue
+        if _TAG_START_END.search(part):
+            return False
+        for match in _TIMED_TOKEN.finditer(part):
+            if not match.group(4) or match.group(5).lower() in _VOID_TAGS:
+                continue
+            if not match.group(4).startswith("</"):
+                stack.append(match.group(5).lower())
+            elif stack and stack[-1] == match.group(5).lower():
+                stack.pop()
+            else:
+                return False
+    return not stack
+
+
+def _is_dynamic(tokens: list) -> bool:
+    for position, token in enumerate(tokens):
+        if token.__class__ is str:
+            if position + 1 < len(tokens) and (_MARKER_PREFIX_END.search(token) or _TAG_START_END.search(token)):
+                return True
+        elif token[0] == COND:
+            body = token[5]
+            # Маркер или непарный тег внутри условия: кадры зависят от того, выполнится ли оно
+            if any(part.__class__ is str and _MARKER_START.search(part) for part in body) or not _balanced_tags(body):
+                return True
+    return False
+
+
+def compile_timed_template(text: str) -> TimedTemplate:
+    """
+    Как compile_timed_edits, но литералы шаблона разбираются на маркеры и теги,
+    а подстановки и условия переходят в кадры целыми токенами.
+    """
+    tokens = compile_template(text, "basic")
+    if _is_dynamic(tokens):
+        return TimedTemplate(tokens=tuple(tokens), base=(), frames=(), dynamic=True)
+
+    base = None
+    prefix = []
+    frames = []
+    current = []
+    tag_stack = []
+    for token in tokens:
+        if token.__class__ is not str:
+            current.append(token)
+            prefix.append(token)
+            continue
+        last_idx = 0
+        for match in _TIMED_TOKEN.finditer(token):
+            piece = token[last_idx:match.start()]
+            current.append(piece)
+            prefix.append(piece)
+            last_idx = match.end()
+
+            if match.group(1):
+                if base is None:
+                    base = tuple(prefix)
+                closing_suffix = "".join(f"</{tag}>" for tag in reversed(tag_stack))
+                frames.append((min(int(match.group(3)), MAX_STEP_DELAY), tuple(current) + (closing_suffix,)))
+                if match.group(2) == "-":
+                    current = []
+                    tag_stack = []
+                continue
+
+            tag_full = match.group(4)
+            tag_name = match.group(5).lower()
+            prefix.append(tag_full)
+            if tag_name in _VOID_TAGS:
+                current.append(tag_full)
+            elif not tag_full.startswith("</"):
+                current.append(tag_full)
+                tag_stack.append(tag_name)
+            elif tag_stack and tag_stack[-1] == tag_name:
+                current.append(tag_full)
+                tag_stack.pop()
+        current.append(token[last_idx:])
+        prefix.append(token[last_idx:])
+
+    closing_suffix = "".join(f"</{tag}>" for tag in reversed(tag_stack))
+    frames.append((0, tuple(current) + (closing_suffix,)))
+    return TimedTemplate(tokens=tuple(tokens), base=base if base is not None else tuple(prefix), frames=tuple(frames))
+
+
+timed_template_cache = TemplateCache(compiler=compile_timed_template)
+
+
+def render_timed_edits(text: str, lookup, missing, empty_text: str) -> TimedEditPlan:
+    """
+    План показа текста фрагмента со значениями игрока (lookup/missing — как у render_template).
+    Разбор берётся из кэша по исходному тексту, значения подставляются в каждый кадр;
+    если после подстановки текст пуст, показывается empty_text.
+    """
+    template = timed_template_cache.get(text or "")
+    rolls = {}
+    full_text = render_template(template.tokens, lookup, missing, rolls)
+    if not full_text.strip():
+        return timed_edit_plan(empty_text)
+    if template.dynamic:
+        # Разметка появляется только после подстановки — план одноразовый и в кэш не попадает
+        return compile_timed_edits(full_text)
+    return TimedEditPlan(
+        base_text=render_template(template.base, lookup, missing, rolls).strip(),
+        steps=tuple(_step(delay, render_template(frame, lookup, missing, rolls)) for delay, frame in template.frames),
+    )
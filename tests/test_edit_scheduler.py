@@ -0,0 +1,100 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("telegram")
+
+from telegram.error import RetryAfter  # noqa: E402
+
+from edit_scheduler import EditScheduler  # noqa: E402
+
+
+class FakeBot:
+    def __init__(self, failures=0):
+        self.calls = []
+        self.failures = failures
+        self.in_flight = None
+
+    async def edit_message_text(self, **kwargs):
+        self.calls.append(("text", kwargs["text"]))
+        if self.in_flight is not None:
+            gate, self.in_flight = self.in_flight, None
+            await gate.wait()
+        if self.failures:
+            self.failures -= 1
+            raise RetryAfter(0)
+        return kwargs["text"]
+
+    async def edit_message_reply_markup(self, **kwargs):
+        self.calls.append(("markup", kwargs["reply_markup"]))
+        return kwargs["reply_markup"]
+
+
+def make_scheduler(max_retries=5):
+    return EditScheduler(chat_rate=1000, chat_burst=10, global_rate=1000, global_burst=10, max_retries=max_retries)
+
+
+def test_coalesces_pending_edits_of_same_message():
+    scheduler = make_scheduler()
+    bot = FakeBot()
+
+    async def main():
+        futures = [scheduler.submit(bot, "edit_message_text", chat_id=1, message_id=7, text=f"кадр {i}") for i in range(3)]
+        markup = scheduler.submit(bot, "edit_message_reply_markup", chat_id=1, message_id=7, reply_markup="кнопки")
+        other = scheduler.submit(bot, "edit_message_text", chat_id=1, message_id=8, text="другое")
+        return await asyncio.gather(*futures, markup, other)
+
+    results = asyncio.run(main())
+    assert results == ["кадр 2"] * 3 + ["кнопки", "другое"]
+    assert bot.calls == [("text", "кадр 2"), ("markup", "кнопки"), ("text", "другое")]
+    assert scheduler.stats()["coalesced"] == 2
+    assert scheduler.stats()["depth"] == 0
+
+
+def test_retry_after_requeues_edit():
+    scheduler = make_scheduler()
+    bot = FakeBot(failures=1)
+
+    async def main():
+        return await scheduler.edit(bot, "edit_message_text", chat_id=1, message_id=7, text="кадр")
+
+    assert asyncio.run(main()) == "кадр"
+    assert bot.calls == [("text", "кадр"), ("text", "кадр")]
+    assert scheduler.stats()["retries"] == 1
+    assert scheduler.stats()["sent"] == 1
+
+
+def test_retry_after_sends_newer_state_instead():
+    scheduler = make_scheduler()
+    bot = FakeBot(failures=1)
+    bot.in_flight = asyncio.Event()
+
+    async def main():
+        gate = bot.in_flight
+        first = scheduler.submit(bot, "edit_message_text", chat_id=1, message_id=7, text="старый")
+        while not bot.calls:
+            await asyncio.sleep(0)
+        # Пока первая правка в полёте, приходит новое состояние сообщения
+        second = scheduler.submit(bot, "edit_message_text", chat_id=1, message_id=7, text="новый")
+        gate.set()
+        return await asyncio.gather(first, second)
+
+    assert asyncio.run(main()) == ["новый", "новый"]
+    assert bot.calls == [("text", "старый"), ("text", "новый")]
+
+
+def test_gives_up_after_max_retries():
+    scheduler = make_scheduler(max_retries=2)
+    bot = FakeBot(failures=10)
+
+    async def main():
+        return await scheduler.edit(bot, "edit_message_text", chat_id=1, message_id=7, text="кадр")
+
+    with pytest.raises(RetryAfter):
+        asyncio.run(main())
+    assert len(bot.calls) == 3
+    assert scheduler.stats()["failed"] == 1
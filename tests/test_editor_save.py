@@ -0,0 +1,100 @@
+import asyncio
+import copy
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+for module in ("telegram", "firebase_admin", "flask", "google.genai", "networkx", "graphviz", "bs4"):
+    pytest.importorskip(module)
+
+# Бот поднимается на локальном бэкенде в памяти, без Firebase и Telegram
+os.environ["STORAGE_BACKEND"] = "memory"
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "test")
+
+import novel  # noqa: E402
+
+USER_ID = "100"
+STORY = {
+    "title": "Тест",
+    "fragments": {
+        "main_1": {"text": "начало", "choices": []},
+        "main_2": {"text": "середина", "choices": []},
+    },
+}
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+
+def open_editor(story_id: str) -> SimpleNamespace:
+    story, version = novel.load_user_story_versioned(USER_ID, story_id)
+    context = SimpleNamespace(
+        bot=FakeBot(),
+        user_data={"user_id_str": USER_ID, "story_id": story_id, "current_story": copy.deepcopy(story)},
+    )
+    novel.remember_story_version(context, story_id, version, story)
+    return context
+
+
+def save(context) -> bool:
+    update = SimpleNamespace(effective_chat=SimpleNamespace(id=1))
+    return asyncio.run(novel.save_story_in_editor(update, context))
+
+
+@pytest.fixture(autouse=True)
+def storage():
+    novel.init_storage()
+    novel.db.reference("/").delete()
+    novel.story_cache.clear()
+
+
+def test_editor_save_writes_story():
+    novel.save_story_data(USER_ID, "s1", copy.deepcopy(STORY))
+    context = open_editor("s1")
+    context.user_data["current_story"]["fragments"]["main_1"]["text"] = "новое начало"
+
+    assert save(context) is True
+    assert novel.load_user_story(USER_ID, "s1")["fragments"]["main_1"]["text"] == "новое начало"
+    assert context.bot.sent == []
+
+
+def test_editor_save_rebases_and_reports_conflicts():
+    novel.save_story_data(USER_ID, "s1", copy.deepcopy(STORY))
+    mine, coauthor = open_editor("s1"), open_editor("s1")
+
+    coauthor.user_data["current_story"]["fragments"]["main_2"]["text"] = "соавтор"
+    assert save(coauthor) is True
+    # Другой фрагмент — правки переносятся поверх версии соавтора
+    mine.user_data["current_story"]["fragments"]["main_1"]["text"] = "я"
+    assert save(mine) is True
+    fragments = novel.load_user_story(USER_ID, "s1")["fragments"]
+    assert (fragments["main_1"]["text"], fragments["main_2"]["text"]) == ("я", "соавтор")
+
+    # Тот же фрагмент — запись отменяется, пользователь получает предупреждение
+    coauthor.user_data["current_story"]["fragments"]["main_1"]["text"] = "не я"
+    mine.user_data["current_story"]["fragments"]["main_1"]["text"] = "снова я"
+    assert save(mine) is True
+    assert save(coauthor) is False
+    assert novel.load_user_story(USER_ID, "s1")["fragments"]["main_1"]["text"] == "снова я"
+    assert len(coauthor.bot.sent) == 1
+
+
+def test_patch_rejects_second_writer_with_same_version():
+    novel.save_story_data(USER_ID, "s1", copy.deepcopy(STORY))
+    version = novel.get_story_version("s1")
+
+    assert novel.save_story_patch(USER_ID, "s1", {"title": "первый"}, version) == version + 1
+    with pytest.raises(novel.StoryVersionConflict):
+        novel.save_story_patch(USER_ID, "s1", {"title": "второй"}, version)
+    assert novel.load_user_story(USER_ID, "s1")["title"] == "первый"
+    assert novel.get_story_version("s1") == version + 1
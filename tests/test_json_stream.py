@@ -0,0 +1,58 @@
+import io
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from json_stream import JsonStreamReader, JsonStreamWriter  # noqa: E402
+
+
+def read_all(text: str, chunk_size: int) -> dict:
+    reader = JsonStreamReader(io.StringIO(text), chunk_size=chunk_size)
+    reader.begin_object()
+    result = {}
+    while True:
+        key = reader.next_key()
+        if key is None:
+            return result
+        result[key] = reader.read_value()
+
+
+def test_number_split_at_chunk_boundary():
+    # Буфер кончается на "12345." — число не должно обрезаться до 12345
+    text = '{"a":12345.678,"b":1e5,"c":-0.5E-3,"d":7}'
+    for chunk_size in range(1, len(text) + 1):
+        assert read_all(text, chunk_size) == {"a": 12345.678, "b": 1e5, "c": -0.5e-3, "d": 7}
+
+
+def test_small_chunk_fuzz():
+    rng = random.Random(16)
+
+    def random_value(depth=0):
+        kind = rng.randrange(7 if depth < 3 else 4)
+        if kind == 0:
+            return rng.randint(-10**6, 10**6)
+        if kind == 1:
+            return rng.uniform(-1e6, 1e6) * 10 ** rng.randint(-20, 20)
+        if kind == 2:
+            return rng.choice([True, False, None])
+        if kind == 3:
+            return "".join(rng.choice('ab"\\ц\n ') for _ in range(rng.randint(0, 8)))
+        if kind == 4:
+            return [random_value(depth + 1) for _ in range(rng.randint(0, 4))]
+        return {f"k{i}": random_value(depth + 1) for i in range(rng.randint(0, 4))}
+
+    for _ in range(200):
+        data = {f"key{i}": random_value() for i in range(rng.randint(1, 6))}
+        out = io.StringIO()
+        writer = JsonStreamWriter(out)
+        writer.begin_object()
+        for key, value in data.items():
+            writer.key(key)
+            writer.value(value)
+        writer.end_object()
+        for text in (out.getvalue(), json.dumps(data, indent=2)):
+            for chunk_size in (1, 2, 3, 5, 8):
+                assert read_all(text, chunk_size) == data
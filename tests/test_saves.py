@@ -0,0 +1,66 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+for module in ("telegram", "firebase_admin", "flask", "google.genai", "networkx", "graphviz", "bs4"):
+    pytest.importorskip(module)
+
+os.environ["STORAGE_BACKEND"] = "memory"
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "test")
+
+import novel  # noqa: E402
+from storage import LocalReference  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def storage():
+    novel.init_storage()
+    novel.db.reference("/").delete()
+
+
+def test_slot_counter_starts_after_existing_slots(monkeypatch):
+    novel.db.reference("user_saves/7").set({"3": {"title": "а"}, "9": {"title": "б"}})
+    assert novel.allocate_save_slot(7) == 10
+
+    # Счётчик уже есть: слоты больше не перечитываются
+    monkeypatch.setattr(novel, "shallow_keys", lambda path: pytest.fail(f"лишнее чтение {path}"))
+    assert novel.allocate_save_slot(7) == 11
+    novel.db.reference("user_saves_counter/8").set(4)
+    assert novel.allocate_save_slot(8) == 5
+
+
+def checkpoint(user_id: int, strength: int) -> bool:
+    novel.db.reference(f"story_settings/s1/{user_id}").set({"fragment_id": f"f{strength}", "current_effects": {"сила": strength}})
+    return novel.perform_save(user_id, "s1", "checkpoint", "100", "История")
+
+
+def test_failed_checkpoint_write_is_rolled_back(monkeypatch):
+    monkeypatch.setattr(novel, "CHECKPOINT_RING_SIZE", 2)
+    assert checkpoint(7, 1) and checkpoint(7, 2)
+
+    original_update = LocalReference.update
+
+    def failing_update(self, value):
+        if any(path.startswith("user_saves/") and value[path] is not None for path in value):
+            raise RuntimeError("сеть недоступна")
+        return original_update(self, value)
+
+    monkeypatch.setattr(LocalReference, "update", failing_update)
+    assert checkpoint(7, 3) is False
+    monkeypatch.setattr(LocalReference, "update", original_update)
+
+    # В кольце нет записи без слота, а слот вытесненного чекпоинта удалён
+    ring = novel.db.reference("user_checkpoints/7/s1").get()
+    slots = novel._slots_as_dict(novel.db.reference("user_saves/7").get())
+    assert [entry["slot_id"] for entry in novel._ring_entries(ring)] == [2]
+    assert sorted(slots) == ["2"]
+    assert novel.materialize_checkpoint(7, "s1", slots["2"]["checkpoint_seq"])["current_effects"] == {"сила": 2}
+
+    assert checkpoint(7, 4)
+    slots = novel._slots_as_dict(novel.db.reference("user_saves/7").get())
+    assert sorted(slots) == ["2", "4"]
+    assert novel.materialize_checkpoint(7, "s1", slots["4"]["checkpoint_seq"])["current_effects"] == {"сила": 4}
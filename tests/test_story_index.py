@@ -0,0 +1,65 @@
+import copy
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+for module in ("telegram", "firebase_admin", "flask", "google.genai", "networkx", "graphviz", "bs4"):
+    pytest.importorskip(module)
+
+os.environ["STORAGE_BACKEND"] = "memory"
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "test")
+
+import novel  # noqa: E402
+
+STORY = {"title": "Тест", "public": True, "user_name": "автор", "fragments": {"main_1": {"text": "начало"}}}
+
+
+@pytest.fixture(autouse=True)
+def storage():
+    novel.init_storage()
+    novel.db.reference("/").delete()
+    novel.story_cache.clear()
+    novel._story_index_misses.clear()
+
+
+def test_stale_index_keeps_story_records_and_version():
+    novel.save_story_data("1", "abcdef0123", copy.deepcopy(STORY))
+    version = novel.get_story_version("abcdef0123")
+    # История переехала к другому владельцу мимо индекса
+    story = novel.db.reference("users_story/1/abcdef0123").get()
+    novel.db.reference("users_story/2/abcdef0123").set(story)
+    novel.db.reference("users_story/1/abcdef0123").delete()
+
+    owner, healed = novel.load_story_with_owner("abcdef0123")
+    assert owner == "2" and healed["title"] == "Тест"
+    index = novel.db.reference("stories_index/abcdef0123").get()
+    assert index["owner_id"] == "2" and index["version"] > version
+    assert novel.db.reference("public_catalog/abcdef0123").get()
+    assert novel.db.reference("story_changelog/abcdef0123").get()
+
+
+def test_stale_index_without_heal_drops_only_index_entry():
+    novel.save_story_data("1", "abcdef0123", copy.deepcopy(STORY))
+    novel.db.reference("users_story/1/abcdef0123").delete()
+
+    assert novel.load_story_with_owner("abcdef0123", heal=False) == (None, None)
+    assert novel.db.reference("stories_index/abcdef0123").get() is None
+    assert novel.db.reference("public_catalog/abcdef0123").get()
+    assert novel.db.reference("story_meta/1/abcdef0123").get()
+
+
+def test_index_miss_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(novel, "STORY_INDEX_MISS_MAX", 3)
+    for number in range(5):
+        assert novel.heal_story_index(f"{number:010x}") is None
+    assert list(novel._story_index_misses) == [f"{number:010x}" for number in (2, 3, 4)]
+
+    novel._story_index_misses.clear()
+    monkeypatch.setattr(novel, "STORY_INDEX_MISS_TTL", -1)
+    novel._remember_story_index_miss("ffffffffff")
+    assert not novel._story_index_missed("ffffffffff")
+    assert not novel._story_index_misses
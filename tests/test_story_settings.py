@@ -0,0 +1,52 @@
+import datetime
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+for module in ("telegram", "firebase_admin", "flask", "google.genai", "networkx", "graphviz", "bs4"):
+    pytest.importorskip(module)
+
+os.environ["STORAGE_BACKEND"] = "memory"
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "test")
+
+import novel  # noqa: E402
+
+DAY = 86400
+
+
+def launch(seconds_ago: float) -> dict:
+    moment = datetime.datetime.fromtimestamp(time.time() - seconds_ago, datetime.timezone.utc)
+    return {"launch_time": {"iso_timestamp_utc": moment.isoformat()}}
+
+
+@pytest.fixture(autouse=True)
+def storage():
+    novel.init_storage()
+    novel.db.reference("/").delete()
+
+
+def test_legacy_entries_are_deleted_or_backfilled_in_batches(monkeypatch):
+    monkeypatch.setattr(novel, "STORY_SETTINGS_LEGACY_BATCH", 2)
+    novel.db.reference("story_settings").set({
+        "old1": launch(30 * DAY),
+        "old2": launch(20 * DAY),
+        "bad": {"launch_time": {"iso_timestamp_utc": "вчера"}},
+        "no_time": {"user_attributes": {"сила": 1}},
+        "fresh": launch(DAY),
+        "indexed_old": {"launch_ts": int(time.time() - 40 * DAY)},
+        "indexed_new": {"launch_ts": int(time.time() - 60)},
+    })
+    cutoff = int(time.time() - 14 * DAY)
+
+    assert novel.sweep_legacy_story_settings(cutoff) == {"deleted": 4, "backfilled": 1}
+    assert sorted(novel.db.reference("story_settings").get()) == ["fresh", "indexed_new", "indexed_old"]
+    assert novel.db.reference("story_settings/fresh/launch_ts").get() > cutoff
+
+    # Дальше с записями работает плановая очистка по индексу launch_ts
+    assert novel.sweep_stale_story_settings(cutoff)["deleted"] == 1
+    assert novel.sweep_legacy_story_settings(cutoff) == {"deleted": 0, "backfilled": 0}
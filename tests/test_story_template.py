@@ -0,0 +1,82 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from story_template import (  # noqa: E402
+    TemplateCache,
+    compile_timed_edits,
+    render_template,
+    resume_timed_edits,
+    timed_edit_plan,
+)
+from template_render import MISSING, make_fragment, regex_apply_effect_values  # noqa: E402
+
+EFFECTS = {"Сила": 5, "ловкость": 2, "удача": 7, "золото": 120}
+
+
+def render(text: str, effects: dict) -> str:
+    normalized = {str(k).strip().lower(): v for k, v in effects.items()}
+    return render_template(TemplateCache().get(text, "basic"), normalized.get, lambda attr_raw: MISSING)
+
+
+def test_parity_with_regex_path():
+    for seed in range(20):
+        text = make_fragment(40, seed=seed)
+        for effects in (EFFECTS, {}, {"мана": 0, "СИЛА": 9}):
+            assert render(text, effects) == regex_apply_effect_values(text, effects)
+
+
+def test_parity_hand_written_cases():
+    cases = [
+        "Сила: {{{ сила }}}, мана: {{{мана}}}",
+        "{{сила:&gt;3}}сильный{{сила}}{{сила:&lt;3}}слабый{{сила}}",
+        "{{удача:=7}}<b>{{{удача}}}</b>{{удача}} и {{мана:>0}}скрыто{{мана}}",
+        "{{ЛОВКОСТЬ:>1}}вложенный {{{золото}}}{{ловкость}} конец",
+        "без подстановок & &amp; <i>текст</i>",
+    ]
+    for text in cases:
+        assert render(text, EFFECTS) == regex_apply_effect_values(text, EFFECTS)
+
+
+def test_cache_reuses_compiled_text():
+    cache = TemplateCache()
+    tokens = cache.get("{{{сила}}}", "basic")
+    assert cache.get("{{{сила}}}", "basic") is tokens
+    assert cache.get("{{{сила}}}", "html") is not tokens
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_timed_edits_close_tags_and_reset():
+    plan = compile_timed_edits("Начало <b>жирный [[+2]] дальше</b> ((-3)) заново </i>конец")
+    assert plan.base_text == "Начало <b>жирный"
+    assert [dict(step) for step in plan.steps] == [
+        {"delay": 2, "full_text": "Начало <b>жирный </b>"},
+        {"delay": 3, "full_text": "Начало <b>жирный  дальше</b> "},
+        {"delay": 0, "full_text": " заново конец"},
+    ]
+    assert plan.has_edits
+    assert compile_timed_edits("[[+999]]текст").steps[0]["delay"] == 60
+    assert not compile_timed_edits("без пауз").has_edits
+
+
+def test_timed_edit_plan_is_cached_and_read_only():
+    plan = timed_edit_plan("раз [[+1]] два")
+    assert timed_edit_plan("раз [[+1]] два") is plan
+    with pytest.raises(TypeError):
+        plan.steps[0]["delay"] = 5
+
+
+def test_resume_timed_edits_skips_overdue_frames():
+    steps = compile_timed_edits("раз [[+2]] два [[+3]] три [[+4]] четыре").steps
+    # Ни один кадр ещё не наступил — первый покажется через остаток паузы
+    assert resume_timed_edits(steps, started=100.0, now=101.5) == (0, 0.5)
+    # Просрочены кадры 0 и 1 — сразу показывается последний из них
+    assert resume_timed_edits(steps, started=100.0, now=106.0) == (1, None)
+    assert resume_timed_edits(steps, started=100.0, now=105.0) == (1, None)
+    # Простой дольше всего показа — сразу итоговый текст
+    assert resume_timed_edits(steps, started=100.0, now=500.0) == (len(steps) - 1, None)
@@ -0,0 +1,65 @@
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from timer_wheel import TimerWheel  # noqa: E402
+
+
+def test_cascade_fires_in_order_and_not_early():
+    # 4 слота на уровень: уровень 0 — 4 тика, уровень 1 — 16, дальше overflow
+    wheel = TimerWheel(tick=0.01, slot_bits=2, levels=2)
+    fired = []
+
+    async def record(name, started, delay):
+        fired.append(name)
+        assert time.monotonic() - started >= delay - 0.011
+
+    async def main():
+        started = time.monotonic()
+        for name, delay in (("overflow", 0.25), ("level0", 0.02), ("level1", 0.09), ("level1b", 0.13)):
+            wheel.schedule(name, delay, record, name, started, delay)
+        assert wheel.stats()["per_level"] == [1, 2]
+        assert wheel.stats()["overflow"] == 1
+        while len(wheel) or wheel.stats()["running"]:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(main())
+    assert fired == ["level0", "level1", "level1b", "overflow"]
+    assert wheel.stats()["fired"] == 4
+    assert wheel.stats()["errors"] == 0
+
+
+def test_cancel_pending_and_running():
+    wheel = TimerWheel(tick=0.01, slot_bits=2, levels=2)
+    fired = []
+
+    async def slow(name):
+        fired.append(name)
+        await asyncio.sleep(10)
+        fired.append(f"{name} done")
+
+    async def main():
+        wheel.schedule(("chat", 1), 0.02, slow, "running")
+        wheel.schedule(("chat", 2), 0.5, slow, "pending")
+        wheel.schedule(("chat", 3), 0.2, slow, "replaced")
+        wheel.schedule(("chat", 3), 0.04, slow, "replacement")
+        assert wheel.pending("chat") == 3
+
+        while "running" not in fired:
+            await asyncio.sleep(0.01)
+        assert ("chat", 1) in wheel
+        assert wheel.cancel(("chat", 1))
+        assert wheel.cancel(("chat", 2))
+        assert not wheel.cancel(("chat", 9))
+        await asyncio.sleep(0.1)
+        wheel.cancel(("chat", 3))
+        await asyncio.sleep(0.02)
+
+    asyncio.run(main())
+    assert "running done" not in fired
+    assert "replaced" not in fired and "pending" not in fired
+    assert "replacement" in fired
+    assert len(wheel) == 0 and wheel.stats()["running"] == 0
@@ -0,0 +1,210 @@
+"""
+Иерархическое колесо таймеров для таймеров фрагментов (авто-переходы, пошаговый показ).
+
+Раньше каждый авто-переход и каждая серия правок были отдельной asyncio-задачей,
+которая спала до нужного момента, а учёт вёлся в словарях active_timers и
+active_edit_tasks. Теперь ожидающий таймер — небольшой объект в слоте колеса,
+а время отсчитывает одна задача-драйвер на весь процесс:
+  • вставка и отмена по ключу — O(1) (ключ → таймер → его слот);
+  • уровень L колеса покрывает TIMER_SLOTS**(L+1) тиков; когда младший уровень
+    проходит полный круг, слот старшего уровня раскладывается ниже (cascade);
+  • таймеры дальше верхнего уровня лежат в overflow и раскладываются при его обороте;
+  • при срабатывании колбэк запускается задачей, которая тоже учитывается по ключу,
+    поэтому cancel(key) прерывает и ожидающий, и уже выполняющийся таймер.
+
+Ключ — любой hashable; в боте это (chat_id, слот), см. novel.py.
+Как и edit_scheduler, модуль отдельный, чтобы колесо было одно на процесс.
+"""
+
+import asyncio
+import logging
+import math
+import time
+
+logger = logging.getLogger(__name__)
+
+TIMER_TICK = 0.1  # Секунд в одном тике
+TIMER_SLOT_BITS = 6  # 64 слота на уровень
+TIMER_LEVELS = 4  # 64**4 тиков по 0.1 с ≈ 19 суток без overflow
+
+_OVERFLOW = -1
+
+
+class _Timer:
+    __slots__ = ("key", "expires", "callback", "args", "kwargs", "level", "slot")
+
+    def __init__(self, key, expires: int, callback, args: tuple, kwargs: dict):
+        self.key = key
+        self.expires = expires
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.level = None
+        self.slot = None
+
+
+class TimerWheel:
+    def __init__(self, tick: float = TIMER_TICK, slot_bits: int = TIMER_SLOT_BITS, levels: int = TIMER_LEVELS):
+        self.tick = tick
+        self.slot_bits = slot_bits
+        self.slots = 1 << slot_bits
+        self.mask = self.slots - 1
+        self.levels = levels
+        self._wheels = [[{} for _ in range(self.slots)] for _ in range(levels)]
+        self._overflow = {}
+        self._timers = {}
+        self._running = {}
+        self._base = time.monotonic()
+        self._tick = 0
+        self._driver = None
+        self.scheduled = 0
+        self.fired = 0
+        self.cancelled = 0
+        self.errors = 0
+        self.max_pending = 0
+
+    # --- Публичный интерфейс ---
+
+    def schedule(self, key, delay: float, callback, *args, **kwargs) -> None:
+        """
+        Через delay секунд запустит callback(*args, **kwargs) (корутину).
+        Таймер с тем же ключом заменяется; если его колбэк уже выполняется,
+        он отменяется — кроме случая, когда schedule вызван из него самого
+        (следующий шаг цепочки ставит себя под тем же ключом).
+        """
+        self._cancel_pending(key)
+        running = self._running.get(key)
+        if running is not None and running is not asyncio.current_task():
+            running.cancel()
+
+        if not self._timers:
+            # Колесо пустое — догонять нечего, просто переносим «сейчас»
+            self._tick = max(self._tick, self._now_tick())
+        expires = max(self._tick + 1, self._tick_at(time.monotonic() + max(delay, 0.0)))
+        timer = _Timer(key, expires, callback, args, kwargs)
+        self._timers[key] = timer
+        self._place(timer)
+        self.scheduled += 1
+        self.max_pending = max(self.max_pending, len(self._timers))
+
+        if self._driver is None or self._driver.done():
+            self._driver = asyncio.create_task(self._drive())
+
+    def cancel(self, key) -> bool:
+        """Отменяет ожидающий таймер и прерывает выполняющийся колбэк. True, если было что отменять."""
+        found = self._cancel_pending(key)
+        running = self._running.get(key)
+        if running is not None and running is not asyncio.current_task():
+            running.cancel()
+            found = True
+        return found
+
+    def __contains__(self, key) -> bool:
+        return key in self._timers or key in self._running
+
+    def __len__(self) -> int:
+        return len(self._timers)
+
+    def pending(self, key=None) -> int:
+        """Число ожидающих таймеров; с key — ожидающих таймеров, чей ключ начинается с key (например, чата)."""
+        if key is None:
+            return len(self._timers)
+        return sum(1 for timer_key in self._timers if isinstance(timer_key, tuple) and timer_key[:1] == (key,))
+
+    def stats(self) -> dict:
+        per_level = [sum(len(slot) for slot in wheel) for wheel in self._wheels]
+        return {
+            "pending": len(self._timers),
+            "running": len(self._running),
+            "max_pending": self.max_pending,
+            "per_level": per_level,
+            "overflow": len(self._overflow),
+            "scheduled": self.scheduled,
+            "fired": self.fired,
+            "cancelled": self.cancelled,
+            "errors": self.errors,
+        }
+
+    # --- Устройство колеса ---
+
+    def _now_tick(self) -> int:
+        return int((time.monotonic() - self._base) / self.tick)
+
+    def _tick_at(self, moment: float) -> int:
+        return math.ceil((moment - self._base) / self.tick)
+
+    def _place(self, timer: _Timer) -> None:
+        # Самый младший уровень, в «родительском» окне которого лежат и сейчас, и срок таймера:
+        # тогда его слот на этом уровне ещё не пройден и будет обработан (или разложен) вовремя
+        for level in range(self.levels):
+            parent_shift = self.slot_bits * (level + 1)
+            if timer.expires >> parent_shift == self._tick >> parent_shift:
+                slot = (timer.expires >> (self.slot_bits * level)) & self.mask
+                self._wheels[level][slot][timer.key] = timer
+                timer.level, timer.slot = level, slot
+                return
+        self._overflow[timer.key] = timer
+        timer.level, timer.slot = _OVERFLOW, None
+
+    def _cancel_pending(self, key) -> bool:
+        timer = self._timers.pop(key, None)
+        if timer is None:
+            return False
+        if timer.level == _OVERFLOW:
+            del self._overflow[key]
+        else:
+            del self._wheels[timer.level][timer.slot][key]
+        self.cancelled += 1
+        return True
+
+    def _advance(self, target_tick: int) -> None:
+        while self._tick < target_tick and self._timers:
+            self._tick += 1
+            tick = self._tick
+            for level in range(1, self.levels + 1):
+                if tick & ((1 << (self.slot_bits * level)) - 1):
+                    break
+                if level == self.levels:
+                    bucket, self._overflow = self._overflow, {}
+                else:
+                    slot = (tick >> (self.slot_bits * level)) & self.mask
+                    bucket = self._wheels[level][slot]
+                    self._wheels[level][slot] = {}
+                for timer in bucket.values():
+                    self._place(timer)
+
+            slot = tick & self.mask
+            due = self._wheels[0][slot]
+            if due:
+                self._wheels[0][slot] = {}
+                for timer in due.values():
+                    self._fire(timer)
+        self._tick = max(self._tick, target_tick)
+
+    def _fire(self, timer: _Timer) -> None:
+        del self._timers[timer.key]
+        self.fired += 1
+        task = asyncio.create_task(self._run_callback(timer))
+        self._running[timer.key] = task
+
+    async def _run_callback(self, timer: _Timer) -> None:
+        try:
+            await timer.callback(*timer.args, **timer.kwargs)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Timer wheel: ошибка в таймере {timer.key}: {e}", exc_info=True)
+        finally:
+            if self._running.get(timer.key) is asyncio.current_task():
+                del self._running[timer.key]
+
+    async def _drive(self) -> None:
+        """Единственная задача, отсчитывающая тики; завершается, когда таймеров не осталось."""
+        while self._timers:
+            next_moment = self._base + (self._tick + 1) * self.tick
+            await asyncio.sleep(max(0.0, next_moment - time.monotonic()))
+            self._advance(self._now_tick())
+
+
+fragment_timers = TimerWheel()